@@ -4,11 +4,12 @@ Contains routing for EOS-DB API, and callbacks for response modification."""
 
 from pyramid.config import Configurator
 from pyramid.events import NewRequest, NewResponse
+from pyramid.settings import asbool
 
 import logging
 import sys, os
 
-from eos_db import server
+from eos_db import server, metrics, tracing, profiling, slowquery, capture, reload
 from eos_db.auth import HybridAuthenticationPolicy, add_cookie_callback
 from pyramid.httpexceptions import HTTPUnauthorized
 
@@ -96,6 +97,46 @@ def main(global_config, **settings):
     # Needed to ensure proper 401 responses
     config.add_forbidden_view(hap.get_forbidden_view)
 
+    # Time all requests and count the SQL they run, for /metrics.  This puts
+    # listeners on every Engine, so it is only done if the .ini file asks.
+    if asbool(settings.get('metrics.enabled', False)):
+        metrics.install()
+        config.add_tween('eos_db.metrics.metrics_tween_factory')
+    else:
+        metrics.uninstall()
+
+    # Give every request an id, and trace a sample of them, logging any that are
+    # slow.  See eos_db.tracing for the settings.  Also off unless asked for.
+    if asbool(settings.get('tracing.enabled', False)):
+        config.add_tween('eos_db.tracing.tracing_tween_factory')
+    else:
+        tracing.uninstall()
+
+    # Log slow SQL statements, with query plans.  See eos_db.slowquery.
+    slowquery.configure(settings)
+    if slowquery.SLOW_SECS:
+        slowquery.install()
+
+    # Let administrators profile a request by adding an X-EOS-Profile header.
+    config.add_tween('eos_db.profiling.profile_tween_factory')
+
+    # Optionally watch the .settings.json file and reload it when it changes.
+    # Each request then keeps to the configuration it started with.
+    reload_secs = float(settings.get('config.reload_secs', 0))
+    if reload_secs:
+        config.add_tween('eos_db.reload.pin_config_tween_factory')
+
+    # Optionally save every request to a file, for eos_db.perf.replay.  Added
+    # last so it is the outermost tween and times all the others.
+    capture.configure(settings)
+    if capture.FILE:
+        config.add_tween('eos_db.capture.capture_tween_factory')
+
+    # Optionally sample the stacks of all threads in the background.
+    if asbool(settings.get('profiling.sampler', False)):
+        profiling.start_sampler(float(settings.get('profiling.sampler.interval', 0.01)),
+                                float(settings.get('profiling.sampler.max_cpu', 1.0)))
+
     # Do this if you need extra info generated by the Configurator, but
     # we do not.
     #settings = config.registry.settings
@@ -105,6 +146,8 @@ def main(global_config, **settings):
     settings_json = global_config['__file__'][:-4] + ".settings.json"
     if os.path.isfile(settings_json):
         server.load_config_json(settings_json)
+        if reload_secs:
+            reload.watch(settings_json, reload_secs)
 
     # Set the engine, but only if it's not already set.  This is useful
     # for testing where we can re-initialise the webapp while leaving the
@@ -117,6 +160,28 @@ def main(global_config, **settings):
     # View of BoostLevels from settings.py
     config.add_route('boostlevels', '/boostlevels')
 
+    # Liveness and readiness probes, which don't touch the hot tables
+    config.add_route('health', '/health')
+    config.add_route('ready', '/ready')
+
+    # Run a list of API calls in one request, sharing one DB session
+    config.add_route('batch', '/batch')
+
+    # Request and DB metrics in Prometheus format (admins only)
+    config.add_route('metrics', '/metrics')
+
+    # Profiles of requests made with the X-EOS-Profile header (admins only)
+    config.add_route('profiles', '/profiles')
+    config.add_route('profile',  '/profiles/{id}')
+    config.add_route('samples',  '/samples')
+
+    # Memory tracing with tracemalloc (admins only)
+    config.add_route('memory',           '/memory')
+    config.add_route('memory_start',     '/memory/start')
+    config.add_route('memory_stop',      '/memory/stop')
+    config.add_route('memory_snapshots', '/memory/snapshots')
+    config.add_route('memory_snapshot',  '/memory/snapshots/{id}')
+
     # User-related API calls (callable by users)
 
     config.add_route('users',       '/users')         # Return user list
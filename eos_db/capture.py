@@ -0,0 +1,148 @@
+"""Capture of live HTTP traffic to EOS-DB, for replaying with eos_db.perf.replay.
+
+When turned on, a tween writes one line of JSON for each request to a file,
+giving the time, method, path, matched route, parameters, how the caller
+authenticated and which group they were in, the status and how long it took.
+This lets us benchmark changes against the real mix of portal, script and agent
+traffic.
+
+No credentials are saved.  The Authorization header and the auth_tkt cookie are
+never looked at, beyond noting which one was used, and any parameter that looks
+like a password or secret has its value replaced.  The names of users and
+servers in the paths are kept.
+
+Settings in the .ini file:
+
+  capture.file = capture.jsonl   Append requests to this file.  Unset means off.
+  capture.sample_rate = 1.0      Fraction of requests to capture, 0 to 1.
+
+Calls made within a /batch request are part of the batch, so only the batch
+itself is captured.
+"""
+
+import re
+import json
+import random
+import logging
+import threading
+from time import time, perf_counter
+
+from eos_db.streaming import after_body
+
+log = logging.getLogger(__name__)
+
+FILE = None
+SAMPLE_RATE = 1.0
+
+# Values of parameters with names like these are replaced with SCRUBBED, here
+# and in the slow query log.
+SECRET = re.compile(r'pass|secret|token|auth|key', re.I)
+SCRUBBED = '********'
+
+_local = threading.local()
+_lock = threading.Lock()
+_fh = None
+
+def configure(settings):
+    """Reads the capture.* settings from the app settings."""
+    global FILE, SAMPLE_RATE
+    FILE = settings.get('capture.file') or None
+    SAMPLE_RATE = float(settings.get('capture.sample_rate', SAMPLE_RATE))
+
+def close():
+    """Closes the capture file.  It will be opened again by the next request."""
+    global _fh
+    with _lock:
+        if _fh is not None:
+            _fh.close()
+            _fh = None
+
+def _write(line):
+    global _fh
+    with _lock:
+        if _fh is None:
+            _fh = open(FILE, 'a', buffering=1)
+        _fh.write(line + '\n')
+
+def scrub(value, key=''):
+    """Returns a copy of value, which may be a dict or list from JSON, with
+       anything under a secret-looking key replaced.
+    """
+    if SECRET.search(key):
+        return SCRUBBED
+    if isinstance(value, dict):
+        return { k: scrub(v, str(k)) for k, v in value.items() }
+    if isinstance(value, list):
+        return [ scrub(v) for v in value ]
+    return value
+
+def auth_method(request):
+    """How the caller authenticated, going only on which credentials were sent."""
+    if request.headers.get('auth_tkt') or 'auth_tkt' in request.cookies:
+        return 'cookie'
+    if request.authorization:
+        return 'basic'
+    return None
+
+def identity(request):
+    """The group of the caller, if the view had to find out.  This never does a
+       password check of its own.
+    """
+    principals = getattr(request, 'cached_effective_principals', None)
+    if principals is None:
+        return None
+    for p in principals:
+        if p.startswith('group:'):
+            return p[6:]
+    return 'anonymous'
+
+def record(request, start, status, elapsed):
+    """Makes the record for one request, as a dict."""
+    res = dict( t = round(start, 6),
+                method = request.method,
+                path = request.path,
+                route = request.matched_route.name if request.matched_route else None,
+                params = [ [k, SCRUBBED if SECRET.search(k) else v]
+                           for k, v in request.params.items() ],
+                auth = auth_method(request),
+                identity = identity(request),
+                status = status,
+                ms = round(elapsed * 1000, 3) )
+    if request.content_type == 'application/json':
+        try:
+            res['json'] = scrub(request.json_body)
+        except ValueError:
+            pass
+    return res
+
+def capture_tween_factory(handler, registry):
+    """Tween that writes a sample of requests to the capture file."""
+    configure(registry.settings)
+
+    def capture_tween(request):
+        if getattr(_local, 'busy', False) or not FILE or random.random() >= SAMPLE_RATE:
+            return handler(request)
+
+        _local.busy = True
+        start = time()
+        pc_start = perf_counter()
+
+        def finish(status):
+            elapsed = perf_counter() - pc_start
+            _local.busy = False
+            try:
+                _write(json.dumps(record(request, start, status, elapsed)))
+            except Exception:
+                #Capturing must never break the request.
+                log.exception("Failed to capture request")
+
+        try:
+            response = handler(request)
+        except:
+            finish(500)
+            raise
+        #Time the whole body of a streamed listing, as the replay will.
+        after_body(response, lambda: finish(response.status_int))
+        return response
+
+    return capture_tween
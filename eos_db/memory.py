@@ -0,0 +1,135 @@
+"""Memory tracing for EOS-DB, for administrators.
+
+This wraps tracemalloc so that we can find out what is holding on to memory in
+a long-running server.  The calls are:
+
+  GET  /memory                      Whether tracing is on, and how much is traced.
+  POST /memory/start?frames=1       Start tracing, keeping this many frames.
+  POST /memory/stop                 Stop tracing.
+  POST /memory/snapshots            Take a snapshot.
+  GET  /memory/snapshots            List the snapshots.
+  GET  /memory/snapshots/{id}       Top allocation sites in a snapshot.
+       ?base={id}                   ... or the growth since another snapshot.
+       ?group_by=filename           ... grouped by file rather than by line.
+       ?limit=25                    ... this many of them.
+
+Tracing slows Python down a good deal and uses extra memory itself, so only
+turn it on while looking into a problem.  Only the last few snapshots are kept.
+"""
+
+import threading
+import tracemalloc
+from datetime import datetime
+from collections import OrderedDict
+
+# How many snapshots to keep.  Each one holds every traced allocation.
+MAX_SNAPSHOTS = 5
+
+# How many allocation sites to list by default.
+TOP = 25
+
+GROUP_BY = ('lineno', 'filename', 'traceback')
+
+# Allocations made by tracemalloc itself, or while importing, are of no interest.
+_FILTERS = ( tracemalloc.Filter(False, tracemalloc.__file__),
+             tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+             tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+             tracemalloc.Filter(False, '<unknown>') )
+
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+_next_id = 1
+
+def start(frames=1):
+    """Starts tracing, if it is not on already.
+    :param frames: How many frames of each traceback to keep.  More frames show
+                   who called the code that allocated the memory, but cost more.
+    :returns: True if tracing was started.
+    """
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+def stop():
+    """Stops tracing.  Snapshots already taken are kept.
+    :returns: True if tracing was on.
+    """
+    if not tracemalloc.is_tracing():
+        return False
+    tracemalloc.stop()
+    return True
+
+def status():
+    """Returns a dict saying whether tracing is on, how much memory is traced,
+       and which snapshots are held.
+    """
+    res = dict(tracing=tracemalloc.is_tracing(), snapshots=list_snapshots())
+    if res['tracing']:
+        current, peak = tracemalloc.get_traced_memory()
+        res.update( frames = tracemalloc.get_traceback_limit(),
+                    traced = current,
+                    peak = peak,
+                    overhead = tracemalloc.get_tracemalloc_memory() )
+    return res
+
+def take_snapshot():
+    """Takes a snapshot and keeps it, dropping the oldest if there are too many.
+    :returns: The id of the new snapshot, or None if tracing is off.
+    """
+    global _next_id
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    with _snapshots_lock:
+        snapshot_id = str(_next_id)
+        _next_id += 1
+        _snapshots[snapshot_id] = (datetime.now(), snapshot)
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    return snapshot_id
+
+def list_snapshots():
+    """Returns a list of {id, taken} for the snapshots held, oldest first."""
+    with _snapshots_lock:
+        return [ dict(id=k, taken=v[0].isoformat()) for k, v in _snapshots.items() ]
+
+def clear_snapshots():
+    with _snapshots_lock:
+        _snapshots.clear()
+
+def _frame_name(frame):
+    return "%s:%i" % (frame.filename.rsplit('/site-packages/', 1)[-1], frame.lineno)
+
+def _stat_dict(stat, group_by):
+    frame = stat.traceback[0]
+    res = dict(file=frame.filename.rsplit('/site-packages/', 1)[-1])
+    if group_by != 'filename':
+        res['line'] = frame.lineno
+    if group_by == 'traceback':
+        res['traceback'] = [ _frame_name(f) for f in stat.traceback ]
+    res.update(size=stat.size, count=stat.count)
+    if hasattr(stat, 'size_diff'):
+        res.update(size_diff=stat.size_diff, count_diff=stat.count_diff)
+    return res
+
+def top(snapshot_id, base_id=None, group_by='lineno', limit=TOP):
+    """Lists the allocation sites holding the most memory in a snapshot, or,
+       if base_id is given, those that grew the most since that snapshot.
+    :returns: A list of dicts with file, line, size and count, plus size_diff
+              and count_diff when comparing.  Sizes are in bytes.  None if either
+              snapshot is not held.
+    """
+    if group_by not in GROUP_BY:
+        raise ValueError("group_by must be one of %s" % ', '.join(GROUP_BY))
+    with _snapshots_lock:
+        snapshot = _snapshots.get(snapshot_id)
+        base = _snapshots.get(base_id) if base_id else None
+    if not snapshot or (base_id and not base):
+        return None
+
+    if base:
+        stats = snapshot[1].compare_to(base[1], group_by)
+    else:
+        stats = snapshot[1].statistics(group_by)
+    return [ _stat_dict(s, group_by) for s in stats[:limit] ]
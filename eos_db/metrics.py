@@ -0,0 +1,313 @@
+"""Request and database metrics for EOS-DB.
+
+A tween times every request and records the status, while SQLAlchemy event
+listeners count the SQL statements each request makes and the time they take.
+The totals are exposed in Prometheus text format by the /metrics API call.
+
+The @with_session decorator in eos_db.server reports to us too, so we can see
+how many DB sessions each request opens, how long each DB function takes, how
+deeply the calls nest, and which functions open a new session of their own
+while an outer one is still active, which usually means someone forgot to pass
+the session through.
+
+To keep the overhead low enough to leave this on in production, each thread
+keeps its own counters, and only the (rare) call to render() adds them all up.
+Even so, nothing is counted unless metrics.enabled is set in the .ini file, so
+eos-admin and the like don't pay for it.
+"""
+
+import threading
+from time import perf_counter
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from eos_db.streaming import after_body
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label used for requests that match no route.
+NO_ROUTE = '__none__'
+
+# Set by install().  eos_db.server checks this before reporting DB function calls.
+ENABLED = False
+
+class _ThreadStats():
+    """The counters for one thread.  Only the owning thread ever writes to
+       these, so no locking is needed.  Readers may see a count that is one
+       request out of date, which is fine.
+    """
+    def __init__(self, thread_name):
+        # The name of the owning thread, such as waitress-0.
+        self.thread_name = thread_name
+        # route -> [ bucket counts..., +Inf count, sum of secs, sql count, sql secs, sessions ]
+        self.routes = {}
+        # (route, status) -> count
+        self.statuses = {}
+        # function -> [ calls, secs, sessions opened, sessions opened inside another, max depth ]
+        self.functions = {}
+        # Running totals for the request in progress on this thread.
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.sql_start = None
+        self.sessions = 0
+        self.in_progress = 0
+        # How deeply @with_session calls are nested, and how many of them
+        # have a session of their own open, right now.
+        self.depth = 0
+        self.open_sessions = 0
+
+    def record(self, route, status, elapsed, sql_count, sql_time, sessions):
+        r = self.routes.get(route)
+        if r is None:
+            r = self.routes[route] = [0] * (len(BUCKETS) + 1) + [0.0, 0, 0.0, 0]
+        r[bisect_left(BUCKETS, elapsed)] += 1
+        r[-4] += elapsed
+        r[-3] += sql_count
+        r[-2] += sql_time
+        r[-1] += sessions
+
+        key = (route, status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+
+_local = threading.local()
+_all_stats = []
+_all_stats_lock = threading.Lock()
+
+# The waitress task dispatcher, if register_dispatcher() has been called.
+_dispatcher = None
+
+def _stats():
+    """Gets the counters for the current thread, making them on first use."""
+    try:
+        return _local.stats
+    except AttributeError:
+        st = _local.stats = _ThreadStats(threading.current_thread().name)
+        with _all_stats_lock:
+            _all_stats.append(st)
+        return st
+
+def reset():
+    """Throws away all the counters.  Mainly for testing."""
+    with _all_stats_lock:
+        for st in _all_stats:
+            st.routes = {}
+            st.statuses = {}
+            st.functions = {}
+
+_installed = False
+def install():
+    """Sets up the SQLAlchemy event listeners.  These are attached to the Engine
+       class, so they apply to whatever engine server.choose_engine() makes,
+       now or later.  Calling this more than once has no further effect.
+    """
+    global _installed, ENABLED
+    if _installed:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _installed = ENABLED = True
+
+def uninstall():
+    """Takes the listeners off again, and stops @with_session reporting to us."""
+    global _installed, ENABLED
+    if not _installed:
+        return
+    event.remove(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.remove(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _installed = ENABLED = False
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _stats().sql_start = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    st = _stats()
+    if st.sql_start is not None:
+        st.sql_time += perf_counter() - st.sql_start
+        st.sql_start = None
+    st.sql_count += 1
+
+def _function(st, name):
+    f = st.functions.get(name)
+    if f is None:
+        f = st.functions[name] = [0, 0.0, 0, 0, 0]
+    return f
+
+def function_enter():
+    """Called by @with_session as a DB function starts.  Pass what this returns
+       to function_exit() when it finishes.
+    """
+    st = _stats()
+    st.depth += 1
+    return (st, st.depth, perf_counter())
+
+def function_exit(token, name):
+    st, depth, start = token
+    st.depth -= 1
+    f = _function(st, name)
+    f[0] += 1
+    f[1] += perf_counter() - start
+    if depth > f[4]:
+        f[4] = depth
+
+def session_opened(name):
+    """Called when a DB function opens a new session, rather than using one
+       it was given.  Call session_closed() when it is done with it.
+    """
+    st = _stats()
+    f = _function(st, name)
+    f[2] += 1
+    if st.open_sessions:
+        #There is already a session open further up the stack.
+        f[3] += 1
+    st.open_sessions += 1
+    st.sessions += 1
+
+def session_closed():
+    _stats().open_sessions -= 1
+
+def register_dispatcher(dispatcher):
+    """Tells us about the waitress task dispatcher, the task_dispatcher of a
+       waitress server, so we can report the queue depth.  Waitress does not
+       tell the app about it, so this only works where we start waitress
+       ourselves, as eos_db.perf.loadtest does.  Otherwise the busy threads
+       are still reported, by name.
+    """
+    global _dispatcher
+    _dispatcher = dispatcher
+
+def metrics_tween_factory(handler, registry):
+    """Tween that times each request and attributes the SQL statements run while
+       handling it to the matched route.  Requests from /batch go through this
+       too, and are counted both on their own and as part of the batch.
+    """
+    def metrics_tween(request):
+        st = _stats()
+        #Save the totals of any outer request, for nested calls.
+        outer_count, outer_time, outer_sessions = st.sql_count, st.sql_time, st.sessions
+        st.sql_count, st.sql_time, st.sessions = 0, 0.0, 0
+        st.in_progress += 1
+
+        start = perf_counter()
+
+        def finish(status):
+            elapsed = perf_counter() - start
+            route = request.matched_route.name if request.matched_route else NO_ROUTE
+            st.record(route, status, elapsed, st.sql_count, st.sql_time, st.sessions)
+
+            st.in_progress -= 1
+            st.sql_count += outer_count
+            st.sql_time += outer_time
+            st.sessions += outer_sessions
+
+        try:
+            response = handler(request)
+        except:
+            finish(500)
+            raise
+        #The big listings are streamed, and run most of their SQL after the
+        #handler returns, so the request is recorded when the body is done.
+        after_body(response, lambda: finish(response.status_int))
+        return response
+
+    return metrics_tween
+
+def _label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def render():
+    """Adds up the counters from all threads and returns the text for the
+       /metrics call, in the Prometheus text exposition format.
+    """
+    with _all_stats_lock:
+        all_stats = list(_all_stats)
+
+    routes = {}
+    statuses = {}
+    functions = {}
+    in_progress = 0
+    busy_threads = {}
+    for st in all_stats:
+        for route, r in list(st.routes.items()):
+            total = routes.setdefault(route, [0] * len(r))
+            for i, v in enumerate(r):
+                total[i] += v
+        for key, count in list(st.statuses.items()):
+            statuses[key] = statuses.get(key, 0) + count
+        for name, f in list(st.functions.items()):
+            total = functions.setdefault(name, [0, 0.0, 0, 0, 0])
+            for i in range(4):
+                total[i] += f[i]
+            total[4] = max(total[4], f[4])
+        in_progress += st.in_progress
+        busy_threads[st.thread_name] = busy_threads.get(st.thread_name, 0) + st.in_progress
+
+    out = []
+    out.append('# HELP eos_request_duration_seconds Time taken to handle requests, by route.')
+    out.append('# TYPE eos_request_duration_seconds histogram')
+    for route, r in sorted(routes.items()):
+        cumulative = 0
+        for le, count in zip(BUCKETS + ('+Inf',), r):
+            cumulative += count
+            out.append('eos_request_duration_seconds_bucket{route="%s",le="%s"} %i' %
+                       (_label(route), le, cumulative))
+        out.append('eos_request_duration_seconds_sum{route="%s"} %f' % (_label(route), r[-4]))
+        out.append('eos_request_duration_seconds_count{route="%s"} %i' % (_label(route), cumulative))
+
+    out.append('# HELP eos_requests_total Requests handled, by route and status.')
+    out.append('# TYPE eos_requests_total counter')
+    for (route, status), count in sorted(statuses.items()):
+        out.append('eos_requests_total{route="%s",status="%s"} %i' %
+                   (_label(route), status, count))
+
+    out.append('# HELP eos_sql_statements_total SQL statements executed, by route.')
+    out.append('# TYPE eos_sql_statements_total counter')
+    for route, r in sorted(routes.items()):
+        out.append('eos_sql_statements_total{route="%s"} %i' % (_label(route), r[-3]))
+
+    out.append('# HELP eos_sql_seconds_total Time spent executing SQL, by route.')
+    out.append('# TYPE eos_sql_seconds_total counter')
+    for route, r in sorted(routes.items()):
+        out.append('eos_sql_seconds_total{route="%s"} %f' % (_label(route), r[-2]))
+
+    out.append('# HELP eos_sessions_opened_total DB sessions opened, by route.')
+    out.append('# TYPE eos_sessions_opened_total counter')
+    for route, r in sorted(routes.items()):
+        out.append('eos_sessions_opened_total{route="%s"} %i' % (_label(route), r[-1]))
+
+    #Per-function summary of the @with_session functions in eos_db.server.
+    for i, name, kind, text in (
+            (0, 'eos_db_function_calls_total', 'counter', 'Calls to each DB function.'),
+            (1, 'eos_db_function_seconds_total', 'counter',
+                'Time spent in each DB function, including the functions it calls.'),
+            (2, 'eos_db_function_sessions_total', 'counter',
+                'New DB sessions opened by each function.'),
+            (3, 'eos_db_function_nested_sessions_total', 'counter',
+                'New DB sessions opened by each function while another was open.'),
+            (4, 'eos_db_function_max_depth', 'gauge',
+                'Deepest nesting of DB function calls each function was seen at.') ):
+        out.append('# HELP %s %s' % (name, text))
+        out.append('# TYPE %s %s' % (name, kind))
+        for func, f in sorted(functions.items()):
+            out.append(('%s{function="%s"} ' % (name, _label(func))) +
+                       ('%f' if i == 1 else '%i') % f[i])
+
+    out.append('# HELP eos_requests_in_progress Requests currently being handled.')
+    out.append('# TYPE eos_requests_in_progress gauge')
+    out.append('eos_requests_in_progress %i' % in_progress)
+    out.append('# HELP eos_thread_requests_in_progress Requests being handled by each thread.')
+    out.append('# TYPE eos_thread_requests_in_progress gauge')
+    for name, count in sorted(busy_threads.items()):
+        out.append('eos_thread_requests_in_progress{thread="%s"} %i' % (_label(name), count))
+
+    if _dispatcher is not None:
+        out.append('# HELP eos_waitress_queue_depth Requests waiting for a waitress thread.')
+        out.append('# TYPE eos_waitress_queue_depth gauge')
+        out.append('eos_waitress_queue_depth %i' % len(_dispatcher.queue))
+        out.append('# HELP eos_waitress_active_threads Waitress threads that are busy.')
+        out.append('# TYPE eos_waitress_active_threads gauge')
+        out.append('eos_waitress_active_threads %i' % _dispatcher.active_count)
+
+    return '\n'.join(out) + '\n'
@@ -26,6 +26,12 @@ from bcrypt import hashpw, gensalt
 """
 Base = declarative_base()
 
+"""Bump this whenever the tables or indexes change, so /ready shows which schema
+this code expects.  It is not stored in the DB.  Version 2 added the indexes
+on the touch and resource keys.
+"""
+SCHEMA_VERSION = 2
+
 class Actor(Base):
     """ An actor is any entity which is permitted to make an action. In the
     context of this system, this could be a user or an agent. Actor is
@@ -65,7 +71,7 @@ class User(Actor):
     __tablename__ = 'user'
     id = Column(Integer, ForeignKey('actor.id'), primary_key=True)
     name = Column(String)
-    username = Column(String)
+    username = Column(String, index=True)
 
     __mapper_args__ = {"polymorphic_identity": "user"}
 
@@ -80,7 +86,7 @@ class Artifact(Base):
 
     id = Column(Integer, primary_key=True)
     uuid = Column("uuid", CHAR(length=40), nullable=False)
-    name = Column("name", CHAR(length=32), nullable=False)
+    name = Column("name", CHAR(length=32), nullable=False, index=True)
     type = Column("type", String(length=32), nullable=False)
 
     __mapper_args__ = {
@@ -117,10 +123,10 @@ class Touch(Base):
     id = Column(Integer, primary_key=True)
     """ Primary key. """
 
-    artifact_id = Column(Integer, ForeignKey('artifact.id'))
+    artifact_id = Column(Integer, ForeignKey('artifact.id'), index=True)
     """ Artifact associated with the touch. """
 
-    actor_id = Column(Integer, ForeignKey('actor.id'))
+    actor_id = Column(Integer, ForeignKey('actor.id'), index=True)
     """ The actor (eg. user) associated with the touch. """
 
     state_id = Column(Integer, ForeignKey('state.id'))
@@ -181,7 +187,7 @@ class Resource(Base):
     provided by subclassed resource tables such as "credit", "email" etc.
     """
 
-    touch_id = Column("touch_id", Integer, ForeignKey("touch.id"))
+    touch_id = Column("touch_id", Integer, ForeignKey("touch.id"), index=True)
     """Touch associated with the resource."""
 
     touch = relationship("Touch")
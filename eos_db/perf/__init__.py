@@ -0,0 +1,6 @@
+"""Tools for measuring the performance of EOS-DB.
+
+None of this is needed to run the server.  The modules here build test fleets
+of users and servers, time the server functions against them, and so on.
+Each can be run with "python -m eos_db.perf.<module> --help".
+"""
@@ -0,0 +1,179 @@
+"""Micro-benchmarks for the busiest functions in eos_db.server.
+
+For each fleet size a file-backed SQLite database is built with
+fleet.build_fleet(), then each function is timed a number of times and the
+best and median times recorded.  Results are saved as JSON, and can be compared
+against an earlier run to spot regressions:
+
+    python -m eos_db.perf.bench --out new.json --compare bench_baseline.json
+
+Sizes are given as USERSxSERVERSxTOUCHES, eg. 20x100x8.  Building the bigger
+fleets takes a while, mainly because every record is committed on its own
+and every password is bcrypt'ed.
+"""
+
+import os
+import sys
+import json
+import platform
+import argparse
+import tempfile
+from time import perf_counter
+from datetime import datetime
+from statistics import median
+
+import sqlalchemy
+from eos_db import server
+from eos_db.perf.fleet import build_fleet, PASSWORD
+
+DEFAULT_SIZES = ('5x20x8', '20x100x8', '50x400x8')
+
+DEFAULT_BASELINE = 'bench_baseline.json'
+
+# Boost levels for the benchmark fleets, with a capacity table so that
+# get_boost_levels() has to count the servers at each level.
+BOOST_LEVELS = dict(
+    baseline=dict(label='Standard', cores=1, ram=16, cost=0),
+    levels=[ dict(label='Level 1', cores=2, ram=40, cost=1),
+             dict(label='Level 2', cores=8, ram=140, cost=3),
+             dict(label='Level 3', cores=16, ram=500, cost=12) ],
+    capacity=[ [1000, 1000, 1000], [1000, 1000, 1000] ] )
+
+def parse_size(size):
+    """Turns '20x100x8' into (20, 100, 8)."""
+    users, servers, touches = ( int(n) for n in size.lower().split('x') )
+    return users, servers, touches
+
+def benchmarks(fleet):
+    """The functions to time, as (name, callable) pairs.  Where a function
+       works on one user or server the busiest one in the fleet is picked, so
+       bigger fleets mean bigger results.
+    """
+    owned = {}
+    for server_id, owners in fleet.owners.items():
+        for owner_id in owners:
+            owned[owner_id] = owned.get(owner_id, 0) + 1
+    user_id = max(fleet.user_ids, key=lambda u: owned.get(u, 0))
+    username = fleet.usernames[fleet.user_ids.index(user_id)]
+    server_id = fleet.server_ids[-1]
+
+    #Covers everything from a year ago to a year ahead.
+    year = 60 * 24 * 365
+
+    return [
+        ( 'list_artifacts_for_user', lambda: server.list_artifacts_for_user(user_id) ),
+        ( 'return_artifact_details', lambda: server.return_artifact_details(server_id) ),
+        ( 'list_servers_by_state',   lambda: server.list_servers_by_state() ),
+        ( 'get_boost_levels',        lambda: server.get_boost_levels() ),
+        ( 'get_deboost_jobs',        lambda: server.get_deboost_jobs(year, year) ),
+        ( 'check_credit',            lambda: server.check_credit(user_id) ),
+        ( 'check_password',          lambda: server.check_password(username, PASSWORD) ),
+    ]
+
+def time_call(func, repeat):
+    """Runs func repeat times, after one warm-up call, and returns a dict of the
+       best and median times in seconds.
+    """
+    func()
+    times = []
+    for n in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return dict(min=min(times), median=median(times), repeat=repeat)
+
+def run_size(size, workdir, repeat=5, seed=0, log=None):
+    """Builds a fleet of the given size in a new SQLite file under workdir and
+       times each benchmark against it.
+    """
+    users, servers, touches = parse_size(size)
+    dbfile = os.path.join(workdir, 'bench_%s.sqlite' % size)
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+
+    server.override_engine('sqlite:///' + dbfile, echo=False)
+    server.setup_states()
+    server.set_config(dict(BoostLevels=json.loads(json.dumps(BOOST_LEVELS))))
+
+    start = perf_counter()
+    fleet = build_fleet(users, servers, touches, seed=seed)
+    if log:
+        log("Built %r for %s in %.1f secs" % (fleet, size, perf_counter() - start))
+
+    res = dict(users=users, servers=servers, touches=fleet.touches, functions={})
+    for name, func in benchmarks(fleet):
+        res['functions'][name] = time_call(func, repeat)
+        if log:
+            log("  %-25s %10.6f" % (name, res['functions'][name]['median']))
+    return res
+
+def run(sizes=DEFAULT_SIZES, repeat=5, workdir=None, seed=0, log=None):
+    """Runs all the benchmarks and returns the results, ready to be saved as JSON.
+    """
+    res = dict( created = datetime.now().isoformat()[0:19],
+                python = platform.python_version(),
+                sqlalchemy = sqlalchemy.__version__,
+                repeat = repeat,
+                sizes = {} )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            res['sizes'][size] = run_size(size, workdir or tmpdir, repeat, seed, log)
+    return res
+
+def compare(new, old, threshold=1.25):
+    """Compares two sets of results, matching up sizes and functions by name.
+       Median times are compared.
+    :returns: A list of (size, function, old_secs, new_secs, ratio) for every
+              function that ran more than threshold times slower.
+    """
+    slower = []
+    for size, new_size in new['sizes'].items():
+        old_funcs = old['sizes'].get(size, {}).get('functions', {})
+        for name, t in new_size['functions'].items():
+            if name not in old_funcs or not old_funcs[name]['median']:
+                continue
+            old_t = old_funcs[name]['median']
+            ratio = t['median'] / old_t
+            if ratio > threshold:
+                slower.append((size, name, old_t, t['median'], ratio))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the eos_db.server functions.")
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        help="Comma-separated fleet sizes as USERSxSERVERSxTOUCHES [%(default)s]")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Times to run each function [%(default)s]")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed for the fleet generator [%(default)s]")
+    parser.add_argument('--workdir',
+                        help="Keep the SQLite files in this directory, rather than a temp dir")
+    parser.add_argument('--out', default=DEFAULT_BASELINE,
+                        help="Where to save the results [%(default)s]")
+    parser.add_argument('--compare', metavar='OLD_JSON',
+                        help="Compare against earlier results and exit with status 1 on a regression")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Slow-down ratio that counts as a regression [%(default)s]")
+    args = parser.parse_args(argv)
+
+    log = lambda msg: print(msg, file=sys.stderr)
+    res = run(args.sizes.split(','), args.repeat, args.workdir, args.seed, log)
+
+    with open(args.out, 'w') as fh:
+        json.dump(res, fh, indent=2, sort_keys=True)
+    log("Results saved to %s" % args.out)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            old = json.load(fh)
+        slower = compare(res, old, args.threshold)
+        for size, name, old_t, new_t, ratio in slower:
+            print("%s %s: %.6f -> %.6f (%.2fx slower)" % (size, name, old_t, new_t, ratio))
+        if slower:
+            return 1
+        log("No regressions against %s" % args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
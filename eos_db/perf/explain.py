@@ -0,0 +1,199 @@
+"""Query plan report for the hot queries in eos_db.server.
+
+Each registered query is one of the read-only lookups that the API makes all
+the time.  Rather than keep copies of the SQL here, which would soon drift
+from the real thing, the server function is called with representative
+parameters taken from the database and every SELECT it runs is captured and
+explained.  Any plan that scans the whole of the touch or resource tables is
+flagged, since those tables grow with every action anybody takes.
+
+The listing calls have to read everything anyway, so their plans are shown
+but they may scan.  If any other query scans, report() returns 1, so
+"eos-admin explain" can be used to check a schema change before it is deployed.
+
+The planner will happily scan a small table, so run this against a database of
+a realistic size, such as one made by "eos-admin seed".
+
+Nothing here changes the database.  Indexes in the models that the database
+lacks are listed at the top of the report, and "eos-admin addindexes" will
+make them.
+"""
+
+import re
+import sys
+from collections import OrderedDict
+from sqlalchemy import event, func
+
+from eos_db import server
+from eos_db.models import User, Appliance
+from eos_db.slowquery import statement_shape, explain
+
+# Matches plan lines for full scans of the touch or resource tables, as shown by
+# SQLite ("SCAN touch", "SCAN TABLE resource AS resource_1") or PostgreSQL
+# ("Seq Scan on touch").
+_SCAN = re.compile(r'(?:^|\s)(?:SCAN(?: TABLE)?|Seq Scan on) (touch|resource)(?:_\d+)?(?:\s|$)')
+
+class Sample():
+    """The parameters for the hot queries: the newest user and the newest
+       server in the database.
+    """
+    def __init__(self):
+        with server._session_scope() as session:
+            self.user_id = session.query(func.max(User.id)).scalar()
+            self.server_id = session.query(func.max(Appliance.id)).scalar()
+        if self.user_id is None or self.server_id is None:
+            raise LookupError("Need at least one user and one server to explain queries.")
+        self.username = server.check_user_details(self.user_id)['username']
+        self.server_name = server.get_server_name_from_id(self.server_id)
+
+# name -> (function of a Sample, may_scan)
+HOT_QUERIES = OrderedDict()
+
+def register(name, may_scan=False):
+    """Decorator to add a function that makes a hot query to HOT_QUERIES."""
+    def decorate(f):
+        HOT_QUERIES[name] = (f, may_scan)
+        return f
+    return decorate
+
+@register('state')
+def _state(s):
+    server.check_state(s.server_id)
+
+@register('specification')
+def _specification(s):
+    server.get_latest_specification(s.server_id)
+    server.get_previous_specification(s.server_id)
+
+@register('deboost')
+def _deboost(s):
+    server.get_time_until_deboost(s.server_id)
+
+@register('server_details')
+def _server_details(s):
+    server.return_artifact_details(s.server_id)
+
+@register('credit')
+def _credit(s):
+    server.check_credit(s.user_id)
+
+@register('ownership')
+def _ownership(s):
+    server.check_ownership(s.server_id, s.user_id)
+    server.list_owned_artifacts([s.server_id], s.user_id)
+
+@register('group')
+def _group(s):
+    server.get_user_group(s.username)
+
+@register('password')
+def _password(s):
+    server.check_password(s.username, 'not the password')
+
+@register('name_lookups')
+def _name_lookups(s):
+    #The public functions would mostly answer from the IdCache.
+    server._get_server_id_from_name(s.server_name)
+    server._get_user_id_from_name(s.username)
+
+@register('user_touches')
+def _user_touches(s):
+    list(server.iter_touches(actor_id=s.user_id))
+
+@register('server_touches')
+def _server_touches(s):
+    list(server.iter_touches(artifact_id=s.server_id))
+
+@register('list_servers', may_scan=True)
+def _list_servers(s):
+    #Just the first chunk is enough to see the queries.
+    next(server.iter_artifacts_for_user(None), None)
+
+@register('list_users', may_scan=True)
+def _list_users(s):
+    next(server.iter_user_details(), None)
+
+@register('list_states', may_scan=True)
+def _list_states(s):
+    server.list_servers_by_state()
+
+@register('list_boostlevels', may_scan=True)
+def _list_boostlevels(s):
+    server.list_servers_by_boost_level()
+
+@register('deboost_jobs', may_scan=True)
+def _deboost_jobs(s):
+    server.get_deboost_jobs(past=60*24, future=60*24)
+
+def capture_selects(f, *args):
+    """Calls f(*args) and returns the distinct SELECT statements it ran, as a
+       list of (statement, parameters).
+    """
+    seen = OrderedDict()
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() == 'SELECT':
+            seen.setdefault(statement_shape(statement), (statement, parameters))
+
+    event.listen(server.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        f(*args)
+    finally:
+        event.remove(server.engine, 'before_cursor_execute', before_cursor_execute)
+    return list(seen.values())
+
+def scans(plan):
+    """Returns the tables that the plan scans in full, out of touch and resource."""
+    return sorted(set( m.group(1) for line in plan for m in _SCAN.finditer(line) ))
+
+def explain_all(names=None):
+    """Explains the registered queries.
+    :param names: Names from HOT_QUERIES to explain, or None for all.
+    :returns: A list of dicts with name, may_scan, statement, plan and scans.
+    """
+    sample = Sample()
+    results = []
+    for name, (f, may_scan) in HOT_QUERIES.items():
+        if names and name not in names:
+            continue
+        for statement, parameters in capture_selects(f, sample):
+            with server.engine.connect() as conn:
+                plan = explain(conn, statement, parameters) or []
+            results.append(dict( name = name,
+                                 may_scan = may_scan,
+                                 statement = statement,
+                                 plan = plan,
+                                 scans = scans(plan) ))
+    return results
+
+def report(names=None, out=sys.stdout):
+    """Prints the plan of every registered query, with scans flagged.
+    :returns: 1 if any query that should not scan does, else 0.
+    """
+    missing = server.missing_indexes()
+    if missing:
+        print("Indexes missing from the database, which \"eos-admin addindexes\" will add:",
+              file=out)
+        for index in missing:
+            print("    %s on %s" % (index.name, index.table.name), file=out)
+        print(file=out)
+
+    bad = 0
+    for r in explain_all(names):
+        if r['scans'] and not r['may_scan']:
+            flag = "SCAN! "
+            bad += 1
+        elif r['scans']:
+            flag = "scan (allowed) "
+        else:
+            flag = ""
+        print("== %s%s" % (flag, r['name']), file=out)
+        print(statement_shape(r['statement']), file=out)
+        for line in r['plan']:
+            print("    " + line, file=out)
+        print(file=out)
+
+    if bad:
+        print("%i queries scan the touch or resource tables." % bad, file=out)
+        return 1
+    print("No unexpected scans.", file=out)
+    return 0
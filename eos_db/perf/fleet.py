@@ -0,0 +1,369 @@
+"""Builds a fleet of users and servers with a realistic history, for
+benchmarks and load tests.
+
+build_fleet() goes through the public functions in eos_db.server, the same
+as the web API does, so every record goes in with its own session and commit.
+That makes it slow, but the database it makes is exactly what the real code
+would make.  seed_fleet() writes the same sort of records with bulk inserts,
+for when you need millions of touches.  It is behind "eos-admin seed".
+
+The fleet goes into whatever database server.engine points at.  Boosts use
+the levels in server.BL, so call server.set_config() first if you want some
+boost levels.
+"""
+
+import random
+from eos_db import server
+
+# Password given to every generated user, so benchmarks can log in.
+PASSWORD = 'fleetpass'
+
+# States a server is moved between in normal use, and how likely each is.
+ROUTINE_STATES = ( ('Started', 5), ('Stopped', 3), ('Restarting', 1),
+                   ('Starting', 1), ('Stopping', 1) )
+
+class Fleet():
+    """What build_fleet() made.  Ids are listed in the order they were made.
+    """
+    def __init__(self):
+        self.user_ids = []
+        self.usernames = []
+        self.server_ids = []
+        self.server_names = []
+        # server_id -> list of user_ids who own it
+        self.owners = {}
+        self.touches = 0
+
+    def __repr__(self):
+        return "<Fleet: %i users, %i servers, %i touches>" % (
+                    len(self.user_ids), len(self.server_ids), self.touches)
+
+def build_fleet(users, servers, touches_per_server, seed=0, password=PASSWORD):
+    """Makes a fleet through the public server API.
+
+    Each user gets a password, some change it later, and all get some credit.
+    Each server is owned by one user, or sometimes shared with a second, and
+    goes through routine state changes plus boosts and deboosts paid for with
+    the owner's credit.  A few server names are re-used, so the newer server
+    masks the old one.
+
+    :param users: Number of users to make.
+    :param servers: Number of servers to make.
+    :param touches_per_server: Roughly how many touches to make on each server
+                               after it is set up.
+    :param seed: Seed for the random number generator, so a fleet can be rebuilt
+                 exactly.
+    :returns: A Fleet object.
+    """
+    rng = random.Random(seed)
+    fleet = Fleet()
+    levels = list(server.BL['levels'])
+    state_names = [ s for s, w in ROUTINE_STATES for n in range(w) ]
+
+    for n in range(users):
+        username = "user%05i" % n
+        group = 'administrators' if n % 50 == 0 else 'users'
+        user_id = server.create_user(group, username + "@example.com", "User %i" % n, username)
+        server.touch_to_add_password(user_id, password)
+        server.touch_to_add_credit(user_id, rng.randint(20, 200))
+        fleet.touches += 3
+        if rng.random() < 0.2:
+            #Change the password, but to the same thing.
+            server.touch_to_add_password(user_id, password)
+            fleet.touches += 1
+        fleet.user_ids.append(user_id)
+        fleet.usernames.append(username)
+
+    for n in range(servers):
+        #Every 20th server re-uses an earlier name, masking the old one.
+        if n % 20 == 19:
+            name = fleet.server_names[rng.randrange(len(fleet.server_names))]
+        else:
+            name = "vm%06i" % n
+        server_id = server.create_appliance(name, "uuid-%06i-%08x" % (n, rng.getrandbits(32)))
+
+        owners = [ rng.choice(fleet.user_ids) ]
+        if rng.random() < 0.1:
+            owners.append(rng.choice(fleet.user_ids))
+        for owner_id in owners:
+            server.touch_to_add_ownership(server_id, owner_id)
+        server.touch_to_add_specification(server_id, *server.get_baseline_specification(server_id))
+        server.touch_to_state(None, server_id, 'Started')
+        fleet.touches += len(owners) + 2
+
+        boosted = False
+        t = 0
+        while t < touches_per_server:
+            owner_id = rng.choice(owners)
+            roll = rng.random()
+            if levels and not boosted and roll < 0.2:
+                #Boost, if the owner can afford it.
+                lev = rng.choice(levels)
+                hours = rng.randint(1, 48)
+                if server.check_and_remove_credits(owner_id, lev['ram'], lev['cores'], hours):
+                    #Some boosts are already overdue for a deboost.
+                    server.touch_to_add_deboost(server_id, hours * rng.choice((1, 1, 1, -0.1)))
+                    server.touch_to_add_specification(server_id, lev['cores'], lev['ram'])
+                    server.touch_to_state(owner_id, server_id, 'Preparing')
+                    boosted = True
+                    t += 4
+                    continue
+            elif boosted and roll < 0.3:
+                #Deboost, and refund any unused time.
+                credit = server.get_time_until_deboost(server_id)[3]
+                server.touch_to_add_credit(owner_id, credit)
+                server.touch_to_add_specification(server_id, *server.get_baseline_specification(server_id))
+                server.touch_to_state(owner_id, server_id, 'Pre_Deboosting')
+                boosted = False
+                t += 3
+                continue
+            elif roll < 0.35:
+                #Top up credit.
+                server.touch_to_add_credit(owner_id, rng.randint(10, 100))
+                t += 1
+                continue
+
+            server.touch_to_state(rng.choice((None, owner_id)), server_id, rng.choice(state_names))
+            t += 1
+
+        fleet.touches += t
+        fleet.server_ids.append(server_id)
+        fleet.server_names.append(name)
+        fleet.owners[server_id] = owners
+
+    return fleet
+
+def load_fleet(max_users=None):
+    """Makes a Fleet describing the users and live servers already in the
+       database, for running load tests against a database built earlier.
+       Nothing is known about the passwords, so the users must have been made
+       by build_fleet() or similar.
+
+    :param max_users: Only load this many users, and their servers.
+    """
+    fleet = Fleet()
+    for user in server.iter_user_details():
+        if max_users is not None and len(fleet.user_ids) >= max_users:
+            break
+        fleet.user_ids.append(user['id'])
+        fleet.usernames.append(user['username'])
+
+        for details in server.iter_artifacts_for_user(user['id']):
+            s_id = details['artifact_id']
+            if s_id not in fleet.owners:
+                fleet.server_ids.append(s_id)
+                fleet.server_names.append(details['artifact_name'])
+                fleet.owners[s_id] = []
+            fleet.owners[s_id].append(user['id'])
+    return fleet
+
+def seed_fleet(users, servers, touches_per_server, years=3, seed=0,
+               password=PASSWORD, batch_size=20000, log=None):
+    """Makes a big fleet quickly, with years of history, by writing rows straight
+    into the tables with bulk inserts rather than going through the server API.
+
+    The rows are the same as the server API would make, but with touch times
+    spread over the given number of years rather than all being now.  Users get
+    a group, a password that is sometimes changed and a credit ledger with
+    top-ups.  Servers get owners (sometimes two), and some re-use the name of
+    an earlier server to mask it.  Their history has routine state changes
+    plus boost and deboost cycles at the levels in server.BL, paid for and
+    refunded from the owner's credit.  A server boosted near the end of the
+    history will still be boosted now.
+
+    The password is only bcrypt'ed once and the hash given to every user,
+    otherwise hashing would take far longer than the rest put together.
+
+    :param users: Number of users to make.
+    :param servers: Number of servers to make.
+    :param touches_per_server: Roughly how many touches to make on each server
+                               after it is set up.
+    :param years: How far back the history goes.
+    :param batch_size: Roughly how many touches to write per transaction.
+    :returns: A Fleet object.
+    """
+    from sqlalchemy.sql import func, select
+    from datetime import datetime, timedelta
+    from eos_db.models import ( Actor, User, Artifact, Appliance, Touch, State,
+                                Resource, GroupMembership, Password, Credit,
+                                Specification, Deboost, Ownership )
+
+    rng = random.Random(seed)
+    fleet = Fleet()
+    engine = server.engine
+    #The tables and the states, which a brand new database won't have yet.
+    server.setup_states()
+
+    levels = list(server.BL['levels'])
+    baseline = server.BL['baseline']
+    state_names = [ s for s, w in ROUTINE_STATES for n in range(w) ]
+    password_hash = Password(password=password).password
+
+    #Work out the ids to use, carrying on from any rows already there.
+    tables = ( Actor, User, Artifact, Appliance, Touch, Resource, GroupMembership,
+               Password, Credit, Specification, Deboost, Ownership )
+    with engine.connect() as conn:
+        next_id = { t: (conn.execute(func.max(t.id)).scalar() or 0) + 1
+                    for t in (Actor, Artifact, Touch, Resource) }
+        state_ids = { name: s_id for name, s_id in conn.execute(select([State.name, State.id])) }
+
+    rows = { t: [] for t in tables }
+
+    def flush():
+        with engine.begin() as conn:
+            for t in tables:
+                if rows[t]:
+                    conn.execute(t.__table__.insert(), rows[t])
+                    rows[t] = []
+
+    def touch(dt, actor_id=None, artifact_id=None, state=None):
+        t_id = next_id[Touch]
+        next_id[Touch] += 1
+        rows[Touch].append(dict( id=t_id, actor_id=actor_id, artifact_id=artifact_id,
+                                 state_id=state_ids[state] if state else None,
+                                 touch_dt=dt ))
+        fleet.touches += 1
+        return t_id
+
+    def resource(t_id, res_class, **kwargs):
+        r_id = next_id[Resource]
+        next_id[Resource] += 1
+        rows[Resource].append(dict(id=r_id, touch_id=t_id,
+                                   type=res_class.__mapper_args__['polymorphic_identity']))
+        rows[res_class].append(dict(id=r_id, **kwargs))
+
+    now = datetime.now()
+    start = now - timedelta(days=365 * years)
+    span = (now - start).total_seconds()
+    at = lambda frac: start + timedelta(seconds=span * frac)
+
+    #Users, with credit balances kept here so boosts can be checked.
+    credit = {}
+    for n in range(users):
+        user_id = next_id[Actor]
+        next_id[Actor] += 1
+        username = "seed%07i" % user_id
+        rows[Actor].append(dict( id=user_id, type='user', uuid="%032x" % rng.getrandbits(128),
+                                 handle=username + "@example.com" ))
+        rows[User].append(dict(id=user_id, name="Seed User %i" % user_id, username=username))
+
+        #Users join over the first half of the history.
+        joined = at(rng.random() * 0.5)
+        resource(touch(joined, user_id), GroupMembership,
+                 group='administrators' if n % 50 == 0 else 'users')
+        resource(touch(joined, user_id), Password, password=password_hash)
+        credit[user_id] = rng.randint(50, 500)
+        resource(touch(joined, user_id), Credit, credit=credit[user_id])
+        if rng.random() < 0.2:
+            resource(touch(at(0.5 + rng.random() * 0.5), user_id), Password, password=password_hash)
+
+        fleet.user_ids.append(user_id)
+        fleet.usernames.append(username)
+
+    for n in range(servers):
+        server_id = next_id[Artifact]
+        next_id[Artifact] += 1
+        #Every 20th server re-uses an earlier name, masking the old one.
+        if n % 20 == 19:
+            name = fleet.server_names[rng.randrange(len(fleet.server_names))]
+        else:
+            name = "svm%07i" % server_id
+        rows[Artifact].append(dict( id=server_id, type='appliance', name=name,
+                                    uuid="%08x-seed-%016x" % (server_id, rng.getrandbits(64)) ))
+        rows[Appliance].append(dict(id=server_id))
+
+        owners = [ rng.choice(fleet.user_ids) ]
+        if rng.random() < 0.1:
+            owners.append(rng.choice(fleet.user_ids))
+
+        #Servers are made any time up to a few days ago, and then touched at
+        #random intervals up to now.
+        dt = at(rng.random() * 0.99)
+        gap = (now - dt).total_seconds() / (touches_per_server + 1)
+        for owner_id in owners:
+            resource(touch(dt, None, server_id), Ownership, user_id=owner_id)
+        resource(touch(dt, None, server_id), Specification, cores=baseline['cores'], ram=baseline['ram'])
+        touch(dt, None, server_id, 'Started')
+
+        boost = None  # (level, end time) while boosted
+        t = 0
+        while t < touches_per_server:
+            dt += timedelta(seconds=rng.expovariate(1.0 / gap))
+            if dt > now:
+                break
+            owner_id = rng.choice(owners)
+
+            if boost and dt >= boost[1]:
+                #The deboost daemon gets there first.
+                resource(touch(boost[1], None, server_id), Specification,
+                         cores=baseline['cores'], ram=baseline['ram'])
+                touch(boost[1], None, server_id, 'Pre_Deboosting')
+                boost = None
+                t += 2
+                continue
+
+            roll = rng.random()
+            if levels and not boost and roll < 0.15:
+                lev = rng.choice(levels)
+                hours = rng.randint(1, 72)
+                cost = lev['cost'] * hours
+                if credit[owner_id] >= cost:
+                    credit[owner_id] -= cost
+                    resource(touch(dt, owner_id), Credit, credit=-cost)
+                    boost = (lev, dt + timedelta(hours=hours))
+                    resource(touch(dt, None, server_id), Deboost, deboost_dt=boost[1])
+                    resource(touch(dt, None, server_id), Specification,
+                             cores=lev['cores'], ram=lev['ram'])
+                    touch(dt, owner_id, server_id, 'Preparing')
+                    touch(dt + timedelta(minutes=5), None, server_id, 'Started')
+                    t += 4
+                    continue
+            elif boost and roll < 0.25:
+                #Deboost early, with a refund for whole hours unused.
+                refund = boost[0]['cost'] * int((boost[1] - dt).total_seconds() // 3600)
+                credit[owner_id] += refund
+                resource(touch(dt, owner_id), Credit, credit=refund)
+                resource(touch(dt, None, server_id), Specification,
+                         cores=baseline['cores'], ram=baseline['ram'])
+                touch(dt, owner_id, server_id, 'Pre_Deboosting')
+                boost = None
+                t += 2
+                continue
+            elif roll < 0.3:
+                #Top-up by an administrator.
+                top_up = rng.randint(10, 200)
+                credit[owner_id] += top_up
+                resource(touch(dt, owner_id), Credit, credit=top_up)
+                t += 1
+                continue
+
+            touch(dt, rng.choice((None, owner_id)), server_id, rng.choice(state_names))
+            t += 1
+
+        if boost and boost[1] < now:
+            resource(touch(boost[1], None, server_id), Specification,
+                     cores=baseline['cores'], ram=baseline['ram'])
+            touch(boost[1], None, server_id, 'Pre_Deboosting')
+
+        fleet.server_ids.append(server_id)
+        fleet.server_names.append(name)
+        fleet.owners[server_id] = owners
+
+        if len(rows[Touch]) >= batch_size:
+            flush()
+            if log:
+                log("%i servers, %i touches" % (n + 1, fleet.touches))
+    flush()
+
+    #PostgreSQL won't notice the ids we used, so move the sequences on.
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            for t in (Actor, Artifact, Touch, Resource):
+                conn.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), %i)" %
+                             (t.__tablename__, next_id[t] - 1))
+
+    #We went round create_user() and create_appliance(), and some of the new
+    #servers mask old ones, so the cached ids may be stale.
+    server.current().clear_ids()
+
+    return fleet
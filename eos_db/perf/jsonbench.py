@@ -0,0 +1,161 @@
+"""Benchmark of the comment-stripping JSON loader in eos_db.json_loader.
+
+Settings files are generated with a number of boost levels, a capacity table
+of the given number of rows and a list of extra machine states, with comments
+sprinkled through as a person would write them.  Each is parsed with the
+original character by character scanner, kept here as charwise_strip(), and
+with the regex version now in json_loader, and the results are checked to be
+the same.  Loading through parse_json_file() a second time, when the cached
+result can be used and only has to be copied, is timed too.
+
+    python -m eos_db.perf.jsonbench --rows 10,1000,10000
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+from time import perf_counter
+from warnings import warn
+
+from eos_db import json_loader
+
+DEFAULT_ROWS = (10, 1000, 10000)
+
+def charwise_strip(text):
+    """The original comment stripper from json_loader, for comparison."""
+    sq_seen = False
+
+    #Buffer for processed content
+    content = []
+
+    NORMAL = 0
+    IN_COMMENT = 1
+    IN_DQ_STR = 2
+    IN_SQ_STR = 3
+
+    mode = 0
+
+    for l in text.splitlines(True):
+        skip = 0
+        mark = 0
+
+        for i, c in enumerate(l):
+
+            if skip:
+                skip -= 1
+                continue
+
+            if mode == NORMAL:
+                if(c == "/" and l[i+1] == "/"):
+                    content.append(l[mark:i] + "\n")
+                    break
+                elif(c == "/" and l[i+1] == "*"):
+                    mode = IN_COMMENT
+                    skip = 1
+                    content.append(l[mark:i])
+                elif(c == "'"):
+                    mode = IN_SQ_STR
+                    if not sq_seen:
+                        warn("Encountered illegal single quoted string. JSON will not parse.")
+                        sq_seen = 0
+                elif(c == '"'):
+                    mode = IN_DQ_STR
+            elif mode == IN_COMMENT:
+                if(c == "*" and l[i+1] == "/"):
+                    mark = i+2
+                    skip = 1
+                    mode = NORMAL
+            elif mode == IN_SQ_STR:
+                if(c == '\\'):
+                    skip = 1
+                elif(c == "'"):
+                    mode = NORMAL
+            elif mode == IN_DQ_STR:
+                if(c == '\\'):
+                    skip = 1
+                elif(c == '"'):
+                    mode = NORMAL
+        else:
+            if mode != IN_COMMENT:
+                content.append(l[mark:])
+
+    return ''.join(content)
+
+def make_settings(rows, levels=4, states=50):
+    """Makes the text of a settings file with comments in it."""
+    lines = [ '/* Generated settings, with %i capacity rows. */' % rows,
+              '{',
+              '  "BoostLevels" : {',
+              '    // The size of a server that is not boosted.',
+              '    "baseline" : { "label" : "Standard // not a comment", "ram" : 16, "cores" : 1 },',
+              '    "levels" : [' ]
+    lines.append(',\n'.join(
+        '      // Level %i\n      { "label" : "Level %i /* still not */", "ram" : %i, "cores" : %i, "cost" : %i }'
+        % (n, n, 40 * n, 2 * n, n) for n in range(1, levels + 1)))
+    lines += [ '    ],', '    /* Servers we have room for at each level,', '       one row per host. */',
+               '    "capacity" : [' ]
+    lines.append(',\n'.join( '      %s[ %s ]' % ('/* rack %i */ ' % r if r % 10 == 0 else '',
+                                               ', '.join(str((r + n) % 97) for n in range(levels)))
+                             for r in range(rows) ))
+    lines += [ '    ]', '  },', '  "MachineStates" : {', '    "state_list" : [' ]
+    lines.append(',\n'.join( '      "Extra_%i"' % n for n in range(states) ))
+    lines += [ '    ]', '  }', '}', '' ]
+    return '\n'.join(lines)
+
+def best_of(f, repeat):
+    """Best time to call f, in secs."""
+    times = []
+    for n in range(repeat):
+        start = perf_counter()
+        f()
+        times.append(perf_counter() - start)
+    return min(times)
+
+def run(rows_list, repeat=5, log=None):
+    """Times the loaders for each number of rows, returning a dict of
+       rows -> timings in secs.
+    """
+    res = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for rows in rows_list:
+            text = make_settings(rows)
+            expected = json.loads(charwise_strip(text))
+            if json.loads(json_loader.strip_comments(text)) != expected:
+                raise AssertionError("Loaders disagree for %i rows" % rows)
+
+            filename = os.path.join(tmpdir, '%i.settings.json' % rows)
+            with open(filename, 'w') as fh:
+                fh.write(text)
+            json_loader.parse_json_file(filename)
+
+            r = res[rows] = dict(
+                bytes = len(text),
+                charwise = best_of(lambda: json.loads(charwise_strip(text)), repeat),
+                regex = best_of(lambda: json.loads(json_loader.strip_comments(text)), repeat),
+                cached = best_of(lambda: json_loader.parse_json_file(filename), repeat) )
+            r['speedup'] = r['charwise'] / r['regex']
+            if log:
+                log("%6i rows %9i bytes: charwise %.4f, regex %.4f (%.1fx), cached %.6f secs" % (
+                    rows, r['bytes'], r['charwise'], r['regex'], r['speedup'], r['cached']))
+    return res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the JSON settings loader.")
+    parser.add_argument('--rows', default=','.join(str(r) for r in DEFAULT_ROWS),
+                        help="Comma-separated capacity table sizes [%(default)s]")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Times to run each loader [%(default)s]")
+    parser.add_argument('--json', help="Also save the results to this file")
+    args = parser.parse_args(argv)
+
+    res = run([ int(r) for r in args.rows.split(',') ], args.repeat,
+              log=lambda msg: print(msg))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(res, fh, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
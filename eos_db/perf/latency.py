@@ -0,0 +1,235 @@
+"""Simulated network latency between EOS-DB and its database.
+
+A local SQLite file answers each query in microseconds, which hides the cost of
+making many small queries.  Against PostgreSQL on another host, every statement
+is a round trip, so a call that makes 40 statements pays 40 times the network
+RTT on top of the time the queries take.
+
+A Latency is attached to an engine and sleeps for the RTT before each
+statement, and before each BEGIN, COMMIT and ROLLBACK as psycopg2 sends those
+to the server too.  It also counts the round trips.  To point eos_db.server at
+a database with 2ms of latency:
+
+    lat = latency.override_engine('sqlite:////tmp/test.sqlite', rtt_ms=2)
+    ...
+    print(lat.round_trips)
+
+Making new connections is not charged for, as the server would normally get
+them from a pool.
+
+Run as a script, this builds a fleet and times each of the routes used in
+eos_db.perf.loadtest at several RTTs, showing how much each one slows down for
+every extra millisecond of latency:
+
+    python -m eos_db.perf.latency --rtts 0,1,5 --size 5x20x8
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+from time import sleep, perf_counter
+from statistics import median
+
+from sqlalchemy import event
+from webtest import TestApp
+
+from eos_db import server
+from eos_db.perf import bench, loadtest
+from eos_db.perf.fleet import build_fleet, PASSWORD
+
+DEFAULT_RTTS = (0, 1, 5)
+
+class Latency():
+    """Adds a delay of rtt_ms to each round trip made on an engine, and counts
+       them.  The counts can be read and reset() at any time.
+    """
+    def __init__(self, rtt_ms=1.0):
+        self.rtt_ms = rtt_ms
+        self.engine = None
+        self.reset()
+
+    def reset(self):
+        self.statements = 0
+        self.transactions = 0
+        self.delay = 0.0
+
+    @property
+    def round_trips(self):
+        #A BEGIN and a COMMIT or ROLLBACK for each transaction.
+        return self.statements + self.transactions * 2
+
+    def _wait(self):
+        if self.rtt_ms:
+            secs = self.rtt_ms / 1000.0
+            sleep(secs)
+            self.delay += secs
+
+    def _statement(self, *args):
+        self.statements += 1
+        self._wait()
+
+    def _begin(self, conn):
+        self.transactions += 1
+        self._wait()
+
+    def _end(self, conn):
+        self._wait()
+
+    def attach(self, engine):
+        """Starts adding latency to the engine.  A Latency can only be attached
+           to one engine at a time.
+        """
+        self.detach()
+        event.listen(engine, 'before_cursor_execute', self._statement)
+        event.listen(engine, 'begin', self._begin)
+        event.listen(engine, 'commit', self._end)
+        event.listen(engine, 'rollback', self._end)
+        self.engine = engine
+        return self
+
+    def detach(self):
+        if self.engine is not None:
+            event.remove(self.engine, 'before_cursor_execute', self._statement)
+            event.remove(self.engine, 'begin', self._begin)
+            event.remove(self.engine, 'commit', self._end)
+            event.remove(self.engine, 'rollback', self._end)
+            self.engine = None
+
+def override_engine(engine_string, rtt_ms=1.0, echo=False):
+    """Calls server.override_engine() and adds latency to the new engine.
+    :returns: The Latency, for reading the counts.
+    """
+    server.override_engine(engine_string, echo=echo)
+    return Latency(rtt_ms).attach(server.engine)
+
+def endpoints(fleet):
+    """The routes to time, as (label, method, path, client kind), taken from the
+       calls that the load test makes.  Each route is timed once, as the first
+       kind of client that uses it.
+    """
+    user_idx = 0
+    user_id = fleet.user_ids[user_idx]
+    live = dict(zip(fleet.server_names, fleet.server_ids))
+    name = sorted( n for n, s_id in live.items() if user_id in fleet.owners[s_id] )[0]
+
+    res = []
+    seen = set()
+    for kind in ('portal', 'agent'):
+        for weight, method, label, path in loadtest.CALLS[kind]:
+            if label not in seen:
+                seen.add(label)
+                res.append((label, method,
+                            path.format(name=name, id=fleet.server_ids[-1]), kind))
+    return res
+
+def _clients(fleet, workdir):
+    """Makes a TestApp for each client kind, logged in as the load test would."""
+    app = loadtest.make_app(workdir)
+    portal = TestApp(app)
+    portal.authorization = ('Basic', (fleet.usernames[0], PASSWORD))
+    portal.get('/user')
+    #From now on rely on the auth_tkt cookie, as the portal does.
+    portal.authorization = None
+
+    agent = TestApp(app)
+    agent.authorization = ('Basic', ('agent', loadtest.AGENT_SECRET))
+    return dict(portal=portal, agent=agent)
+
+def time_endpoint(client, method, path, lat, repeat):
+    """Calls the route repeat times, after one warm-up call.
+    :returns: dict of the median time in secs and round trips per call.
+    """
+    client.request(path, method=method, status=200)
+    lat.reset()
+    times = []
+    for n in range(repeat):
+        start = perf_counter()
+        client.request(path, method=method, status=200)
+        times.append(perf_counter() - start)
+    return dict(median=median(times), round_trips=lat.round_trips / repeat)
+
+def run(rtts=DEFAULT_RTTS, size='5x20x8', repeat=5, seed=0, workdir=None, log=None):
+    """Builds a fleet in a new SQLite file and times each endpoint at each RTT.
+    :returns: dict of label -> dict with the round trips per call, the median
+              secs at each RTT, and the secs added per ms of RTT.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfile = os.path.join(workdir or tmpdir, 'latency.sqlite')
+        if os.path.exists(dbfile):
+            os.remove(dbfile)
+        server.override_engine('sqlite:///' + dbfile, echo=False)
+        server.setup_states()
+        server.set_config(dict(BoostLevels=json.loads(json.dumps(bench.BOOST_LEVELS))))
+        fleet = build_fleet(*bench.parse_size(size), seed=seed)
+        if log:
+            log("Built %r" % fleet)
+            log(format_header(rtts))
+
+        clients = _clients(fleet, workdir or tmpdir)
+        lat = Latency().attach(server.engine)
+        res = {}
+        try:
+            for label, method, path, kind in endpoints(fleet):
+                r = res[label] = dict(round_trips=None, secs={})
+                for rtt in rtts:
+                    lat.rtt_ms = rtt
+                    t = time_endpoint(clients[kind], method, path, lat, repeat)
+                    r['secs'][str(rtt)] = t['median']
+                    r['round_trips'] = t['round_trips']
+                r['secs_per_rtt_ms'] = slope(r['secs'])
+                if log:
+                    log(format_endpoint(label, r, rtts))
+        finally:
+            lat.detach()
+        return res
+
+def slope(secs):
+    """Least squares fit of secs against RTT, from a dict of {str(rtt_ms): secs}.
+       Should come out close to the round trips times 1ms.
+    """
+    points = [ (float(k), v) for k, v in secs.items() ]
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, y in points) / len(points)
+    my = sum(y for x, y in points) / len(points)
+    var = sum((x - mx) ** 2 for x, y in points)
+    if not var:
+        return None
+    return sum((x - mx) * (y - my) for x, y in points) / var
+
+def format_header(rtts):
+    return "%-38s %7s %s %10s" % ('route', 'trips', ' '.join( '%9s' % ('%sms' % r) for r in rtts ),
+                                  'ms per ms')
+
+def format_endpoint(label, r, rtts):
+    per_ms = '%10.1f' % (r['secs_per_rtt_ms'] * 1000) if r['secs_per_rtt_ms'] is not None else '%10s' % '-'
+    return "%-38s %7.1f %s %s" % (label, r['round_trips'],
+                                  ' '.join( '%9.1f' % (r['secs'][str(rtt)] * 1000) for rtt in rtts ),
+                                  per_ms)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the EOS-DB routes with simulated DB latency.")
+    parser.add_argument('--rtts', default=','.join(str(r) for r in DEFAULT_RTTS),
+                        help="Comma-separated round trip times to try, in ms [%(default)s]")
+    parser.add_argument('--size', default='5x20x8',
+                        help="Fleet to build, as USERSxSERVERSxTOUCHES [%(default)s]")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Times to call each route at each RTT [%(default)s]")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir',
+                        help="Keep the SQLite file in this directory, rather than a temp dir")
+    parser.add_argument('--out', help="Save the results here as JSON")
+    args = parser.parse_args(argv)
+
+    rtts = [ float(r) for r in args.rtts.split(',') ]
+    log = lambda msg: print(msg, file=sys.stderr)
+    res = run(rtts, args.size, args.repeat, args.seed, args.workdir, log)
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump(res, fh, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""HTTP load test for the whole EOS-DB web app.
+
+The app is run under waitress on localhost, on a seeded database, and is
+driven by a number of concurrent clients of three kinds:
+
+  portal - a user of the web portal, who logs in once and then uses the
+           auth_tkt cookie.  Gets /servers, /user, /boostlevels and their own
+           servers.
+  script - a user running scripts, who sends a password with every request.
+  agent  - an agent, which sets server states and polls /deboost_jobs.
+
+At the end, the throughput plus the 50th, 95th and 99th percentile latency is
+reported for each route:
+
+    python -m eos_db.perf.loadtest --size 20x200x8 --mix portal=8,script=2,agent=2
+
+Unlike eos_db.perf.bench this includes the cost of authentication, the cookie
+and CORS callbacks, route matching and rendering the JSON.
+"""
+
+import os
+import sys
+import json
+import math
+import logging
+import random
+import argparse
+import tempfile
+import threading
+from time import perf_counter
+
+import requests
+from webtest.http import StopableWSGIServer
+
+import eos_db
+from eos_db import server, metrics
+from eos_db.perf import bench
+from eos_db.perf.fleet import build_fleet, load_fleet, PASSWORD
+
+DEFAULT_MIX = 'portal=6,script=2,agent=1'
+
+AGENT_SECRET = 'loadtestsecret'
+
+# What each kind of client does, as (weight, method, route label, path).
+# Paths are filled in with the name of one of the user's servers, or the id of
+# any server for agents.
+CALLS = {
+    'portal': ( (4, 'GET',  'GET /servers',                 '/servers'),
+                (3, 'GET',  'GET /user',                    '/user'),
+                (2, 'GET',  'GET /boostlevels',             '/boostlevels'),
+                (2, 'GET',  'GET /servers/{name}',          '/servers/{name}') ),
+    'script': ( (2, 'GET',  'GET /servers',                 '/servers'),
+                (1, 'GET',  'GET /user',                    '/user') ),
+    'agent':  ( (3, 'POST', 'POST /servers/by_id/{id}/Started', '/servers/by_id/{id}/Started'),
+                (1, 'GET',  'GET /deboost_jobs',            '/deboost_jobs') ),
+}
+
+def parse_mix(mix):
+    """Turns 'portal=6,agent=1' into {'portal': 6, 'agent': 1}."""
+    res = {}
+    for part in mix.split(','):
+        kind, n = part.split('=')
+        if kind not in CALLS:
+            raise ValueError("Unknown client type %r" % kind)
+        res[kind] = int(n)
+    return res
+
+def percentile(sorted_times, pc):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_times:
+        return None
+    rank = max(1, math.ceil(pc / 100.0 * len(sorted_times)))
+    return sorted_times[rank - 1]
+
+class Client(threading.Thread):
+    """One client, making requests one after another until the deadline.
+       Results are saved as (route label, status, secs) tuples.
+    """
+    def __init__(self, kind, base_url, username, servers, all_server_ids, deadline, seed):
+        super().__init__(daemon=True)
+        self.kind = kind
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.servers = servers
+        self.all_server_ids = all_server_ids
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.results = []
+        self.errors = 0
+
+        self.calls = []
+        for weight, method, label, path in CALLS[kind]:
+            if '{name}' in path and not servers:
+                continue
+            self.calls.extend([(method, label, path)] * weight)
+
+    def _session(self):
+        """Makes a requests.Session that will authenticate as this client."""
+        s = requests.Session()
+        if self.kind == 'agent':
+            s.auth = ('agent', AGENT_SECRET)
+        elif self.kind == 'script':
+            s.auth = (self.username, PASSWORD)
+        else:
+            #Log in once, then rely on the cookie.
+            r = s.get(self.base_url + '/user', auth=(self.username, PASSWORD))
+            r.raise_for_status()
+        return s
+
+    def run(self):
+        s = self._session()
+        while perf_counter() < self.deadline:
+            method, label, path = self.rng.choice(self.calls)
+            if '{name}' in path:
+                path = path.format(name=self.rng.choice(self.servers))
+            elif '{id}' in path:
+                path = path.format(id=self.rng.choice(self.all_server_ids))
+
+            start = perf_counter()
+            try:
+                r = s.request(method, self.base_url + path)
+                r.content
+                status = r.status_code
+            except requests.RequestException:
+                status = 0
+            self.results.append((label, status, perf_counter() - start))
+            if status != 200:
+                self.errors += 1
+
+def make_app(workdir):
+    """Makes the WSGI app with eos_db.main(), the same as pserve would, but
+       with no settings file so that the current server.BL is kept and with
+       whatever database server.engine already points to.
+    """
+    settings = { 'server': 'SQLite',
+                 'authtkt.secret': 'loadtest',
+                 'agent.secret': AGENT_SECRET,
+                 'metrics.enabled': 'true' }
+    return eos_db.main({'__file__': os.path.join(workdir, 'loadtest.ini')}, **settings)
+
+def run(mix, duration, fleet, threads=4, seed=0, workdir=None):
+    """Serves the app under waitress and runs the clients against it.
+
+    :param mix: Dict of {client kind: number of clients}
+    :param duration: How long to run the clients for, in seconds.
+    :param fleet: The fleet in the database, from build_fleet() or load_fleet()
+    :param threads: Number of waitress threads.
+    :returns: Dict of results, as returned by report()
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = make_app(workdir or tmpdir)
+
+    httpd = StopableWSGIServer.create(app, host='127.0.0.1', threads=threads)
+    metrics.register_dispatcher(httpd.task_dispatcher)
+    try:
+        if not httpd.wait():
+            raise RuntimeError("Waitress did not start")
+
+        #The portal clients log in when they start, which is not counted.
+        deadline = perf_counter() + duration
+        clients = []
+        n = 0
+        #Servers masked by a newer one with the same name can't be got by name.
+        live = dict(zip(fleet.server_names, fleet.server_ids))
+        for kind, count in sorted(mix.items()):
+            for i in range(count):
+                user_idx = n % len(fleet.user_ids)
+                user_id = fleet.user_ids[user_idx]
+                servers = sorted( name for name, s_id in live.items()
+                                  if user_id in fleet.owners[s_id] )
+                clients.append(Client(kind, httpd.application_url, fleet.usernames[user_idx],
+                                      servers, fleet.server_ids, deadline, seed + n))
+                n += 1
+
+        start = perf_counter()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = perf_counter() - start
+    finally:
+        httpd.shutdown()
+        metrics.register_dispatcher(None)
+
+    return report([ r for c in clients for r in c.results ], elapsed, mix, threads)
+
+def report(results, elapsed, mix, threads):
+    """Summarises a list of (route label, status, secs) into throughput and
+       latency percentiles per route, plus a total.
+    """
+    by_route = {}
+    for label, status, secs in results:
+        by_route.setdefault(label, []).append((status, secs))
+    by_route['ALL'] = [ (status, secs) for label, status, secs in results ]
+
+    routes = {}
+    for label, rs in by_route.items():
+        times = sorted( secs for status, secs in rs )
+        routes[label] = dict( requests = len(rs),
+                              errors = sum(1 for status, secs in rs if status != 200),
+                              per_sec = len(rs) / elapsed if elapsed else 0,
+                              p50 = percentile(times, 50),
+                              p95 = percentile(times, 95),
+                              p99 = percentile(times, 99) )
+
+    return dict(elapsed=elapsed, mix=mix, threads=threads, routes=routes)
+
+def format_report(res):
+    """Formats the results as a table."""
+    lines = [ "%-38s %7s %6s %8s %8s %8s %8s" % ('route', 'reqs', 'errs', 'req/s',
+                                                 'p50 ms', 'p95 ms', 'p99 ms') ]
+    ms = lambda t: "%8.1f" % (t * 1000) if t is not None else "%8s" % '-'
+    for label, r in sorted(res['routes'].items(), key=lambda i: (i[0] == 'ALL', i[0])):
+        lines.append("%-38s %7i %6i %8.1f %s %s %s" % (label, r['requests'], r['errors'], r['per_sec'],
+                                                       ms(r['p50']), ms(r['p95']), ms(r['p99'])))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the EOS-DB web app under waitress.")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="Clients of each type to run [%(default)s]")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="Seconds to run for [%(default)s]")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="Waitress threads [%(default)s]")
+    parser.add_argument('--size', default='10x100x8',
+                        help="Fleet to build, as USERSxSERVERSxTOUCHES [%(default)s]")
+    parser.add_argument('--db',
+                        help="SQLAlchemy URL of an existing database to use rather than building a "
+                             "fleet.  All users must have the standard fleet password.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Also save the results to this file")
+    args = parser.parse_args(argv)
+
+    log = lambda msg: print(msg, file=sys.stderr)
+    #Waitress warns whenever a request has to wait for a thread, which is
+    #expected here.
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+    server.set_config(dict(BoostLevels=json.loads(json.dumps(bench.BOOST_LEVELS))))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.db:
+            server.override_engine(args.db, echo=False)
+            server.setup_states()
+            fleet = load_fleet(max_users=sum(parse_mix(args.mix).values()))
+        else:
+            server.override_engine('sqlite:///' + os.path.join(tmpdir, 'loadtest.sqlite'), echo=False)
+            server.setup_states()
+            fleet = build_fleet(*bench.parse_size(args.size), seed=args.seed)
+        log("Using %r" % fleet)
+
+        res = run(parse_mix(args.mix), args.duration, fleet, args.threads, args.seed, tmpdir)
+
+    print(format_report(res))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(res, fh, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
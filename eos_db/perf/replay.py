@@ -0,0 +1,228 @@
+"""Replays traffic saved by eos_db.capture against a test instance of EOS-DB.
+
+Requests are sent at the times they were made, relative to the first, or
+faster or slower by the --speed factor.  --speed 0 sends them as fast as the
+threads allow.  A request that can't be sent on time, because all the threads
+are busy, is sent late and the lag is reported.
+
+The capture has no credentials in it, only the group each caller was in and
+whether they used a cookie or Basic auth, so the credentials to use for each
+group are given on the command line.  Cookie users log in once per thread,
+as the portal does.  Requests from groups with no credentials are skipped.
+So are requests with scrubbed parameters, such as password changes, which would
+otherwise set the password to the scrubbed placeholder and lock the group out.
+
+    python -m eos_db.perf.replay capture.jsonl --url http://localhost:6543 \\
+        --auth users=someuser:pass,administrators=admin:pass,agents=agent:secret
+
+At the end the recorded and replayed latency percentiles are compared for each
+route, along with the number of responses whose status differed from the
+original.  The test instance needs to have the same users and servers as the
+original, or else many calls will just get a 404.
+"""
+
+import sys
+import json
+import queue
+import argparse
+import threading
+from time import sleep, perf_counter
+
+import requests
+
+from eos_db.capture import SCRUBBED
+from eos_db.perf.loadtest import percentile
+
+def load(filename, limit=None):
+    """Reads a capture file, returning the records in time order."""
+    res = []
+    with open(filename) as fh:
+        for line in fh:
+            if line.strip():
+                res.append(json.loads(line))
+    res.sort(key=lambda r: r['t'])
+    return res[:limit] if limit else res
+
+def parse_auth(auth):
+    """Turns 'users=bob:pass,agents=agent:secret' into
+       {'users': ('bob', 'pass'), 'agents': ('agent', 'secret')}.
+    """
+    res = {}
+    for part in (auth or '').split(','):
+        if part:
+            group, cred = part.split('=', 1)
+            username, password = cred.split(':', 1)
+            res[group] = (username, password)
+    return res
+
+def is_scrubbed(rec):
+    """Whether any parameter in the record had its value scrubbed."""
+    def scrubbed(value):
+        if isinstance(value, dict):
+            return any( scrubbed(v) for v in value.values() )
+        if isinstance(value, list):
+            return any( scrubbed(v) for v in value )
+        return value == SCRUBBED
+    return scrubbed(rec['params']) or scrubbed(rec.get('json'))
+
+def label(rec):
+    return '%s %s' % (rec['method'], rec['route'])
+
+class Replayer():
+    """Sends the records to base_url from a number of threads.  Results are
+       saved as (record, status, secs, lag secs) tuples.
+    """
+    def __init__(self, base_url, credentials, speed=1.0, threads=4):
+        self.base_url = base_url.rstrip('/')
+        self.credentials = credentials
+        self.speed = speed
+        self.threads = threads
+        self.results = []
+        self.skipped = 0
+        self.scrubbed = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self, rec):
+        """Gets a requests.Session for this thread, group and auth method."""
+        sessions = self._local.__dict__.setdefault('sessions', {})
+        key = (rec['identity'], rec['auth'])
+        s = sessions.get(key)
+        if s is None:
+            s = sessions[key] = requests.Session()
+            cred = self.credentials.get(rec['identity'])
+            if cred and rec['auth'] == 'cookie':
+                #Log in once, then rely on the cookie.
+                s.get(self.base_url + '/user', auth=cred).raise_for_status()
+            elif cred:
+                s.auth = cred
+        return s
+
+    def send(self, rec):
+        """Sends one request, returning the status, or 0 on a connection error."""
+        s = self._session(rec)
+        kwargs = {}
+        if 'json' in rec:
+            kwargs.update(params=rec['params'], json=rec['json'])
+        elif rec['method'] == 'GET':
+            kwargs.update(params=rec['params'])
+        else:
+            kwargs.update(data=rec['params'])
+        try:
+            r = s.request(rec['method'], self.base_url + rec['path'], **kwargs)
+            r.content
+            return r.status_code
+        except requests.RequestException:
+            return 0
+
+    def _worker(self, todo, start):
+        while True:
+            try:
+                due, rec = todo.get_nowait()
+            except queue.Empty:
+                return
+            wait = start + due - perf_counter()
+            if wait > 0:
+                sleep(wait)
+            sent = perf_counter()
+            status = self.send(rec)
+            secs = perf_counter() - sent
+            with self._lock:
+                self.results.append((rec, status, secs, max(0, sent - start - due)))
+
+    def run(self, records):
+        """Replays the records and returns the results."""
+        todo = queue.Queue()
+        t0 = records[0]['t'] if records else 0
+        for rec in records:
+            if rec['identity'] not in (None, 'anonymous') and rec['identity'] not in self.credentials:
+                self.skipped += 1
+                continue
+            if is_scrubbed(rec):
+                self.scrubbed += 1
+                continue
+            due = (rec['t'] - t0) / self.speed if self.speed else 0
+            todo.put((due, rec))
+
+        start = perf_counter()
+        workers = [ threading.Thread(target=self._worker, args=(todo, start), daemon=True)
+                    for n in range(self.threads) ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.elapsed = perf_counter() - start
+        return self.results
+
+def compare(results):
+    """Summarises the replay results against the recorded times, per route and
+       in total.  Times are in secs.
+    """
+    by_route = {}
+    for res in results:
+        by_route.setdefault(label(res[0]), []).append(res)
+    by_route['ALL'] = results
+
+    routes = {}
+    for name, rs in by_route.items():
+        recorded = sorted( rec['ms'] / 1000.0 for rec, status, secs, lag in rs )
+        replayed = sorted( secs for rec, status, secs, lag in rs )
+        r = routes[name] = dict( requests = len(rs),
+                                 status_changed = sum(1 for rec, status, secs, lag in rs
+                                                      if status != rec['status']),
+                                 max_lag = max([ lag for rec, status, secs, lag in rs ] or [0]) )
+        for pc in (50, 95, 99):
+            r['recorded_p%i' % pc] = percentile(recorded, pc)
+            r['replayed_p%i' % pc] = percentile(replayed, pc)
+        r['p50_ratio'] = ( r['replayed_p50'] / r['recorded_p50']
+                           if r['recorded_p50'] else None )
+    return routes
+
+def format_report(routes):
+    """Formats the output of compare() as a table, in ms."""
+    lines = [ "%-30s %6s %6s %9s %9s %9s %9s %9s %9s %7s" % (
+                  'route', 'reqs', 'diffs', 'was p50', 'now p50', 'was p95', 'now p95',
+                  'was p99', 'now p99', 'ratio') ]
+    ms = lambda t: "%9.1f" % (t * 1000) if t is not None else "%9s" % '-'
+    for name, r in sorted(routes.items(), key=lambda i: (i[0] == 'ALL', i[0])):
+        lines.append("%-30s %6i %6i %s %s %s %s %s %s %7s" % (
+            name, r['requests'], r['status_changed'],
+            ms(r['recorded_p50']), ms(r['replayed_p50']),
+            ms(r['recorded_p95']), ms(r['replayed_p95']),
+            ms(r['recorded_p99']), ms(r['replayed_p99']),
+            '%.2f' % r['p50_ratio'] if r['p50_ratio'] is not None else '-'))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured traffic against EOS-DB.")
+    parser.add_argument('capture', help="File saved by eos_db.capture")
+    parser.add_argument('--url', default='http://localhost:6543',
+                        help="Base URL of the test instance [%(default)s]")
+    parser.add_argument('--auth',
+                        help="Credentials for each group, as group=user:password,...")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="How much faster than the original to send requests, "
+                             "or 0 for flat out [%(default)s]")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="Requests that can be in flight at once [%(default)s]")
+    parser.add_argument('--limit', type=int, help="Only replay the first LIMIT requests")
+    parser.add_argument('--json', help="Also save the comparison to this file")
+    args = parser.parse_args(argv)
+
+    log = lambda msg: print(msg, file=sys.stderr)
+    records = load(args.capture, args.limit)
+    replayer = Replayer(args.url, parse_auth(args.auth), args.speed, args.threads)
+    results = replayer.run(records)
+    log("Replayed %i requests in %.1f secs, skipped %i with no credentials "
+        "and %i with scrubbed parameters" %
+        (len(results), replayer.elapsed, replayer.skipped, replayer.scrubbed))
+
+    routes = compare(results)
+    print(format_report(routes))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(routes, fh, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""Boost and deboost traffic in simulated time.
+
+eos_db.server gets the time from server.now(), so here a SimClock is swapped
+in and weeks of traffic run in a few minutes:
+
+  users - boost their servers for a few hours at a time, and sometimes extend
+          the boost or deboost early, as the web portal would have them do.
+  agent - polls for deboost jobs every few simulated minutes, as the deboost
+          daemon does, and deboosts each server whose boost has run out.
+
+The clock jumps from one poll to the next, but the real time the agent spends
+on each poll and each deboost is added to it as well.  So if the deboost
+queries slow down as the touch log grows, the deboosts get later, just as they
+would in real life.  Any boost the agent never sees, because it fell out of the
+window that get_deboost_jobs() looks back over, is counted as missed.
+
+For each simulated day the report gives the size of the touch log, the real
+cost of the agent's polls in time and SQL statements, the real time taken by a
+user's boost, and how late the deboosts were:
+
+    python -m eos_db.perf.simulate --days 30 --users 20 --servers 200
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+from time import perf_counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from eos_db import server
+from eos_db.perf.bench import BOOST_LEVELS
+from eos_db.perf.fleet import build_fleet
+
+# How far back the agent asks for deboost jobs, in minutes, as the daemon does.
+AGENT_PAST = 60
+
+class SimClock():
+    """A clock for server.set_clock() that only moves when told to."""
+    def __init__(self, start=None):
+        self.time = start or datetime(2020, 1, 1)
+
+    def __call__(self):
+        return self.time
+
+    def advance(self, secs):
+        self.time += timedelta(seconds=secs)
+
+    def set(self, time):
+        self.time = time
+
+class _StatementCounter():
+    """Counts the statements run against server.engine."""
+    def __init__(self):
+        self.count = 0
+        event.listen(server.engine, 'after_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+    def remove(self):
+        event.remove(server.engine, 'after_cursor_execute', self._count)
+
+def user_boost(actor_id, vm_id, level, hours):
+    """Does what the boost_server view does.  Returns False if the user can't
+       afford it.
+    """
+    if not server.check_and_remove_credits(actor_id, level['ram'], level['cores'], hours):
+        return False
+    server.touch_to_add_deboost(vm_id, hours)
+    server.touch_to_add_specification(vm_id, level['cores'], level['ram'])
+    server.touch_to_state(actor_id, vm_id, "Preparing")
+    server.touch_to_state(None, vm_id, "Started")
+    return True
+
+def user_extend(actor_id, vm_id, hours):
+    """Does what the extend_boost_on_server view does.  Returns the new time
+       left in hours, or None if the user can't afford it.
+    """
+    cores, ram = server.get_latest_specification(vm_id)
+    if not server.check_and_remove_credits(actor_id, ram, cores, hours):
+        return None
+    remaining = max((server.get_time_until_deboost(vm_id)[1] or 0) / 3600.0, 0)
+    server.touch_to_add_deboost(vm_id, hours + remaining)
+    return hours + remaining
+
+def deboost(actor_id, vm_id):
+    """Does what the deboost_server view does, for a user or an agent, and then
+       what the agent does once the server has been resized.
+    """
+    credit = server.get_time_until_deboost(vm_id)[3]
+    if actor_id and credit:
+        server.touch_to_add_credit(actor_id, credit)
+    server.touch_to_add_specification(vm_id, *server.get_baseline_specification(vm_id))
+    server.touch_to_state(actor_id, vm_id, "Pre_Deboosting")
+    server.touch_to_state(None, vm_id, "Started")
+
+class _Day():
+    def __init__(self):
+        self.polls = []         # (secs, statements) per agent poll
+        self.boosts = []        # secs per user boost
+        self.lateness = []      # secs late per agent deboost
+        self.extends = 0
+        self.early = 0
+        self.missed = 0
+        self.broke = 0
+
+    def summary(self, day, touches):
+        mean = lambda l: sum(l) / len(l) if l else 0.0
+        return dict( day = day,
+                     touches = touches,
+                     polls = len(self.polls),
+                     poll_ms_mean = round(mean([ p[0] for p in self.polls ]) * 1000, 3),
+                     poll_ms_max = round(max([ p[0] for p in self.polls ] or [0]) * 1000, 3),
+                     poll_sql_mean = round(mean([ p[1] for p in self.polls ]), 1),
+                     boosts = len(self.boosts),
+                     boost_ms_mean = round(mean(self.boosts) * 1000, 3),
+                     extends = self.extends,
+                     early_deboosts = self.early,
+                     agent_deboosts = len(self.lateness),
+                     late_secs_mean = round(mean(self.lateness), 1),
+                     late_secs_max = round(max(self.lateness or [0]), 1),
+                     missed = self.missed,
+                     refused = self.broke )
+
+def simulate(fleet, days, poll_minutes=5, boosts_per_day=1.0, seed=0, log=None):
+    """Runs the simulation on a fleet already in the database.  The clock is
+       set to a SimClock for the duration.
+    :param fleet: A Fleet from build_fleet().  Servers masked by a newer server
+                  of the same name are left alone.
+    :param days: How many days to simulate.
+    :param poll_minutes: How often the agent polls for deboost jobs.
+    :param boosts_per_day: How often, on average, each server is boosted.
+    :returns: A list of dicts, one per day.  See _Day.summary().
+    """
+    rng = random.Random(seed)
+    levels = list(server.BL['levels'])
+    live = [ s for s, name in zip(fleet.server_ids, fleet.server_names)
+             if server.get_server_id_from_name(name) == s ]
+
+    clock = SimClock()
+    server.set_clock(clock)
+    counter = _StatementCounter()
+
+    #Chance per poll that an unboosted server is boosted, and that a boosted one
+    #is extended or deboosted early.
+    polls_per_day = 24 * 60 // poll_minutes
+    p_boost = boosts_per_day / polls_per_day
+    p_extend = p_early = 1.0 / (polls_per_day / 2)
+
+    boosted = {}  # vm_id -> (owner_id, due)
+    touches = fleet.touches
+    res = []
+    try:
+        for day_n in range(days):
+            day = _Day()
+            day_end = clock() + timedelta(days=1)
+            while clock() < day_end:
+                tick = clock()
+
+                #The users, who act at random times between polls.
+                actions = sorted( (rng.random() * poll_minutes * 60, vm_id, rng.random())
+                                  for vm_id in live )
+                for offset, vm_id, roll in actions:
+                    if roll >= max(p_boost, p_extend + p_early):
+                        continue
+                    clock.set(tick + timedelta(seconds=offset))
+                    if vm_id not in boosted:
+                        if roll < p_boost:
+                            owner_id = rng.choice(fleet.owners[vm_id])
+                            hours = rng.randint(1, 12)
+                            start = perf_counter()
+                            if user_boost(owner_id, vm_id, rng.choice(levels), hours):
+                                day.boosts.append(perf_counter() - start)
+                                boosted[vm_id] = (owner_id, clock() + timedelta(hours=hours))
+                                touches += 4
+                            else:
+                                #Top them up for next time.
+                                day.broke += 1
+                                server.touch_to_add_credit(owner_id, 100)
+                                touches += 1
+                    elif roll < p_extend:
+                        owner_id = boosted[vm_id][0]
+                        hours = user_extend(owner_id, vm_id, rng.randint(1, 4))
+                        if hours:
+                            day.extends += 1
+                            boosted[vm_id] = (owner_id, clock() + timedelta(hours=hours))
+                            touches += 2
+                    elif roll < p_extend + p_early:
+                        deboost(boosted.pop(vm_id)[0], vm_id)
+                        day.early += 1
+                        touches += 4
+
+                #The agent, at the end of the interval.
+                clock.set(tick + timedelta(minutes=poll_minutes))
+                start = perf_counter()
+                before = counter.count
+                jobs = server.get_deboost_jobs(AGENT_PAST, 0)
+                elapsed = perf_counter() - start
+                day.polls.append((elapsed, counter.count - before))
+                clock.advance(elapsed)
+
+                for job in jobs:
+                    vm_id = job['artifact_id']
+                    start = perf_counter()
+                    deboost(None, vm_id)
+                    clock.advance(perf_counter() - start)
+                    touches += 3
+                    if vm_id in boosted:
+                        due = boosted.pop(vm_id)[1]
+                        day.lateness.append((clock() - due).total_seconds())
+
+                #Boosts that ran out too long ago for the agent to see.
+                too_old = clock() - timedelta(minutes=AGENT_PAST)
+                for vm_id in [ v for v, b in boosted.items() if b[1] < too_old ]:
+                    del boosted[vm_id]
+                    day.missed += 1
+
+            res.append(day.summary(day_n + 1, touches))
+            if log:
+                log(format_day(res[-1]))
+    finally:
+        counter.remove()
+        server.set_clock()
+    return res
+
+# (key, heading, format) for each column of the report.
+_COLUMNS = ( ('day',            'day',       '%4i'),
+             ('touches',        'touches',   '%9i'),
+             ('poll_ms_mean',   'poll ms',   '%9.3f'),
+             ('poll_ms_max',    'max ms',    '%9.3f'),
+             ('poll_sql_mean',  'poll SQL',  '%9.1f'),
+             ('boosts',         'boosts',    '%7i'),
+             ('boost_ms_mean',  'boost ms',  '%9.3f'),
+             ('agent_deboosts', 'deboosts',  '%9i'),
+             ('late_secs_mean', 'late s',    '%8.1f'),
+             ('late_secs_max',  'max late',  '%9.1f'),
+             ('missed',         'missed',    '%7i') )
+
+def format_header():
+    return ' '.join( h.rjust(len(f % 0)) for k, h, f in _COLUMNS )
+
+def format_day(day):
+    return ' '.join( f % day[k] for k, h, f in _COLUMNS )
+
+def run(days=30, users=20, servers=200, poll_minutes=5, boosts_per_day=1.0,
+        seed=0, workdir=None, log=None):
+    """Builds a fresh fleet in a new SQLite file and simulates it.
+    :returns: A list of dicts, one per day.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfile = os.path.join(workdir or tmpdir, 'simulate.sqlite')
+        if os.path.exists(dbfile):
+            os.remove(dbfile)
+        server.override_engine('sqlite:///' + dbfile, echo=False)
+        server.setup_states()
+        server.set_config(dict(BoostLevels=json.loads(json.dumps(BOOST_LEVELS))))
+
+        #The fleet starts at the simulation's epoch, with no history.
+        server.set_clock(SimClock())
+        try:
+            fleet = build_fleet(users, servers, 0, seed=seed)
+        finally:
+            server.set_clock()
+        if log:
+            log("Built %r" % fleet)
+            log(format_header())
+
+        return simulate(fleet, days, poll_minutes, boosts_per_day, seed, log)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate boost and deboost traffic.")
+    parser.add_argument('--days', type=int, default=30,
+                        help="Days to simulate [%(default)s]")
+    parser.add_argument('--users', type=int, default=20,
+                        help="Number of users [%(default)s]")
+    parser.add_argument('--servers', type=int, default=200,
+                        help="Number of servers [%(default)s]")
+    parser.add_argument('--poll-minutes', type=int, default=5,
+                        help="Minutes between agent polls [%(default)s]")
+    parser.add_argument('--boosts-per-day', type=float, default=1.0,
+                        help="Boosts per server per day [%(default)s]")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed for the fleet and the traffic [%(default)s]")
+    parser.add_argument('--workdir',
+                        help="Keep the SQLite file in this directory, rather than a temp dir")
+    parser.add_argument('--out', help="Save the daily results here as JSON")
+    args = parser.parse_args(argv)
+
+    res = run(args.days, args.users, args.servers, args.poll_minutes,
+              args.boosts_per_day, args.seed, args.workdir, log=print)
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump(res, fh, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""Profiling of individual requests, for administrators.
+
+An administrator can send any request with the header "X-EOS-Profile: 1" to
+have it run under cProfile.  The response is just the same as normal, but has
+an X-EOS-Profile-Id header, and the profile can then be fetched from
+/profiles/{id} as collapsed stacks, ready for flamegraph.pl or speedscope,
+or as a pstats listing with ?format=stats.  For a streamed listing the
+profile is saved once the whole body has been sent.
+
+The header is ignored for anyone without the 'administer' permission, so
+nobody else can slow the server down with it.  Only the last few profiles are
+kept, in memory.
+
+There is also a StackSampler which can run all the time in the background,
+giving folded stacks for the whole server at /samples.  Turn it on in the .ini:
+
+  profiling.sampler = true
+  profiling.sampler.interval = 0.01   Seconds between samples.
+  profiling.sampler.max_cpu = 1.0     Limit on CPU use, as a percentage.
+"""
+
+import io
+import sys
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+from collections import OrderedDict
+
+from eos_db.streaming import after_body, during_body
+
+PROFILE_HEADER = 'X-EOS-Profile'
+
+# How many profiles to keep.
+MAX_PROFILES = 20
+
+# Collapsed stacks deeper than this are cut short, and branches of the call
+# tree that took less time than this are left out.
+MAX_DEPTH = 100
+MIN_SECS = 1e-6
+
+_profiles = OrderedDict()
+_profiles_lock = threading.Lock()
+_local = threading.local()
+
+def save_profile(profile_id, stats, description):
+    with _profiles_lock:
+        _profiles[profile_id] = (description, stats)
+        while len(_profiles) > MAX_PROFILES:
+            _profiles.popitem(last=False)
+
+def get_profile(profile_id):
+    """Returns (description, pstats.Stats) for a saved profile, or None."""
+    with _profiles_lock:
+        return _profiles.get(profile_id)
+
+def list_profiles():
+    """Returns {profile_id: description} for the saved profiles, oldest first."""
+    with _profiles_lock:
+        return OrderedDict( (k, v[0]) for k, v in _profiles.items() )
+
+def _func_name(func):
+    filename, line, name = func
+    if filename == '~':
+        #A built-in, like <method 'execute' of 'sqlite3.Cursor' objects>
+        return name
+    return "%s:%s:%i" % (filename.rsplit('/site-packages/', 1)[-1], name, line)
+
+def collapsed_stacks(stats):
+    """Converts a pstats.Stats into collapsed stacks, one line per stack with
+       the time in microseconds, like "a;b;c 1234".
+
+       cProfile only records who called whom, not whole stacks, so the stacks
+       are rebuilt by following calls down from the top, sharing out the time
+       spent in each function between its callers in proportion to the time
+       each caller spent calling it.  For code where a function behaves the
+       same whoever calls it this gives the right picture.
+    """
+    raw = stats.stats
+    # caller -> { callee: cumulative time spent in callee when called from caller }
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge[3]
+
+    folded = {}
+    def walk(func, path, secs):
+        """secs is the cumulative time of func along this path."""
+        cc, nc, tt, ct, callers = raw[func]
+        path = path + (func,)
+        scale = secs / ct if ct else 0
+
+        self_secs = tt * scale
+        if len(path) < MAX_DEPTH:
+            for child, edge_ct in callees.get(func, {}).items():
+                if child not in raw:
+                    continue
+                c_secs = edge_ct * scale
+                if child in path:
+                    #Recursion, which can't be drawn properly.  Count as self time.
+                    self_secs += c_secs
+                elif c_secs >= MIN_SECS:
+                    walk(child, path, c_secs)
+
+        if self_secs > 0:
+            key = ';'.join(_func_name(f) for f in path)
+            folded[key] = folded.get(key, 0) + self_secs
+
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        if not callers:
+            walk(func, (), ct)
+
+    return '\n'.join( "%s %i" % (k, round(v * 1e6))
+                      for k, v in sorted(folded.items()) if round(v * 1e6) ) + '\n'
+
+def stats_text(stats, limit=50):
+    """A pstats listing of the top functions by cumulative time."""
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+def profile_tween_factory(handler, registry):
+    """Tween that runs requests with the X-EOS-Profile header under cProfile,
+       if the user may administer.  Calls made by /batch are not profiled
+       separately, but are included in the profile of the batch.
+    """
+    from eos_db.views import PermissionsMap
+
+    def profile_tween(request):
+        if ( not request.headers.get(PROFILE_HEADER) or
+             getattr(_local, 'active', False) or
+             not request.has_permission('administer', PermissionsMap(request)) ):
+            return handler(request)
+
+        profiler = cProfile.Profile()
+        _local.active = True
+        try:
+            response = profiler.runcall(handler, request)
+        finally:
+            _local.active = False
+
+        #Streamed listings do most of their work as the body is sent, so
+        #profile each chunk as it is made, and save the profile at the end.
+        #The header has to go out first, so the id is there before the profile.
+        profile_id = getattr(request, 'request_id', None) or uuid.uuid4().hex
+        response.headers['X-EOS-Profile-Id'] = profile_id
+        during_body(response, lambda: profiler)
+        after_body(response, lambda: save_profile(
+                profile_id, pstats.Stats(profiler),
+                "%s %s %s" % (request.method, request.path_qs, response.status) ))
+        return response
+
+    return profile_tween
+
+class StackSampler(threading.Thread):
+    """Background thread that looks at what the other threads are doing every
+    so often, with sys._current_frames(), and counts how many times each stack
+    is seen.  Over time this shows where the server spends its time, across all
+    requests, as folded stacks.
+
+    Under waitress only the waitress worker threads are sampled, and threads
+    that are idle, waiting for a request, are not counted.
+
+    To bound the cost, the sampler times itself and waits longer between
+    samples if it would otherwise take more than max_cpu percent of one CPU.
+    """
+    def __init__(self, interval=0.01, max_cpu=1.0):
+        super().__init__(name='eos-stack-sampler', daemon=True)
+        self.interval = interval
+        self.max_cpu = max_cpu
+        self.counts = {}
+        self.samples = 0
+        self.idle = 0
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        wait = self.interval
+        while not self._stop_event.wait(wait):
+            start = time.thread_time()
+            self.sample()
+            cost = time.thread_time() - start
+            wait = max(self.interval, cost * 100.0 / self.max_cpu - cost)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _wanted_threads(self):
+        threads = [ t for t in threading.enumerate() if t is not self ]
+        workers = [ t for t in threads if t.name.startswith('waitress') ]
+        return { t.ident for t in (workers or threads) }
+
+    def sample(self):
+        wanted = self._wanted_threads()
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident not in wanted:
+                continue
+            if frame.f_code.co_filename == threading.__file__:
+                #Waiting for work, or otherwise blocked in the threading module.
+                self.idle += 1
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stacks.append(tuple(reversed(stack)))
+
+        with self.lock:
+            self.samples += 1
+            for stack in stacks:
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def folded(self):
+        """The stacks seen so far, as "a;b;c count" lines."""
+        with self.lock:
+            counts = list(self.counts.items())
+        name = lambda c: _func_name((c.co_filename, c.co_firstlineno, c.co_name))
+        return '\n'.join(sorted( "%s %i" % (';'.join(name(c) for c in stack), n)
+                                 for stack, n in counts )) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.samples = 0
+            self.idle = 0
+
+_sampler = None
+
+def start_sampler(interval=0.01, max_cpu=1.0):
+    """Starts the background sampler, if it is not already running.
+    :param interval: Seconds between samples, at least.
+    :param max_cpu: Percentage of one CPU the sampler may use.
+    """
+    global _sampler
+    if _sampler is None:
+        _sampler = StackSampler(interval, max_cpu)
+        _sampler.start()
+    return _sampler
+
+def stop_sampler():
+    global _sampler
+    if _sampler is not None:
+        _sampler.stop()
+        _sampler.join()
+        _sampler = None
+
+def get_sampler():
+    """Returns the running StackSampler, or None."""
+    return _sampler
@@ -0,0 +1,135 @@
+"""Reloading of the .settings.json file while EOS-DB is running.
+
+A thread checks the modification time of the settings file every few seconds.
+When it changes the file is parsed and checked with server.validate_config()
+and, if all is well, set_config() swaps in a new configuration snapshot.  Any
+new machine states are then added to the database.  If the file is broken the
+error is logged and the old configuration stays in use, so a bad edit can be
+fixed without a restart.
+
+Each request is pinned to the snapshot that was current when it started, so a
+request never sees the boost levels change part way through.
+
+Settings in the .ini file:
+
+  config.reload_secs = 5     How often to check the file.  0 means never.
+
+The DBDetails can't be changed this way, as the engine is already made, and a
+change to them is ignored with a warning.  New states are added to the
+database at once, but the routes for setting them only appear on a restart.
+"""
+
+import os
+import logging
+import threading
+
+from eos_db import server
+from eos_db.json_loader import parse_json_file
+from eos_db.streaming import during_body
+
+log = logging.getLogger(__name__)
+
+class ConfigWatcher():
+    """Watches one settings file, loading it into eos_server when it changes.
+       Call check() to look once, or start() to look every interval secs in
+       the background.
+    """
+    def __init__(self, filename, interval=5.0, eos_server=None):
+        self.filename = filename
+        self.interval = interval
+        self.eos_server = eos_server or server.current()
+        self.reloads = 0
+        self.errors = 0
+        self._mtime = self._get_mtime()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        """Reload the file if it has changed.  Returns True if a new
+           configuration was loaded.
+        """
+        mtime = self._get_mtime()
+        if mtime is None or mtime == self._mtime:
+            return False
+        self._mtime = mtime
+
+        try:
+            json_conf = parse_json_file(self.filename)
+            server.validate_config(json_conf)
+        except Exception as e:
+            self.errors += 1
+            log.error("Not reloading %s: %s", self.filename, e)
+            return False
+
+        old = self.eos_server.config
+        if 'DBDetails' in json_conf and json_conf['DBDetails'] != old.DB:
+            log.warning("DBDetails in %s changed, which needs a restart", self.filename)
+            json_conf = dict(json_conf)
+            del json_conf['DBDetails']
+
+        self.eos_server.set_config(json_conf)
+        self.reloads += 1
+
+        if self.eos_server.config.states != old.states and self.eos_server.engine:
+            with server.using(self.eos_server):
+                server.setup_states()
+        log.info("Reloaded %s", self.filename)
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                #Keep watching, whatever happened.
+                log.exception("Failed to reload %s", self.filename)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='eos_db-reload', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+# The watcher started by watch(), if any.
+_watcher = None
+
+def watch(filename, interval):
+    """Start watching filename in the background, stopping any watcher there
+       already was.  Called from main() when config.reload_secs is set.
+    """
+    global _watcher
+    unwatch()
+    _watcher = ConfigWatcher(filename, interval)
+    _watcher.start()
+    return _watcher
+
+def unwatch():
+    global _watcher
+    if _watcher:
+        _watcher.stop()
+        _watcher = None
+
+def pin_config_tween_factory(handler, registry):
+    """Tween that keeps each request on one configuration snapshot."""
+    def pin_config_tween(request):
+        eos_server = server.current()
+        with eos_server.pin() as config:
+            response = handler(request)
+        #A streamed listing is made after the handler returns, so pin it to the
+        #same snapshot while each chunk is made.  Nothing is left pinned in
+        #between, in case the body is never finished.
+        during_body(response, lambda: eos_server.pin(config))
+        return response
+
+    return pin_config_tween
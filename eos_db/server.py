@@ -5,7 +5,13 @@ Cloudhands database, request information from the DB, or bundle a series of
 functions which cause a number of DB changes to take effect.
 """
 
-from collections import OrderedDict
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from itertools import islice
+import threading
+import sqlite3
+import sys
 
 #We need everything from the models
 from eos_db.models import ( Artifact, Appliance, Registration,
@@ -15,88 +21,506 @@ from eos_db.models import ( Artifact, Appliance, Registration,
                             Resource, Node, Password, Credit,
                             Specification, Base )
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import func
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from time import perf_counter, monotonic
 from datetime import datetime, timedelta
-from copy import deepcopy
+from copy import copy, deepcopy
 from eos_db.json_loader import parse_json_file
+from eos_db import tracing, metrics
 
-engine = None  # Assume no default database connection
+# Generators that stream results, like iter_artifacts_for_user(), fetch and
+# process rows in chunks of this size.
+STREAM_CHUNK = 200
 
-# Load config: DB, BL, and EXTRA_STATES
-DB = None
+# Holds the session set up by shared_session(), per thread.
+_shared = threading.local()
 
-# If no Boost Levels are configured supply a baseline default.
-# In the case of other exceptions - ie. If the the settings are incomplete -
-# let the exception propogate to produce an error.
-BL = {}
-BL['baseline'] = dict(label='Default', ram=2, cores=1)
-BL['levels']   = tuple()
-BL['capacity'] = tuple()
+def _state_list(EXTRA_STATES):
+    """The internal states plus any EXTRA_STATES, for get_state_list()."""
+    state_list = (
+            'Started',
+            'Stopped',
+            'Restarting',
+            'Starting',
+            'Starting_Boosted',
+            'Stopping',
+            'Preparing',
+            'Prepared',
+            'Pre_Deboosting',
+            'Pre_Deboosted',
+            'Deboosted',
+            'Boosting',   # Transitional state
+            'Deboosting', # Transitional state
+            'Error'
+            )
+
+    if EXTRA_STATES:
+        return state_list + tuple(s for s in EXTRA_STATES if s not in state_list )
+    else:
+        return state_list
+
+class LevelIndex():
+    """The boost levels from BL['levels'], indexed for the lookups we make all
+       the time.  Made once per Config, rather than looping over the levels on
+       every call.
+    """
+    def __init__(self, levels):
+        self.levels = levels
+
+        # (cores, ram) -> level number.  If two levels are the same size the
+        # last one wins, as it always has.
+        self.exact = { (lev['cores'], lev['ram']): i for i, lev in enumerate(levels) }
+
+        # The levels sorted by cores, so that those with few enough cores can be
+        # found with a bisect, and then checked for RAM.
+        by_cores = sorted(range(len(levels)), key=lambda i: levels[i]['cores'])
+        self._cores = [ levels[i]['cores'] for i in by_cores ]
+        self._by_cores = [ (i, levels[i]['ram']) for i in by_cores ]
+
+    def match(self, cores, ram):
+        """The level that is exactly (cores, ram), or None."""
+        return self.exact.get((cores, ram))
+
+    def level_met(self, cores, ram):
+        """The highest level that (cores, ram) meets or beats, or -1 if none."""
+        n = bisect_right(self._cores, cores)
+        return max(( i for i, lev_ram in self._by_cores[:n] if ram >= lev_ram ), default=-1)
+
+    def is_boosted(self, cores, ram):
+        """Whether (cores, ram) meets the first boost level."""
+        return bool(self.levels) and (cores >= self.levels[0]['cores'] and
+                                      ram >= self.levels[0]['ram'])
+
+    def cost(self, level):
+        return self.levels[level]['cost']
+
+# One snapshot of the configuration, made by set_config().  A snapshot is never
+# changed once made, so a request can keep using the one it started with while a
+# new one is swapped in.  'states' is the full list from get_state_list(), and
+# 'levels' is a LevelIndex of BL['levels'].
+Config = namedtuple('Config', 'DB BL EXTRA_STATES states levels loaded')
+
+def make_config(json_conf, base=None):
+    """Make a new Config from a dict of settings, as loaded from a settings.json
+       file.  Anything not in json_conf is kept from the base Config.
+    """
+    DB, BL, EXTRA_STATES = (base.DB, base.BL, base.EXTRA_STATES) if base else (None, None, None)
 
-EXTRA_STATES = None
+    if 'DBDetails' in json_conf:
+        DB = deepcopy(json_conf['DBDetails'])
+
+    if 'BoostLevels' in json_conf:
+        BL = deepcopy(json_conf['BoostLevels'])
+
+        if 'levels' not in BL:
+            BL['levels'] = tuple()
+            BL['capacity'] = tuple()
+
+    if 'MachineStates' in json_conf:
+        EXTRA_STATES = tuple(json_conf['MachineStates']['state_list'])
+
+    if BL is None:
+        # If no Boost Levels are configured supply a baseline default.
+        # In the case of other exceptions - ie. If the the settings are incomplete -
+        # let the exception propogate to produce an error.
+        BL = {}
+        BL['baseline'] = dict(label='Default', ram=2, cores=1)
+        BL['levels']   = tuple()
+        BL['capacity'] = tuple()
+
+    return Config(DB, BL, EXTRA_STATES, _state_list(EXTRA_STATES),
+                  LevelIndex(BL['levels']), datetime.now())
+
+def validate_config(json_conf):
+    """Check that a dict of settings makes sense before it is used, raising a
+       ValueError if not.  set_config() trusts what it is given, but a file that
+       has been edited on a live server needs checking first.
+    """
+    def check(test, msg):
+        if not test:
+            raise ValueError(msg)
+
+    check(isinstance(json_conf, dict), "Settings must be a JSON object")
+
+    BL = json_conf.get('BoostLevels')
+    if BL is not None:
+        check(isinstance(BL, dict), "BoostLevels must be an object")
+        levels = BL.get('levels', ())
+        for name, lev in [('baseline', BL.get('baseline'))] + \
+                         [ ('level %i' % (n + 1), l) for n, l in enumerate(levels) ]:
+            check(isinstance(lev, dict), "BoostLevels %s must be an object" % name)
+            for k in ('cores', 'ram'):
+                check(isinstance(lev.get(k), int) and lev[k] > 0,
+                      "BoostLevels %s needs a positive whole number of %s" % (name, k))
+        for lev in levels:
+            check(isinstance(lev.get('cost'), (int, float)) and lev['cost'] >= 0,
+                  "BoostLevels %s needs a cost" % lev.get('label'))
+        for row in BL.get('capacity', ()):
+            check(isinstance(row, (list, tuple)) and len(row) >= len(levels) and
+                  all(isinstance(n, int) for n in row),
+                  "Each BoostLevels capacity row needs a whole number for each level")
+
+    MS = json_conf.get('MachineStates')
+    if MS is not None:
+        check(isinstance(MS, dict) and isinstance(MS.get('state_list'), list) and
+              all(isinstance(st, str) and st for st in MS['state_list']),
+              "MachineStates needs a state_list of names")
+
+# Most names looked up in each IdCache.
+ID_CACHE_SIZE = 10000
+
+# Secs an IdCache entry is trusted for.  See IdCache.
+ID_CACHE_TTL = 5
+
+class IdCache():
+    """A bounded LRU of name -> id, shared by all threads.  Users and servers
+       are never renamed or deleted, so an entry only goes stale when a new
+       record takes the name, and the create functions call discard() for that.
+       A lookup that was already under way when discard() was called may have
+       read the old id, so put() takes the generation() from before the lookup
+       and does nothing if there has been a discard() since.
+       Only this process gets to call discard().  A server made by another
+       waitress process, or by eos-admin, is not seen until the entry for its
+       name expires, which is ttl secs after it was saved.  Until then the name
+       may still give the id of the older server it masks.
+    """
+    def __init__(self, size=ID_CACHE_SIZE, ttl=ID_CACHE_TTL, clock=monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+        self._gen = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._ids.get(key, (None, None))
+            if value is not None and expires <= self.clock():
+                del self._ids[key]
+                value = None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._ids.move_to_end(key)
+            return value
+
+    def generation(self):
+        return self._gen
+
+    def put(self, key, value, gen):
+        with self._lock:
+            if gen != self._gen:
+                return
+            self._ids[key] = (value, self.clock() + self.ttl)
+            self._ids.move_to_end(key)
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+            self._gen += 1
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._gen += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids)
+
+class EOSServer():
+    """Everything the functions in this module need to know about the database
+       they are working on: the engine and the sessionmaker bound to it, the
+       configuration, and the clock.  The module functions use the current()
+       instance, which is the default one unless another has been put in place
+       with using(), so one process can work on more than one database.
+       The module-level choose_engine(), set_config() and so on are wrappers
+       around the methods here, called on current().
+       The configuration is held as a Config snapshot, which set_config()
+       replaces in one go.  Inside pin() a thread keeps seeing the snapshot it
+       started with.
+    """
+    def __init__(self):
+        self.engine = None  # Assume no default database connection
+
+        # Load config: DB, BL, and EXTRA_STATES
+        self.config = make_config({})._replace(loaded=None)
+        self._pinned = threading.local()
+
+        # Where the times on touches and deboosts come from.  Simulations and
+        # tests can swap this for a clock of their own with set_clock().
+        self.clock = datetime.now
+
+    def __copy__(self):
+        res = EOSServer()
+        res.engine, res.config, res.clock = self.engine, self.config, self.clock
+        return res
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        #Make the sessionmaker just once per engine.
+        self._engine = engine
+        self.Session = engine and sessionmaker(bind=engine, expire_on_commit=False)
+
+        #Names are looked up afresh in a new database.
+        self.user_ids = IdCache()
+        self.server_ids = IdCache()
+        self.uuid_ids = IdCache()
+
+    def clear_ids(self):
+        """Empty the IdCaches, after users or servers are added other than by
+           create_user() and create_appliance().
+        """
+        for cache in (self.user_ids, self.server_ids, self.uuid_ids):
+            cache.clear()
+
+    def snapshot(self):
+        """The Config this thread should be using."""
+        return getattr(self._pinned, 'config', None) or self.config
+
+    @contextmanager
+    def pin(self, config=None):
+        """Context manager under which this thread sees the same Config
+           throughout, even if set_config() is called meanwhile.  Nested calls
+           keep the outer snapshot.
+        :param config: The Config to see, if not the current one.
+        """
+        if getattr(self._pinned, 'config', None):
+            yield self._pinned.config
+            return
+        self._pinned.config = config or self.config
+        try:
+            yield self._pinned.config
+        finally:
+            self._pinned.config = None
+
+    DB = property(lambda self: self.snapshot().DB)
+    BL = property(lambda self: self.snapshot().BL)
+    EXTRA_STATES = property(lambda self: self.snapshot().EXTRA_STATES)
+    # When set_config() last ran, for /ready.
+    CONFIG_LOADED = property(lambda self: self.config.loaded)
+
+    def now(self):
+        return self.clock()
+
+    def set_clock(self, clock=None):
+        self.clock = clock or datetime.now
+
+    def load_config_json(self, conffile):
+        self.set_config(parse_json_file(conffile))
+
+    def set_config(self, json_conf):
+        self.config = make_config(json_conf, self.config)
+
+        #It's tempting to call setup_states() here, but we can't initiate the
+        #database connection until the DB config is loaded, so it stays on the
+        #end of choose_engine()
+
+    def choose_engine(self, enginestring, replace=True, template=None):
+        if self.engine and not replace:
+            return
+
+        DB = self.DB
+        if enginestring == "PostgreSQL":
+            if DB and DB.get('username'):
+                # Password auth
+                self.engine = create_engine('postgresql://%s:%s@%s/%s'
+                                            % (DB['username'],
+                                               DB['password'],
+                                               DB['host'],
+                                               DB['database']),
+                                            echo=False)
+            elif DB:
+                self.engine = create_engine('postgresql:///%s'
+                                            % (DB['database']),
+                                            echo=False)
+            else:
+                self.engine = create_engine('postgresql:///eos_db', echo=False)
+
+        elif enginestring == "SQLite":
+            self.engine = create_engine('sqlite://', echo=False)
+            if template is not None:
+                #The template already has the tables and states.
+                self._copy_sqlite(template)
+                return
+
+        else:
+            raise LookupError("Invalid server type.")
+
+        # Always do this.  This bootstraps the database for us, and ensures
+        # any new states are added.
+        with using(self):
+            setup_states()
+
+    def _copy_sqlite(self, template):
+        """Copy a template into our in-memory SQLite engine, using SQLite's
+        backup API.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            template.backup(conn.dbapi_connection)
+        finally:
+            conn.close()
+
+    def override_engine(self, engine_string, echo=True):
+        self.engine = create_engine(engine_string, echo=echo)
+
+_current = threading.local()
+
+# The EOSServer used unless another is put in place by using().
+default = EOSServer()
+
+def current():
+    """The EOSServer that the functions in this module are working on, in this
+       thread.
+    """
+    return getattr(_current, 'server', None) or default
+
+@contextmanager
+def using(eos_server):
+    """Context manager under which the functions in this module work on another
+       EOSServer, in this thread only.
+    """
+    old = getattr(_current, 'server', None)
+    _current.server = eos_server
+    try:
+        yield eos_server
+    finally:
+        _current.server = old
+
+# These used to be module globals, and can still be read as such, from current().
+_CONTEXT_ATTRS = ('engine', 'DB', 'BL', 'EXTRA_STATES', 'CONFIG_LOADED')
+
+def __getattr__(name):
+    if name in _CONTEXT_ATTRS:
+        return getattr(current(), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def now():
+    """The current time, as far as the database records are concerned."""
+    return current().clock()
+
+def set_clock(clock=None):
+    """Sets the function used to get the current time.  It must return a naive
+       datetime, as datetime.now() does.  With no argument, goes back to the
+       real clock.
+    """
+    current().set_clock(clock)
 
 def with_session(f):
     """Decorator that automatically passes a Session to a function and then shuts
        the session down at the end, unless a session was already passed through.
        The decorator itself takes no arguments.  The function must have a session
        argument.
+       Inside a shared_session() block the shared session is passed through instead.
        This would be much easier if we just had a session handle, surely?
+       Each call is timed and counted for /metrics, along with any new session
+       it opens.  See metrics.py.
     """
     def inner(*args, **kwargs):
         #Note that if session is passed in kwargs the local session
         #variable is never set and therefore is left for the caller to close.
         session = None
-        if not kwargs.get('session'):
-            Session = sessionmaker(bind=engine, expire_on_commit=False)
-            session = Session()
+        counted = metrics.ENABLED
+        if not kwargs.get('session') and getattr(_shared, 'session', None):
+            kwargs['session'] = _shared.session
+        elif not kwargs.get('session'):
+            session = current().Session()
             kwargs['session'] = session
+            if counted: metrics.session_opened(f.__name__)
         res = None
+        trace = tracing.current()
+        if trace: trace.enter(f.__name__)
+        token = metrics.function_enter() if counted else None
         try:
             res = f(*args, **kwargs)
         except Exception as e:
             if session: session.close()
             raise e
+        finally:
+            if trace: trace.exit()
+            if counted:
+                metrics.function_exit(token, f.__name__)
+                if session: metrics.session_closed()
         if session:
             session.commit()
             session.close()
         return res
     return inner
 
+@contextmanager
+def shared_session():
+    """Context manager under which all calls decorated with @with_session in this
+       thread use one Session, rather than each opening and committing their own.
+       New records are flushed but not committed, so the caller decides when to
+       call commit() or rollback() on the session it gets back.  Anything not
+       committed when the block exits is rolled back.
+       This is used by the /batch API call.
+    """
+    if getattr(_shared, 'session', None):
+        raise RuntimeError("shared_session() blocks cannot be nested")
+
+    _shared.session = current().Session()
+    _shared.forget = []
+    try:
+        yield _shared.session
+    finally:
+        _shared.session.close()
+        _shared.session = None
+        #Anything created in the block is committed or gone by now.
+        for cache, key in _shared.forget:
+            cache.discard(key)
+        _shared.forget = None
+
+@contextmanager
+def _session_scope(session=None):
+    """Internal context manager for generators, which can't use @with_session as
+       the session would be closed as soon as the generator object was returned.
+       As with @with_session, a session passed in or set up by shared_session()
+       will be used and left open.
+    """
+    session = session or getattr(_shared, 'session', None)
+    if session:
+        yield session
+        return
+
+    session = current().Session()
+    counted = metrics.ENABLED
+    if counted:
+        #Count the session against the generator that asked for it, which is
+        #two frames up, past contextlib.
+        metrics.session_opened(sys._getframe(2).f_code.co_name)
+    try:
+        yield session
+    finally:
+        session.close()
+        if counted: metrics.session_closed()
+
 def load_config_json(conffile):
     """Loads a specified JSON file and then feeds the configuration from it to
        set_config()
     """
-    set_config(parse_json_file(conffile))
+    current().load_config_json(conffile)
 
 def set_config(json_conf):
     """Applies configuration from the supplied dict.
     """
+    current().set_config(json_conf)
 
-    global DB
-    global BL
-    global EXTRA_STATES
-
-    if 'DBDetails' in json_conf:
-        DB = json_conf['DBDetails']
-
-    if 'BoostLevels' in json_conf:
-        BL = json_conf['BoostLevels']
-
-        if 'levels' not in BL:
-            BL['levels'] = tuple()
-            BL['capacity'] = tuple()
-
-    if 'MachineStates' in json_conf:
-        EXTRA_STATES = json_conf['MachineStates']['state_list']
-        #It's tempting to call setup_states() here, but we can't initiate the
-        #database connection until the DB config is loaded, so it stays on the
-        #end of choose_engine()
-
-
-def choose_engine(enginestring, replace=True):
+def choose_engine(enginestring, replace=True, template=None):
     """
     Create a connection to a database. If Postgres is selected, this will
     connect to the database specified in the settings.py file. If SQLite is
@@ -105,38 +529,40 @@ def choose_engine(enginestring, replace=True):
     http://docs.sqlalchemy.org/en/latest/core/engines.html#configuring-logging
     one should only use echo=True for blanket debugging.  Use the logger
     settings for sqlalchemy.engine instead.
+    :param template: For SQLite only, a database from make_template() to copy
+                     into the new database, in place of setting it up from
+                     scratch.
     """
-    global engine
-
-    if engine and not replace:
-        return
-
-    if enginestring == "PostgreSQL":
-        if DB and DB.get('username'):
-            # Password auth
-            engine = create_engine('postgresql://%s:%s@%s/%s'
-                                   % (DB['username'],
-                                      DB['password'],
-                                      DB['host'],
-                                      DB['database']),
-                                   echo=False)
-        elif DB:
-            engine = create_engine('postgresql:///%s'
-                                   % (DB['database']),
-                                   echo=False)
-        else:
-            engine = create_engine('postgresql:///eos_db', echo=False)
-
-    elif enginestring == "SQLite":
-        engine = create_engine('sqlite://', echo=False)
-
-    else:
-        raise LookupError("Invalid server type.")
-
-    # Always do this.  This bootstraps the database for us, and ensures
-    # any new states are added.
-    setup_states()
-
+    current().choose_engine(enginestring, replace, template)
+
+def make_template(populate=None):
+    """Build an in-memory SQLite database with the tables and states set up, to
+    be copied by choose_engine("SQLite", template=...).  Copying is much quicker
+    than setting up a new database, and so is handy for tests and benchmarks.
+    The current engine is left as it was.
+    Note that the copy is made for the current thread only, as with any
+    in-memory SQLite database.
+    :param populate: Function called with no arguments once the template is set
+                     up, to add anything else, such as users.  Until it returns
+                     the module functions work on the template.
+    :returns: The template, as a sqlite3 connection.
+    """
+    #The template gets the same states, boost levels and so on as we have.
+    template_server = copy(current())
+    template_server.engine = create_engine('sqlite://', echo=False)
+    with using(template_server):
+        setup_states()
+        if populate:
+            populate()
+
+    template = sqlite3.connect(':memory:', check_same_thread=False)
+    conn = template_server.engine.raw_connection()
+    try:
+        conn.dbapi_connection.backup(template)
+    finally:
+        conn.close()
+    template_server.engine.dispose()
+    return template
 
 def override_engine(engine_string, echo=True):
     """Sets the target database explicitly to a different location than that
@@ -145,41 +571,72 @@ def override_engine(engine_string, echo=True):
     or deploy_tables() explicitly afterwards if you want to do that.
     :param engine_string: A SQLAlchemy server string, eg. 'sqlite://'
     """
-    global engine
-    engine = create_engine(engine_string, echo=echo)
+    current().override_engine(engine_string, echo)
 
 def deploy_tables():
     """Create tables in their current state in the currently connected
     database.
     """
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(current().engine)
+
+def missing_indexes():
+    """List the indexes defined in models.py that the database does not have.
+    create_all() only makes indexes along with new tables, so a database made
+    before an index was added to the models will be missing it.  This only
+    looks, so it is safe to call on a live database.
+    :returns: The missing indexes, as SQLAlchemy Index objects.
+    """
+    inspector = inspect(current().engine)
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        have = set( i['name'] for i in inspector.get_indexes(table.name) )
+        missing.extend( i for i in table.indexes if i.name not in have )
+    return missing
+
+def create_indexes():
+    """Add any indexes from missing_indexes() to the database.
+    Building an index on a big table takes a while and blocks writes to it
+    in the meantime, so this is never done on startup.  Run it deliberately,
+    with "eos-admin addindexes".
+    :returns: The names of the indexes that were made.
+    """
+    made = []
+    for index in missing_indexes():
+        index.create(current().engine)
+        made.append(index.name)
+    return made
+
+def check_db():
+    """Make a trivial round trip to the database, which touches no tables, and
+    report on the connection pool.  This is for the /ready call, so it needs
+    to be quick.
+    :returns: dict with db_ok, db_ms and the pool counts, where the type of
+              pool in use keeps them.
+    """
+    engine = current().engine
+    res = dict(db_ok=False, pool=type(engine.pool).__name__)
+    start = perf_counter()
+    try:
+        with engine.connect() as conn:
+            res['db_ok'] = conn.execute(text('SELECT 1')).scalar() == 1
+    except SQLAlchemyError as e:
+        res['db_error'] = type(e).__name__
+    res['db_ms'] = round((perf_counter() - start) * 1000, 3)
+
+    #The in-memory SQLite engine uses a pool that doesn't count anything.
+    if isinstance(engine.pool, QueuePool):
+        res.update( pool_size = engine.pool.size(),
+                    pool_checked_out = engine.pool.checkedout(),
+                    pool_overflow = engine.pool.overflow() )
+    return res
 
 def get_state_list():
     """The state list is a union of the internal states we need to function
        plus anything else in EXTRA_STATES
     """
-    state_list = (
-            'Started',
-            'Stopped',
-            'Restarting',
-            'Starting',
-            'Starting_Boosted',
-            'Stopping',
-            'Preparing',
-            'Prepared',
-            'Pre_Deboosting',
-            'Pre_Deboosted',
-            'Deboosted',
-            'Boosting',   # Transitional state
-            'Deboosting', # Transitional state
-            'Error'
-            )
-
-    if EXTRA_STATES:
-        return state_list + tuple(s for s in EXTRA_STATES if s not in state_list )
-    else:
-        return state_list
-
+    return current().snapshot().states
 
 def setup_states(ignore_dupes=True):
     """ Write the list of valid states to the database.
@@ -188,7 +645,7 @@ def setup_states(ignore_dupes=True):
         add the same state twice, otherwise it will just ignore the error - ie.
         it will just add new states and will be idempotent.
     """
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(current().engine)
     states_added = 0
     for state in get_state_list():
         try:
@@ -203,6 +660,7 @@ def get_boost_levels(show_if_avail=True):
     """List the boost levels configured on this server.  If a capacity table has
        been supplied it will also say, for each level, whether it is available.
     """
+    BL = current().BL
     if not (BL.get('capacity') and show_if_avail):
         return(BL)
 
@@ -247,10 +705,30 @@ def list_user_ids(session):
     for n in session.query(User.username).distinct():
         yield get_user_id_from_name(n[0])
 
+def iter_user_details(session=None):
+    """Generator giving check_user_details() for all active users, ie. the users
+       returned by list_user_ids(), but fetching the details in the same query and
+       without loading them all at once.
+    """
+    with _session_scope(session) as session:
+        #get_user_id_from_name() gives the first user with any given name.
+        first_ids = session.query(func.min(User.id)).group_by(User.username)
+        users = ( session
+                  .query(User.id, User.handle, User.username, User.name)
+                  .filter(User.id.in_(first_ids))
+                  .order_by(User.id)
+                  .yield_per(STREAM_CHUNK) )
+        for u in users:
+            yield {'id': u.id,
+                   'handle': u.handle,
+                   'username': u.username,
+                   'name': u.name
+                   }
+
 def create_user(type, handle, name, username):
     """Create a new user record. Handle/uuid must be unique e-mail address"""
-    Base.metadata.create_all(engine)
     user_id = _create_thingy(User(name=name, username=username, uuid=handle, handle=handle))
+    _forget_id(current().user_ids, username)
 
     #Add this user to a group
     if type:
@@ -271,7 +749,6 @@ def touch_to_add_user_group(username, group):
 def create_group_membership(touch_id, group):
     """ Create a new group membership resource. """
     # FIXME2 - this is only ever used by the function above so fold the code in.
-    Base.metadata.create_all(engine)
     #return _create_thingy(GroupMembership(group=group))
     # FIXME (Tim) - touch_id was unused, so clearly this was broken.  Test as-is first.
     return _create_thingy(GroupMembership(group=group, touch_id=touch_id))
@@ -296,14 +773,41 @@ def get_user_group(username, session):
 def create_appliance(name, uuid):
     """ Create a new VApp """  # FIXME: We shoehorn VMs into the Vapp record.
     # VMs should go into the "Node" object.
-    Base.metadata.create_all(engine)
-    return _create_thingy(Appliance(uuid=uuid, name=name))
+    artifact_id = _create_thingy(Appliance(uuid=uuid, name=name))
+
+    #The new server masks any old one with the same name.
+    _forget_id(current().server_ids, name)
+    _forget_id(current().uuid_ids, uuid)
+    return artifact_id
 
 def create_artifact_state(state_name):
     """ Create a new artifact state. ArtifactState subclasses State. See the
     relevant docs in the model. """
     return _create_thingy(ArtifactState(name=state_name))
 
+def _forget_id(cache, key):
+    """Drop a name from an IdCache after a record with that name is made.  In a
+       shared_session() the record is not committed yet, so it is dropped again
+       at the end of the block.
+    """
+    cache.discard(key)
+    if getattr(_shared, 'forget', None) is not None:
+        _shared.forget.append((cache, key))
+
+def _cached_id(cache, key, lookup, session):
+    """Get an id from the IdCache, or else from lookup(key, session=session),
+       saving the result.  In a shared_session() the lookup may see records
+       that other threads can't, and that may yet be rolled back, so nothing
+       is saved.
+    """
+    res = cache.get(key)
+    if res is None:
+        gen = cache.generation()
+        res = lookup(key, session=session)
+        if not getattr(_shared, 'session', None):
+            cache.put(key, res, gen)
+    return res
+
 @with_session
 def _create_thingy(sql_entity, session):
     """Internal call that holds the boilerplate for putting a new SQLAlchemy object
@@ -311,8 +815,12 @@ def _create_thingy(sql_entity, session):
        that aids legibility.  Maybe should rename this though.
     """
     session.add(sql_entity)
-    #Note that this commit causes the .id to be populated.
-    session.commit()
+    #Note that this commit causes the .id to be populated.  In a shared session
+    #a flush does that without ending the caller's transaction.
+    if session is getattr(_shared, 'session', None):
+        session.flush()
+    else:
+        session.commit()
     return sql_entity.id
 
 
@@ -337,29 +845,35 @@ def list_artifacts_for_user(user_id, session):
                     If None, all VMs will be returned
     :returns: List of dictionaries containing pertinent info.
     """
-    # This bit was  _list_artifacts_for_user(user_id)
-    servers = (session
-               .query(Artifact.id, Artifact.name, Artifact.uuid)
-               .all())
-
-    # Because of my logic that adding a new server with an existing name masks
-    # the old server, we actually want to get all the servers here and then
-    # post-filter them, or at least that is the simplest approach.
-
-    #OrderedDict gives me the property of updating any server listed
-    #twice while still maintaining database order.
-    artifacts = OrderedDict()
-    for server in servers:
-        #Cleanup CHAR values - really should fix this in the DB
-        server = list(server)
-        server[1] = server[1].rstrip()
-        server[2] = server[2].rstrip()
-        #END workaround
-        if server[1] in artifacts:
-            del artifacts[server[1]]
-        if user_id is None or check_ownership(server[0], user_id, session=session):
-            artifacts[server[1]] = return_artifact_details(*server, session=session)
-    return artifacts.values()
+    return list(iter_artifacts_for_user(user_id, session=session))
+
+def iter_artifacts_for_user(user_id, session=None):
+    """Generator version of list_artifacts_for_user().  The servers are fetched
+       and checked in chunks, so the whole list is never held in memory.
+    """
+    with _session_scope(session) as session:
+        for chunk in _chunks(_live_artifacts(session), STREAM_CHUNK):
+            ids = [ a[0] for a in chunk ]
+            if user_id is not None:
+                owned = list_owned_artifacts(ids, user_id, session=session)
+                ids = [ a_id for a_id in ids if a_id in owned ]
+
+            details = return_artifact_details_multi(ids, session=session)
+            for a_id in ids:
+                yield details[a_id]
+
+def _live_artifacts(session):
+    """Internal function giving (id, name, uuid) for every server, in order,
+       streamed from the database.
+       Because of my logic that adding a new server with an existing name masks
+       the old server, this means the newest server with each name.
+    """
+    newest_ids = session.query(func.max(Artifact.id)).group_by(Artifact.name)
+    return ( session
+             .query(Artifact.id, Artifact.name, Artifact.uuid)
+             .filter(Artifact.id.in_(newest_ids))
+             .order_by(Artifact.id)
+             .yield_per(STREAM_CHUNK) )
 
 @with_session
 def return_artifact_details(artifact_id, artifact_name=None, artifact_uuid=None, session=None):
@@ -368,7 +882,80 @@ def return_artifact_details(artifact_id, artifact_name=None, artifact_uuid=None,
     change_dt = _get_most_recent_change(artifact_id, session=session)
     create_dt = _get_artifact_creation_date(artifact_id, session=session)
     state = check_state(artifact_id, session=session)
-    boosted = _get_server_boost_status(artifact_id)
+    spec = get_latest_specification(artifact_id, session=session)
+    deboost_dt = _get_latest_deboost_dt(artifact_id, session=session)
+
+    if not artifact_uuid:
+        artifact_uuid = get_server_uuid_from_id(artifact_id, session=session)
+    if not artifact_name:
+        artifact_name = get_server_name_from_id(artifact_id, session=session)
+
+    return _artifact_details(artifact_id, artifact_name, artifact_uuid,
+                             change_dt[0], create_dt[0], state, spec,
+                             deboost_dt[0] if deboost_dt else None)
+
+@with_session
+def return_artifact_details_multi(artifact_ids, session):
+    """ Multi-VM version of return_artifact_details().  Rather than making a
+        handful of queries per VM, this fetches each piece of information
+        for all the VMs at once.
+
+    :param artifact_ids: A list of artifact ids.
+    :returns: Dict of {artifact_id: details}.  IDs not found are left out.
+    """
+    names = {}
+    change_dts = {}
+    states = {}
+    specs = {}
+    deboost_dts = {}
+
+    for chunk in _chunks(artifact_ids):
+        for a_id, a_name, a_uuid in ( session
+                                      .query(Artifact.id, Artifact.name, Artifact.uuid)
+                                      .filter(Artifact.id.in_(chunk)) ):
+            names[a_id] = (a_name.rstrip(), a_uuid.rstrip())
+
+        for a_id, create_dt, change_dt in ( session
+                                            .query(Touch.artifact_id,
+                                                   func.min(Touch.touch_dt),
+                                                   func.max(Touch.touch_dt))
+                                            .filter(Touch.artifact_id.in_(chunk))
+                                            .group_by(Touch.artifact_id) ):
+            change_dts[a_id] = (create_dt, change_dt)
+
+        states.update(_latest_states(chunk, session))
+
+        #For these, the latest touch for each artifact wins, as in check_state()
+        #and friends.
+        latest = _latest_touches(chunk, session, Specification)
+        for a_id, cores, ram in ( session
+                                  .query(Touch.artifact_id,
+                                         Specification.cores, Specification.ram)
+                                  .filter(Specification.touch_id == Touch.id)
+                                  .filter(Touch.id == latest.c.id) ):
+            specs[a_id] = (cores, ram)
+
+        latest = _latest_touches(chunk, session, Deboost)
+        for a_id, deboost_dt in ( session
+                                  .query(Touch.artifact_id, Deboost.deboost_dt)
+                                  .filter(Deboost.touch_id == Touch.id)
+                                  .filter(Touch.id == latest.c.id) ):
+            deboost_dts[a_id] = deboost_dt
+
+    return { a_id: _artifact_details(a_id, a_name, a_uuid,
+                                     change_dts.get(a_id, (None, None))[1],
+                                     change_dts.get(a_id, (None, None))[0],
+                                     states.get(a_id),
+                                     specs.get(a_id),
+                                     deboost_dts.get(a_id))
+             for a_id, (a_name, a_uuid) in names.items() }
+
+def _artifact_details(artifact_id, artifact_name, artifact_uuid,
+                      change_dt, create_dt, state, spec, deboost_dt):
+    """Internal function that builds the dict returned by return_artifact_details()
+       once all the information has been fetched.
+    """
+    boosted = _spec_is_boosted(spec)
 
     boostremaining = "N/A"
     deboost_time = 0
@@ -377,7 +964,7 @@ def return_artifact_details(artifact_id, artifact_name=None, artifact_uuid=None,
     #Because get_time_until_deboost() might report a deboost time for an un-boosted
     #server if it was manually deboosted, check the status
     if boosted:
-        time_for_deboost = get_time_until_deboost(artifact_id, session=session)
+        time_for_deboost = _time_until_deboost(deboost_dt, spec)
         boostremaining = time_for_deboost[2] or "Not set"
         # Get deboost time as UNIX seconds-since-epoch
         # Any browser will be able to render this as local time by using:
@@ -386,22 +973,18 @@ def return_artifact_details(artifact_id, artifact_name=None, artifact_uuid=None,
         deboost_credit = time_for_deboost[3]
 
     try:
-        cores, ram = get_latest_specification(artifact_id, session=session)
+        cores, ram = spec
         ram = str(ram)
     except:
         cores, ram = "N/A", "N/A"
     if state == None:
         state = "Not yet initialised"
-    if not artifact_uuid:
-        artifact_uuid = get_server_uuid_from_id(artifact_id, session=session)
-    if not artifact_name:
-        artifact_name = get_server_name_from_id(artifact_id, session=session)
 
     return({"artifact_id": artifact_id,
             "artifact_uuid": artifact_uuid,
             "artifact_name": artifact_name,
-            "change_dt": str(change_dt[0])[0:16],
-            "create_dt": str(create_dt[0])[0:16],
+            "change_dt": str(change_dt)[0:16],
+            "create_dt": str(create_dt)[0:16],
             "state": state,
             "boosted": "Boosted" if boosted else "Unboosted",
             "cores": cores,
@@ -411,6 +994,51 @@ def return_artifact_details(artifact_id, artifact_name=None, artifact_uuid=None,
             "deboost_credit": deboost_credit
             })
 
+def _latest_states(artifact_ids, session):
+    """Internal function giving check_state() for a list of artifacts, as a dict.
+       Artifacts with no state are left out.
+    """
+    latest = _latest_touches(artifact_ids, session)
+    return dict( session
+                 .query(Touch.artifact_id, ArtifactState.name)
+                 .filter(ArtifactState.id == Touch.state_id)
+                 .filter(Touch.id == latest.c.id) )
+
+def _latest_touches(artifact_ids, session, resource=None):
+    """Internal function giving a subquery with the id of the latest touch for
+       each of the artifacts that added a resource of the given class, or
+       that set a state if resource is None.  This way the database returns one
+       row per artifact rather than the whole history.  Latest means the newest
+       touch_dt, and then the highest id if two touches have the same time.
+       Touches with no touch_dt never count.
+    """
+    def touches(*columns):
+        query = session.query(*columns).filter(Touch.artifact_id.in_(artifact_ids))
+        if resource is None:
+            return query.filter(Touch.state_id != None)
+        return query.join(resource, resource.touch_id == Touch.id)
+
+    newest_dt = ( touches(Touch.artifact_id.label('artifact_id'),
+                          func.max(Touch.touch_dt).label('touch_dt'))
+                  .group_by(Touch.artifact_id)
+                  .subquery() )
+    return ( touches(func.max(Touch.id).label('id'))
+             .filter(Touch.artifact_id == newest_dt.c.artifact_id)
+             .filter(Touch.touch_dt == newest_dt.c.touch_dt)
+             .group_by(Touch.artifact_id)
+             .subquery() )
+
+def _chunks(items, size=500):
+    """Splits items into lists no longer than size, so that we don't put too
+       many values into any one IN clause.  Items can be any iterable, and are
+       consumed lazily.
+    """
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
 
 #FIXME - rationalise these to three functions:
 #  get_server_by_name
@@ -432,13 +1060,18 @@ def get_server_name_from_id(artifact_id, session):
                      .first())
     return artifact_name[0].rstrip()
 
-@with_session
-def get_server_id_from_name(name, session):
+def get_server_id_from_name(name, session=None):
     """ Get the system ID of a server from its name.
+    Results are cached in current().server_ids.
 
     :param name: The name of an artifact.
     :returns: Internal ID of artifact.
     """
+    return _cached_id(current().server_ids, name, _get_server_id_from_name, session)
+
+@with_session
+def _get_server_id_from_name(name, session):
+    """Uncached version of get_server_id_from_name()."""
     # FIXME - Check behaviour on duplicate names. This should not be a problem
     # due to database constraints, but is worth looking at, just in case.
     artifact_id = (session
@@ -449,25 +1082,53 @@ def get_server_id_from_name(name, session):
     return artifact_id[0]
 
 @with_session
-def get_server_id_from_uuid(uuid, session):
+def get_server_ids_from_names(names, session):
+    """ Multi-name version of get_server_id_from_name().
+
+    :param names: A list of artifact names.
+    :returns: Dict of {name: artifact_id}.  Names not found are left out.
+    """
+    #As in get_server_id_from_name(), the newest server with any name masks
+    #the older ones.
+    res = {}
+    for chunk in _chunks(names):
+        for a_name, a_id in ( session
+                              .query(Artifact.name, func.max(Artifact.id))
+                              .filter(Artifact.name.in_(chunk))
+                              .group_by(Artifact.name) ):
+            res[a_name.rstrip()] = a_id
+    return res
+
+def get_server_id_from_uuid(uuid, session=None):
     """ Get the system ID of a server from its UUID.
+    Results are cached in current().uuid_ids.
 
     :param name: The name of an artifact.
     :returns: Internal ID of artifact.
     """
+    return _cached_id(current().uuid_ids, uuid, _get_server_id_from_uuid, session)
+
+@with_session
+def _get_server_id_from_uuid(uuid, session):
+    """Uncached version of get_server_id_from_uuid()."""
     artifact_id = (session
                    .query(Artifact.id)
                    .filter(Artifact.uuid == uuid)
                    .first())
     return artifact_id[0]
 
-@with_session
-def get_user_id_from_name(name, session):
+def get_user_id_from_name(name, session=None):
     """ Get the system ID of a user from his name.
+    Results are cached in current().user_ids.
 
     :param name: The username of a user.
     :returns: Internal ID of user.
     """
+    return _cached_id(current().user_ids, name, _get_user_id_from_name, session)
+
+@with_session
+def _get_user_id_from_name(name, session):
+    """Uncached version of get_user_id_from_name()."""
     # FIXME - Behaviour with duplicates also applies here. Ensure constraints
     # properly set.
     user_id = (session
@@ -489,9 +1150,17 @@ def _get_server_boost_status(artifact_id, session=None):
     :returns: Bool giving boost status.
     """
     try:
-        cores, ram = get_latest_specification(artifact_id, session=session)
+        return _spec_is_boosted(get_latest_specification(artifact_id, session=session))
+    except:
+        return False
 
-        return (ram >= BL['levels'][0]['ram']) and (cores >= BL['levels'][0]['cores'])
+def _spec_is_boosted(spec):
+    """ Internal function that gives the boost status for a (cores, ram) spec as
+        returned by get_latest_specification().
+    """
+    try:
+        cores, ram = spec
+        return current().snapshot().levels.is_boosted(cores, ram)
     except:
         #Maybe the machine is new.  Unboosted then.
         return False
@@ -513,14 +1182,21 @@ def get_deboost_credits(artifact_id, hours, session):
     #don't care about.
     if hours <= 0: return 0
 
+    return _deboost_credits(get_latest_specification(artifact_id, session=session), hours)
+
+def _deboost_credits(spec, hours):
+    """ Internal function that works out get_deboost_credits() for a (cores, ram)
+        spec.
+    """
+    if hours <= 0: return 0
+
     #This is very similar to the code in check_and_remove_credits but in this case
     #we are less specific.  Find the highest level that the VM meets rather than requiring
     #an exact match.
-    cores, ram = get_latest_specification(artifact_id, session=session)
-    multiplier = 0
-    for lev in BL["levels"]:
-        if(cores >= lev['cores'] and ram >= lev['ram']):
-            multiplier = lev['cost']
+    cores, ram = spec
+    levels = current().snapshot().levels
+    vm_lev = levels.level_met(cores, ram)
+    multiplier = levels.cost(vm_lev) if vm_lev >= 0 else 0
 
     return multiplier * hours
 
@@ -550,13 +1226,54 @@ def list_servers_by_state(session):
             state_table[s_state] = [ server_id ]
     return state_table
 
+def iter_servers_in_state(state_name, session=None):
+    """Generator giving the id, uuid and name of all servers in the given state,
+       checking the servers in chunks rather than one at a time like
+       list_servers_by_state().
+    """
+    with _session_scope(session) as session:
+        for chunk in _chunks(_live_artifacts(session), STREAM_CHUNK):
+            states = _latest_states([ a[0] for a in chunk ], session)
+            for a_id, a_name, a_uuid in chunk:
+                if states.get(a_id) == state_name:
+                    yield { "artifact_id"   : a_id,
+                            "artifact_uuid" : a_uuid.rstrip(),
+                            "artifact_name" : a_name.rstrip() }
+
+def iter_touches(actor_id=None, artifact_id=None, session=None):
+    """Generator giving the history of touches made by a user or made to a VM,
+       oldest first.  Each touch is reported along with the state it set and/or
+       the type of resource it added, if any.
+
+    :param actor_id: A valid actor (user) id, or None.
+    :param artifact_id: A valid artifact id, or None.
+    """
+    with _session_scope(session) as session:
+        touches = ( session
+                    .query(Touch.id, Touch.touch_dt, Touch.actor_id, Touch.artifact_id,
+                           State.name, Resource.type)
+                    .outerjoin(State, State.id == Touch.state_id)
+                    .outerjoin(Resource, Resource.touch_id == Touch.id) )
+        if actor_id is not None:
+            touches = touches.filter(Touch.actor_id == actor_id)
+        if artifact_id is not None:
+            touches = touches.filter(Touch.artifact_id == artifact_id)
+
+        for t in touches.order_by(Touch.id).yield_per(STREAM_CHUNK):
+            yield { "touch_id"    : t[0],
+                    "touch_dt"    : str(t[1])[0:19],
+                    "actor_id"    : t[2],
+                    "artifact_id" : t[3],
+                    "state"       : t[4],
+                    "resource"    : t[5] }
+
 @with_session
 def list_servers_by_boost_level(session):
     """ Iterates through the servers and bins them by boost level.
     """
     # Borrowing code from the function above and from get_deboost_credits
-    all_levels =  BL["levels"]
-    lev_tally = [0] * len(all_levels)
+    levels = current().snapshot().levels
+    lev_tally = [0] * len(levels.levels)
 
     servers = session.query(Artifact.name).distinct()
     for server_name in servers:
@@ -567,11 +1284,7 @@ def list_servers_by_boost_level(session):
         try:
             cores, ram = get_latest_specification(server_id, session=session)
 
-            vm_lev = -1
-            for i, lev in enumerate(all_levels):
-                if(cores >= lev['cores'] and ram >= lev['ram']):
-                    vm_lev = i
-
+            vm_lev = levels.level_met(cores, ram)
             if vm_lev >= 0:
                 lev_tally[vm_lev] += 1
         except:
@@ -627,6 +1340,25 @@ def check_ownership(artifact_id, actor_id, session):
     else:
         return True
 
+@with_session
+def list_owned_artifacts(artifact_ids, actor_id, session):
+    """ Multi-VM version of check_ownership().
+
+    :param artifact_ids: A list of artifact ids.
+    :param actor_id: A valid actor (user) id.
+    :returns: The set of the given artifact ids that belong to the user.
+    """
+    owned = set()
+    for chunk in _chunks(artifact_ids):
+        owned.update( a_id for (a_id,) in ( session
+                                            .query(Touch.artifact_id)
+                                            .select_from(Ownership)
+                                            .filter(Ownership.user_id == actor_id)
+                                            .filter(Ownership.touch_id == Touch.id)
+                                            .filter(Touch.artifact_id.in_(chunk))
+                                            .distinct() ) )
+    return owned
+
 @with_session
 def get_state_id_by_name(name, session):
     """Gets the id of a state from the name associated with it.
@@ -665,7 +1397,7 @@ def touch_to_add_deboost(vm_id, hours):
     """
     touch_id = _create_touch(None, vm_id, None)
 
-    deboost_dt = datetime.now()
+    deboost_dt = now()
     deboost_dt += timedelta(hours=hours)
     new_deboost = Deboost(deboost_dt=deboost_dt, touch_id=touch_id)
 
@@ -683,17 +1415,15 @@ def check_and_remove_credits(actor_id, ram, cores, hours):
     #This is not ideal - the client requests RAM/Cores explicitly.  We need to see if this
     #translates back to a real boost level and work out the cost.  If there is no exact
     #match we must fail.
-    multiplier = -1
-    for lev in BL["levels"]:
-        if(cores == lev['cores'] and ram == lev['ram']):
-            multiplier = lev['cost']
-
-    #Return if we didn't find a match.  Note I'm using -1 as you could conceivably have a free
-    #boost level but not one that pays you!
-    if multiplier < 0:
+    levels = current().snapshot().levels
+    lev = levels.match(cores, ram)
+
+    #Return if we didn't find a match.  Note I'm checking for None as you could
+    #conceivably have a free boost level.
+    if lev is None:
         return None
 
-    cost = multiplier * hours
+    cost = levels.cost(lev) * hours
 
     #See if the user can afford it...
     current_credit = check_credit(actor_id)
@@ -780,10 +1510,19 @@ def get_time_until_deboost(vm_id, session=None):
         We return a quadruplet:
           [ (datetime)deboost_time, (int)secs_until_deboost, (str)display_value, (int)credit ]
     """
-    now = datetime.now()
     try:
         deboost_dt = _get_latest_deboost_dt(vm_id,session=session)[0]
-        delta = deboost_dt - now
+        spec = get_latest_specification(vm_id, session=session)
+    except:
+        return (None, None, None, 0)
+    return _time_until_deboost(deboost_dt, spec)
+
+def _time_until_deboost(deboost_dt, spec):
+    """ Internal function that works out get_time_until_deboost() given the latest
+        deboost time and (cores, ram) spec of a VM.
+    """
+    try:
+        delta = deboost_dt - now()
         #Work out what to show the user...
         display_value = None
         if delta.days > 0:
@@ -796,7 +1535,7 @@ def get_time_until_deboost(vm_id, session=None):
             display_value = "Expired"
 
         #Work out what any unused time is worth.  This will always be an integer >=0
-        credit = get_deboost_credits(vm_id, hours=delta.total_seconds() // 3600)
+        credit = _deboost_credits(spec, hours=delta.total_seconds() // 3600)
 
         return (deboost_dt, int(delta.total_seconds()), display_value, credit)
     except:
@@ -813,9 +1552,9 @@ def get_deboost_jobs(past, future, session):
         :param future : How far forward to look, also in minutes.
         :returns: Array of {server_name, server_id, seconds_remaining}
     """
-    now = datetime.now()
-    start_time = now - timedelta(minutes=past)
-    end_time = now + timedelta(minutes=future)
+    time_now = now()
+    start_time = time_now - timedelta(minutes=past)
+    end_time = time_now + timedelta(minutes=future)
 
     deboosts = ( session
                  .query(Deboost.deboost_dt, Touch.artifact_id)
@@ -850,7 +1589,7 @@ def get_deboost_jobs(past, future, session):
     #And return an array of triples as promised
     return [ dict(artifact_name=n,
                   artifact_id=i[1],
-                  boost_remain=int( (i[0] - now).total_seconds() ) )
+                  boost_remain=int( (i[0] - time_now).total_seconds() ) )
              for n,i in res.items() ]
 
 @with_session
@@ -870,13 +1609,14 @@ def get_previous_specification(vm_id, index=1, session=None):
     try:
         return state[index]
     except IndexError:
-        return BL['baseline']['cores'], BL['baseline']['ram']
+        return get_baseline_specification(vm_id)
 
 def get_baseline_specification(vm_id):
     """Get the default baseline spec for a VM.  At present this is just the same
        for all VMs.
     """
-    return BL['baseline']['cores'], BL['baseline']['ram']
+    baseline = current().BL['baseline']
+    return baseline['cores'], baseline['ram']
 
 def touch_to_add_node():
     """
@@ -906,7 +1646,7 @@ def _create_touch(actor_id, artifact_id, state_id):
     new_touch = Touch(actor_id=actor_id,
                       artifact_id=artifact_id,
                       state_id=state_id,
-                      touch_dt=datetime.now())
+                      touch_dt=now())
     return _create_thingy(new_touch)
 
 def create_ownership(touch_id, user_id):
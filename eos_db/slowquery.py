@@ -0,0 +1,199 @@
+"""Slow query log for EOS-DB.
+
+Any SQL statement that takes longer than a threshold is logged as one line of
+JSON to the eos_db.slowquery logger, with its parameters, the function in
+eos_db.server that ran it and the row count, where the database reports one
+(SQLite does not for SELECTs).
+
+The first time a SELECT of any given shape is slow, the query plan is also
+fetched and logged, so that a missing index shows up straight away as a scan.
+
+Both are off unless turned on in the .ini file, as fetching a plan is more
+work for the database just when it is struggling:
+
+  slowquery.secs = 0.5        Threshold in seconds.  0, the default, is off.
+  slowquery.explain = true    Fetch query plans for slow SELECTs.  Default false.
+"""
+
+import re
+import sys
+import json
+import logging
+import threading
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from eos_db.capture import SECRET, SCRUBBED
+
+log = logging.getLogger(__name__)
+
+SLOW_SECS = 0
+EXPLAIN = False
+
+# Only this many statement shapes are remembered as already explained.
+MAX_EXPLAINED = 1000
+
+# Long parameters are cut down to this.  That is no protection for secrets,
+# as a bcrypt hash is shorter, so those are replaced whole: see _safe_params().
+MAX_PARAM = 64
+
+# Every parameter written to a table with a name like this is replaced.
+_WRITES_TO = re.compile(r'^\s*(?:INSERT\s+INTO|UPDATE)\s+"?(\w+)', re.I)
+
+# Matches a bracketed list of bind parameters, for any of the param styles we use.
+_PARAM_LIST = re.compile(r'\(\s*(?:\?|%s|%\(\w+\)s)(?:\s*,\s*(?:\?|%s|%\(\w+\)s))*\s*\)')
+
+def statement_shape(statement):
+    """Normalises a statement so that the same query with a different number of
+       values in an IN clause, or different whitespace, has the same shape.
+    """
+    return ' '.join(_PARAM_LIST.sub('(?)', statement).split())
+
+_local = threading.local()
+_explained = set()
+_explained_lock = threading.Lock()
+
+def configure(settings):
+    """Reads the slowquery.* settings from the app settings."""
+    global SLOW_SECS, EXPLAIN
+    SLOW_SECS = float(settings.get('slowquery.secs', SLOW_SECS))
+    EXPLAIN = str(settings.get('slowquery.explain', EXPLAIN)).lower() in ('true', '1', 'yes', 'on')
+
+def reset():
+    """Forgets which statements have been explained.  Mainly for testing."""
+    with _explained_lock:
+        _explained.clear()
+
+_installed = False
+def install():
+    """Sets up the SQLAlchemy event listeners.  As in eos_db.metrics these go on
+       the Engine class so they work for whatever engine server.engine is.
+    """
+    global _installed
+    if _installed:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _installed = True
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _local.start = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(_local, 'start', None)
+    if start is None or not SLOW_SECS:
+        return
+    _local.start = None
+
+    elapsed = perf_counter() - start
+    if elapsed < SLOW_SECS:
+        return
+
+    entry = dict( secs = round(elapsed, 6),
+                  function = calling_function(),
+                  statement = statement,
+                  parameters = _safe_params(parameters, statement, context),
+                  rowcount = cursor.rowcount if cursor.rowcount >= 0 else None )
+
+    if EXPLAIN and statement.lstrip()[:6].upper() == 'SELECT':
+        shape = statement_shape(statement)
+        with _explained_lock:
+            first = shape not in _explained and len(_explained) < MAX_EXPLAINED
+            _explained.add(shape)
+        if first:
+            entry['plan'] = explain(conn, statement, parameters)
+
+    log.warning(json.dumps(entry))
+
+def calling_function():
+    """Finds the function in eos_db.server that led to the statement being run.
+       Helpers like _create_thingy are skipped over in favour of the public
+       function that called them, if there is one.  Failing that, gives the
+       innermost function in any eos_db module.
+    """
+    from eos_db import server
+    #The wrapper that with_session puts round each function doesn't count.
+    wrappers = server.with_session.__code__.co_consts
+    frame = sys._getframe(2)
+    helper = fallback = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == server.__file__ and code not in wrappers:
+            if not code.co_name.startswith('_'):
+                return code.co_name
+            helper = helper or code.co_name
+        elif fallback is None and '/eos_db/' in code.co_filename and code.co_filename != __file__:
+            fallback = "%s:%s" % (code.co_filename.rsplit('/', 1)[-1], code.co_name)
+        frame = frame.f_back
+    return helper or fallback
+
+def _safe_params(parameters, statement='', context=None):
+    """Parameters fit for the log.  Any with a name that looks secret, as in
+       eos_db.capture, are replaced, and so is everything written to a table
+       with a name like that, such as the password hashes.  Positional
+       parameters get their names from the compiled statement, if there is one.
+    """
+    table = _WRITES_TO.match(statement)
+    if table and SECRET.search(table.group(1)):
+        names = None
+        secret = lambda name: True
+    else:
+        names = getattr(getattr(context, 'compiled', None), 'positiontup', None)
+        secret = lambda name: bool(name and SECRET.search(str(name)))
+
+    def safe(params):
+        if isinstance(params, dict):
+            return { k: SCRUBBED if secret(k) else _safe_param(v) for k, v in params.items() }
+        if isinstance(params, (list, tuple)):
+            #A list of parameter sets for executemany is cut short.
+            if params and isinstance(params[0], (list, tuple, dict)):
+                return [ safe(p) for p in params[:3] ]
+            if names and len(names) == len(params):
+                return [ SCRUBBED if secret(n) else _safe_param(p) for n, p in zip(names, params) ]
+            if secret(None):
+                return [ SCRUBBED ] * len(params)
+            return [ _safe_param(p) for p in params ]
+        return SCRUBBED if secret(None) else _safe_param(params)
+
+    return safe(parameters)
+
+def _safe_param(value):
+    if value is None or isinstance(value, (int, float, bool)):
+        return value
+    value = str(value)
+    return value if len(value) <= MAX_PARAM else value[:MAX_PARAM] + '...'
+
+def explain(conn, statement, parameters):
+    """Gets the query plan for a statement, as a list of lines.  This goes
+       straight to the DBAPI connection so the events don't fire again.
+    """
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif dialect == 'postgresql':
+        prefix = 'EXPLAIN '
+    else:
+        return None
+
+    try:
+        cursor = conn.connection.cursor()
+        try:
+            suffix = ''
+            if dialect == 'sqlite':
+                #SQLite does not re-prepare a cached EXPLAIN when the schema
+                #changes, so the plan would be stale after adding an index.
+                cursor.execute('PRAGMA schema_version')
+                suffix = ' /* schema %s */' % cursor.fetchone()[0]
+            cursor.execute(prefix + statement + suffix, parameters)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    except Exception as e:
+        return ["Could not get plan: %s" % e]
+
+    if dialect == 'sqlite':
+        #Rows are (id, parent, notused, detail)
+        return [ row[-1] for row in rows ]
+    return [ row[0] for row in rows ]
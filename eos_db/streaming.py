@@ -0,0 +1,81 @@
+"""Responses whose body is generated as it is sent.
+
+The big listings are streamed, so most of their SQL runs after the view, and
+every tween, has returned.  A tween that times or accounts for the request,
+or holds something for it, should use after_body() to finish up once the body
+has been generated, rather than when the handler returns.
+
+The WSGI server always calls close() on the body when it is done with it,
+whether or not it got to the end, and webob does the same when the body of a
+response is read, as /batch does.  But a body that is dropped
+unread, say because an outer tween replaced the response, is never closed.  So
+nothing should be left set on the thread waiting for close().  A tween that
+needs some state while the body is made, such as the config pin, should use
+during_body() to set it up around each step instead.
+"""
+
+import logging
+from contextlib import ExitStack
+
+from pyramid.response import Response
+
+log = logging.getLogger(__name__)
+
+class StreamedBody():
+    """Wraps the app_iter of a response, running callbacks when it is closed."""
+    def __init__(self, app_iter):
+        self.app_iter = app_iter
+        self.callbacks = []
+        self.contexts = []
+        self.closed = False
+
+    def __iter__(self):
+        it = iter(self.app_iter)
+        while True:
+            with ExitStack() as stack:
+                for context in self.contexts:
+                    stack.enter_context(context())
+                try:
+                    chunk = next(it)
+                except StopIteration:
+                    return
+            yield chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            #The innermost tween added its callback first, and finishes first.
+            for callback in self.callbacks:
+                try:
+                    callback()
+                except Exception:
+                    log.exception("Error finishing a streamed response")
+
+def stream_response(app_iter, **kwargs):
+    """A Response with a StreamedBody made from app_iter."""
+    return Response(app_iter=StreamedBody(app_iter), **kwargs)
+
+def after_body(response, callback):
+    """Calls callback once the body of response has been generated.  For a
+       streamed response that is when the body is closed, and for any other
+       response it is right now.
+    """
+    app_iter = getattr(response, 'app_iter', None)
+    if isinstance(app_iter, StreamedBody) and not app_iter.closed:
+        app_iter.callbacks.append(callback)
+    else:
+        callback()
+
+def during_body(response, context):
+    """Makes each chunk of a streamed response with context() entered, where
+       context is a function returning a context manager.  For any other
+       response there is nothing to do, as the body is already made.
+    """
+    app_iter = getattr(response, 'app_iter', None)
+    if isinstance(app_iter, StreamedBody) and not app_iter.closed:
+        app_iter.contexts.append(context)
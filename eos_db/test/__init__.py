@@ -0,0 +1,36 @@
+"""Shared set-up for the tests.
+"""
+from eos_db import server
+
+# Templates made by fresh_db(), by users and states.
+_templates = {}
+
+def fresh_db(*users):
+    """Like server.choose_engine("SQLite"), but with the given users already in
+       the database.  The database is copied from a template that is only made
+       the first time, which saves re-making the tables and, above all, hashing
+       the passwords for every test.
+    :param users: (group, username, password) for each user, created in order
+                  with the username as the handle and name too.  A handle and a
+                  name may be added on the end.
+    """
+    key = (users, tuple(server.get_state_list()))
+    if key not in _templates:
+        def populate():
+            for group, username, password, *details in users:
+                handle, name = details or (username, username)
+                user_id = server.create_user(group, handle, name, username)
+                server.touch_to_add_password(user_id, password)
+        _templates[key] = server.make_template(populate)
+    server.choose_engine("SQLite", template=_templates[key])
+
+def leave_fresh_db():
+    """For tearDown() in tests that use fresh_db() with users in it.  Some older
+       tests, such as test_unauthenticated_api, carry on with whatever DB was
+       there before and expect no administrator account, so put an empty one
+       back.
+    """
+    server.choose_engine("SQLite")
+
+ADMIN = ("administrators", "administrator", "adminpass")
+TESTUSER = ("users", "testuser", "asdf")
@@ -0,0 +1,79 @@
+"""Helpers for counting the SQL statements run by a piece of code, so that tests
+   can give each API call a budget and catch N+1 query patterns, where some
+   statement is run once for every user or server in the database.
+
+   with QueryCounter() as qc:
+       app.get('/servers')
+   print(qc.report())
+
+   Or in a test case that uses QueryBudgetMixin:
+
+   with self.assertQueryBudget(10, max_repeats=2):
+       app.get('/servers')
+"""
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import event
+
+from eos_db import server
+from eos_db.slowquery import statement_shape
+
+class QueryCounter():
+    """Context manager that records every statement executed against an engine,
+       by default whatever server.engine is on entry.
+    """
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        self.engine = self.engine or server.engine
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def shapes(self):
+        """Returns a Counter of how many times each statement shape was run."""
+        return Counter(statement_shape(s) for s in self.statements)
+
+    def repeated(self, max_repeats=1):
+        """Returns {shape: count} for shapes run more than max_repeats times.
+           These are the likely N+1 queries.
+        """
+        return { s: n for s, n in self.shapes().items() if n > max_repeats }
+
+    def report(self):
+        """A summary of the statements run, most repeated first."""
+        lines = [ "%i statements, %i distinct" % (self.count, len(self.shapes())) ]
+        for shape, n in self.shapes().most_common():
+            lines.append("%5i x %s" % (n, shape[:200]))
+        return '\n'.join(lines)
+
+class QueryBudgetMixin():
+    """Mixin for unittest.TestCase classes, providing assertQueryBudget().
+    """
+    @contextmanager
+    def assertQueryBudget(self, budget, max_repeats=None):
+        """Fails the test if the code in the with block runs more than budget
+           statements, or if any one statement shape is run more than max_repeats
+           times.
+        """
+        with QueryCounter() as qc:
+            yield qc
+
+        if qc.count > budget:
+            self.fail("Ran %i SQL statements, but the budget was %i.\n%s" %
+                      (qc.count, budget, qc.report()))
+
+        if max_repeats is not None and qc.repeated(max_repeats):
+            self.fail("Possible N+1 query - statements repeated more than %i times:\n%s" %
+                      (max_repeats, qc.report()))
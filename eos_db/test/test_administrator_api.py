@@ -4,7 +4,9 @@
 """
 import os
 import unittest
-from eos_db import server
+from unittest.mock import patch
+from eos_db import server, views
+from eos_db.test import fresh_db, ADMIN
 from webtest import TestApp
 from pyramid.paster import get_app
 from http.cookiejar import DefaultCookiePolicy
@@ -27,17 +29,11 @@ class TestAdminAPI(unittest.TestCase):
         #All auth via BasicAuth - never return the session cookie.
         self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
 
-        # This sets global var "engine" - in the case of SQLite this is a fresh RAM
-        # DB each time.  If we only did this on class instantiation the database would
-        # be dirty and one test could influence another.
+        # This gives us a fresh RAM DB each time, with the administrator account
+        # already in it.  If we only did this on class instantiation the database
+        # would be dirty and one test could influence another.
         # TODO - add a test that tests this.
-        server.choose_engine("SQLite")
-
-        # Punch in new administrator account with direct server call
-        # This will implicitly generate the tables.
-        user_id = server.create_user("administrators", "administrator", "administrator", "administrator")
-        #server.touch_to_add_user_group("administrator", "administrators")
-        server.touch_to_add_password(user_id, "adminpass")
+        fresh_db(ADMIN)
 
         self.app.authorization = ('Basic', ('administrator', 'adminpass'))
 
@@ -214,6 +210,74 @@ class TestAdminAPI(unittest.TestCase):
                                            'credit_change' : -100,
                                            'credit_balance' : 900 } )
 
+    def test_batch_credit(self):
+        """ A batch of calls is run in order, and by default a failed call
+            does not undo the ones before it.
+        """
+        self.create_user("testuser")
+
+        calls = [ dict(method='POST', path='/users/testuser/credit', params={'credit': 100}),
+                  dict(method='GET',  path='/users/notauser/credit'),
+                  dict(method='GET',  path='/users/testuser/credit') ]
+        res = self.app.post_json('/batch', calls).json
+
+        self.assertEqual([ r['status'] for r in res ], [200, 404, 200])
+        self.assertEqual(res[0]['body']['credit_balance'], 100)
+        self.assertEqual(res[2]['body']['credit_balance'], 100)
+
+    def test_batch_atomic(self):
+        """ With atomic=1, a failure anywhere in the batch rolls back
+            everything and gives a 409.
+        """
+        self.create_user("testuser")
+
+        calls = [ dict(method='POST', path='/users/testuser/credit', params={'credit': 100}),
+                  dict(method='POST', path='/users/notauser/credit', params={'credit': 100}) ]
+        res = self.app.post_json('/batch?atomic=1', calls, status=409).json
+        self.assertEqual([ r['status'] for r in res ], [200, 404])
+
+        response = self.app.get('/users/testuser/credit', status=200)
+        self.assertEqual(response.json['credit_balance'], 0)
+
+        #And when it all works the result is committed.
+        res = self.app.post_json('/batch?atomic=1', calls[:1]).json
+        response = self.app.get('/users/testuser/credit', status=200)
+        self.assertEqual(response.json['credit_balance'], 100)
+
+        #Making a user and a server is rolled back too.
+        calls = [ dict(method='PUT', path='/users/newuser',
+                       params={'type': 'users', 'handle': 'new@example.com', 'name': 'New'}),
+                  dict(method='PUT', path='/servers/newserver', params={'uuid': 'newuuid'}),
+                  calls[1] ]
+        res = self.app.post_json('/batch?atomic=1', calls, status=409).json
+        self.assertEqual([ r['status'] for r in res ], [200, 200, 404])
+        self.app.get('/users/newuser', status=404)
+        self.app.get('/servers/newserver', status=404)
+
+    def test_batch_bad(self):
+        """ Malformed batches are rejected, and so are batches within batches.
+        """
+        self.app.post_json('/batch', {'path': '/user'}, status=400)
+        self.app.post_json('/batch', [{'method': 'GET'}], status=400)
+
+        res = self.app.post_json('/batch', [dict(method='POST', path='/batch'),
+                                            dict(method='POST', path='/batch?atomic=1')]).json
+        self.assertEqual([ r['status'] for r in res ], [400, 400])
+
+        with patch.object(views, 'BATCH_MAX_CALLS', 2):
+            self.app.post_json('/batch', [dict(path='/user')] * 3, status=400)
+            self.app.post_json('/batch', [dict(path='/user')] * 2, status=200)
+
+    def test_batch_error(self):
+        """ An internal error in a call is logged, but the details are not
+            sent back.
+        """
+        self.create_user("testuser")
+        with patch.object(server, 'check_credit', side_effect=RuntimeError("SELECT secrets")):
+            with self.assertLogs('eos_db.views', 'ERROR'):
+                res = self.app.post_json('/batch', [dict(path='/users/testuser/credit')]).json
+        self.assertEqual(res, [dict(status=500, body="Internal server error")])
+
 
 ###############################################################################
 # Support Functions, calling server admin views                               #
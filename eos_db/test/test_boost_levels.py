@@ -143,6 +143,28 @@ class TestBoostLevels(unittest.TestCase):
 
         self.assertEqual(get_avail(), [1,0,0])
 
+    def test_level_index(self):
+        """The index gives the same answers as looping over the levels did,
+           even when the levels are not in order, and follows set_config().
+        """
+        levels = [ dict(label='a', cores=4, ram=10, cost=1),
+                   dict(label='b', cores=2, ram=40, cost=2),
+                   dict(label='c', cores=8, ram=20, cost=5),
+                   dict(label='d', cores=4, ram=10, cost=7) ]
+        index = server.LevelIndex(levels)
+        for cores in range(0, 12):
+            for ram in range(0, 50, 5):
+                met = max([ i for i, l in enumerate(levels)
+                            if cores >= l['cores'] and ram >= l['ram'] ], default=-1)
+                self.assertEqual(index.level_met(cores, ram), met)
+        self.assertEqual(index.match(4, 10), 3)
+        self.assertEqual(index.match(4, 20), None)
+        self.assertFalse(server.LevelIndex([]).is_boosted(100, 100))
+
+        server.set_config(self._get_conf_for_test())
+        self.assertEqual(server._deboost_credits((8, 25), 2), 6)
+        self.assertTrue(server._spec_is_boosted((2, 10)))
+        self.assertFalse(server._spec_is_boosted((1, 10)))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,103 @@
+"""Tests for the traffic capture tween.
+"""
+import os
+import json
+import unittest
+import tempfile
+import time
+import eos_db
+from eos_db import capture
+from eos_db.streaming import stream_response
+from pyramid.request import Request
+from eos_db.test import fresh_db, leave_fresh_db, TESTUSER
+from webtest import TestApp
+from pyramid.paster import get_appsettings
+
+# Depend on test.ini in the same dir as this file.
+test_ini = os.path.join(os.path.dirname(__file__), 'test.ini')
+
+class TestCapture(unittest.TestCase):
+    """Tests what is saved, and what is not.
+    """
+    def setUp(self):
+        """Launch app using webtest with test settings, plus a capture file."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.capture_file = os.path.join(self.tmpdir.name, 'capture.jsonl')
+        settings = dict(get_appsettings(test_ini))
+        settings['capture.file'] = self.capture_file
+        self.app = TestApp(eos_db.main({'__file__': test_ini}, **settings))
+
+        fresh_db(TESTUSER)
+
+    def tearDown(self):
+        capture.close()
+        capture.configure({})
+        self.tmpdir.cleanup()
+        leave_fresh_db()
+
+    def _records(self):
+        capture.close()
+        with open(self.capture_file) as fh:
+            text = fh.read()
+        return text, [ json.loads(l) for l in text.splitlines() ]
+
+    def test_capture(self):
+        """Routes, auth methods and groups are saved, and credentials are not."""
+        self.app.get('/boostlevels')
+
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+        self.app.get('/user')
+        self.app.authorization = None
+        #Now using the cookie.
+        self.app.get('/user?foo=bar')
+        self.app.put('/user/password', dict(password='newsecretpass'))
+        self.app.post_json('/batch', [ dict(method='GET', path='/user'),
+                                       dict(method='PUT', path='/user/password',
+                                            params=dict(password='othersecretpass')) ])
+
+        self.app.reset()
+        self.app.authorization = ('Basic', ('agent', 'sharedsecret'))
+        self.app.get('/deboost_jobs')
+
+        text, recs = self._records()
+        self.assertNotIn('asdf', text)
+        self.assertNotIn('secretpass', text)
+        self.assertNotIn('sharedsecret', text)
+        self.assertNotIn('auth_tkt', text)
+
+        self.assertEqual([ (r['method'], r['route'], r['auth'], r['identity']) for r in recs ],
+                         [ ('GET', 'boostlevels', None, None),
+                           ('GET', 'my_user', 'basic', 'users'),
+                           ('GET', 'my_user', 'cookie', 'users'),
+                           ('PUT', 'my_password', 'cookie', 'users'),
+                           ('POST', 'batch', 'cookie', 'users'),
+                           ('GET', 'deboosts', 'basic', 'agents') ])
+        self.assertEqual(recs[2]['params'], [['foo', 'bar']])
+        self.assertEqual(recs[3]['params'], [['password', capture.SCRUBBED]])
+        self.assertEqual(recs[4]['json'][1]['params'], dict(password=capture.SCRUBBED))
+        self.assertEqual([ r['status'] for r in recs ], [200] * 6)
+        self.assertTrue(all( r['ms'] > 0 for r in recs ))
+        self.assertEqual([ r['t'] for r in recs ], sorted( r['t'] for r in recs ))
+
+    def test_streamed(self):
+        """The time for a streamed listing includes making the body."""
+        def body():
+            time.sleep(0.05)
+            yield b'[]'
+
+        tween = capture.capture_tween_factory(lambda request: stream_response(body()),
+                                              self.app.app.registry)
+        response = tween(Request.blank('/servers'))
+        self.assertEqual(response.body, b'[]')
+
+        text, recs = self._records()
+        self.assertEqual(len(recs), 1)
+        self.assertTrue(recs[0]['ms'] >= 50)
+
+    def test_scrub(self):
+        self.assertEqual(capture.scrub(dict(a=[dict(Password='x', b=1)], api_key='y', c='z')),
+                         dict(a=[dict(Password=capture.SCRUBBED, b=1)],
+                              api_key=capture.SCRUBBED, c='z'))
+
+if __name__ == '__main__':
+    unittest.main()
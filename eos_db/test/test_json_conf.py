@@ -80,3 +80,34 @@ class TestJSONConf(unittest.TestCase):
                 e = _e
         self.assertEqual(j, None)
         self.assertEqual(e.__class__, ValueError)
+
+class TestJSONLoader(unittest.TestCase):
+    """Tests the regex comment stripper against the original, and the cache.
+    """
+    def test_same_as_charwise(self):
+        from eos_db.json_loader import strip_comments
+        from eos_db.perf.jsonbench import charwise_strip, make_settings
+        for text in ( make_settings(25),
+                      '{"a": "\\"// /*", /* x\n y */ "b": [1, 2] // z\n}\n',
+                      '{"a": 1 /* never closed\n}' ):
+            self.assertEqual(strip_comments(text), charwise_strip(text))
+
+    def test_cache(self):
+        from tempfile import TemporaryDirectory
+        from eos_db.json_loader import parse_json_file
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'x.settings.json')
+            with open(filename, 'w') as fh:
+                fh.write('{"a": 1} // one')
+            j = parse_json_file(filename)
+            self.assertEqual(parse_json_file(filename), j)
+
+            #Each caller gets a copy, so changing one doesn't change the cache.
+            j['a'] = 3
+            self.assertEqual(parse_json_file(filename), {"a": 1})
+
+            #Same size, but a new mtime.
+            with open(filename, 'w') as fh:
+                fh.write('{"a": 2} // two')
+            os.utime(filename, ns=(1, 1))
+            self.assertEqual(parse_json_file(filename), {"a": 2})
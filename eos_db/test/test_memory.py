@@ -0,0 +1,83 @@
+"""Tests for the tracemalloc calls under /memory.
+"""
+import os
+import unittest
+from eos_db import memory
+from eos_db.test import fresh_db, leave_fresh_db, ADMIN, TESTUSER
+from webtest import TestApp
+from pyramid.paster import get_app
+from http.cookiejar import DefaultCookiePolicy
+
+# Depend on test.ini in the same dir as this file.
+test_ini = os.path.join(os.path.dirname(__file__), 'test.ini')
+
+_hogged = []
+def _hog():
+    """Hold on to a few MB in lots of small pieces."""
+    _hogged.extend( bytearray(1000) for n in range(5000) )
+
+class TestMemory(unittest.TestCase):
+    """Tests starting and stopping tracemalloc and reading snapshots.
+    """
+    def setUp(self):
+        """Launch app using webtest with test settings"""
+        self.appconf = get_app(test_ini)
+        self.app = TestApp(self.appconf)
+        self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        fresh_db(ADMIN, TESTUSER)
+
+    def tearDown(self):
+        memory.stop()
+        memory.clear_snapshots()
+        del _hogged[:]
+        leave_fresh_db()
+
+    def test_snapshot_diff(self):
+        """The growth between two snapshots is put down to the right line."""
+        self.app.authorization = ('Basic', ('administrator', 'adminpass'))
+        self.app.post('/memory/snapshots', status=409)
+
+        res = self.app.post('/memory/start').json
+        self.assertTrue(res['tracing'])
+        self.assertEqual(res['frames'], 1)
+
+        before = self.app.post('/memory/snapshots').json['id']
+        _hog()
+        after = self.app.post('/memory/snapshots').json['id']
+        self.assertEqual([ s['id'] for s in self.app.get('/memory/snapshots').json ],
+                         [before, after])
+
+        growth = self.app.get('/memory/snapshots/%s?base=%s&limit=5' % (after, before)).json
+        self.assertTrue(len(growth) <= 5)
+        self.assertTrue(growth[0]['file'].endswith('test_memory.py'))
+        self.assertTrue(growth[0]['size_diff'] > 4000000)
+        self.assertTrue(growth[0]['count_diff'] >= 5000)
+
+        by_file = self.app.get('/memory/snapshots/%s?group_by=filename' % after).json
+        self.assertNotIn('line', by_file[0])
+        self.assertNotIn('size_diff', by_file[0])
+
+        self.app.get('/memory/snapshots/%s?group_by=nonsense' % after, status=400)
+        self.app.get('/memory/snapshots/nosuchsnapshot', status=404)
+
+        res = self.app.post('/memory/stop').json
+        self.assertFalse(res['tracing'])
+        #Snapshots outlive tracing.
+        self.assertEqual(len(self.app.get('/memory').json['snapshots']), 2)
+
+    def test_max_snapshots(self):
+        memory.start()
+        ids = [ memory.take_snapshot() for n in range(memory.MAX_SNAPSHOTS + 2) ]
+        self.assertEqual([ s['id'] for s in memory.list_snapshots() ],
+                         ids[-memory.MAX_SNAPSHOTS:])
+
+    def test_not_admin(self):
+        """Other users can't trace memory."""
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+        self.app.get('/memory', status=401)
+        self.app.post('/memory/start', status=401)
+        self.assertFalse(memory.status()['tracing'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""Tests for the /metrics call and the counters behind it.
+"""
+import os
+import unittest
+import eos_db
+import threading
+from eos_db import server, metrics
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from eos_db.test import fresh_db, leave_fresh_db, ADMIN, TESTUSER
+from webtest import TestApp
+from pyramid.paster import get_appsettings
+from http.cookiejar import DefaultCookiePolicy
+
+# Depend on test.ini in the same dir as this file.
+test_ini = os.path.join(os.path.dirname(__file__), 'test.ini')
+
+@server.with_session
+def _forgetful(artifact_id, session):
+    """Calls another DB function without passing the session through."""
+    return server.check_state(artifact_id)
+
+@server.with_session
+def _careful(artifact_id, session):
+    return server.check_state(artifact_id, session=session)
+
+class TestMetrics(unittest.TestCase):
+    """Tests the metrics collected by the tween and SQL listeners.
+    """
+    def setUp(self):
+        """Launch app using webtest with test settings"""
+        settings = dict(get_appsettings(test_ini))
+        settings['metrics.enabled'] = 'true'
+        self.app = TestApp(eos_db.main({'__file__': test_ini}, **settings))
+        self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        fresh_db(ADMIN, TESTUSER)
+        metrics.reset()
+
+    def tearDown(self):
+        leave_fresh_db()
+
+    def test_off_by_default(self):
+        """Without metrics.enabled nothing is listening to the SQL."""
+        eos_db.main({'__file__': test_ini}, **get_appsettings(test_ini))
+        self.assertFalse(metrics.ENABLED)
+        self.assertFalse(event.contains(Engine, 'after_cursor_execute',
+                                        metrics._after_cursor_execute))
+
+    def _get_metrics(self):
+        """Fetch /metrics as admin and parse it into a dict of {line_key: value}."""
+        self.app.authorization = ('Basic', ('administrator', 'adminpass'))
+        r = self.app.get('/metrics')
+        self.assertTrue(r.content_type.startswith('text/plain'))
+
+        res = {}
+        for l in r.text.splitlines():
+            if not l.startswith('#'):
+                k, v = l.rsplit(' ', 1)
+                res[k] = float(v)
+        return res
+
+    def test_metrics_admin_only(self):
+        """Only administrators can see the metrics."""
+        self.app.get('/metrics', status=401)
+
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+        self.app.get('/metrics', status=401)
+
+        self._get_metrics()
+
+    def test_route_counts(self):
+        """Requests are counted by route and status, along with the SQL they run."""
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+        for n in range(3):
+            self.app.get('/user')
+        self.app.get('/servers/noserver', status=404)
+        self.app.get('/boostlevels')
+
+        m = self._get_metrics()
+
+        self.assertEqual(m['eos_requests_total{route="my_user",status="200"}'], 3)
+        self.assertEqual(m['eos_requests_total{route="server",status="404"}'], 1)
+        self.assertEqual(m['eos_request_duration_seconds_count{route="my_user"}'], 3)
+        self.assertEqual(m['eos_request_duration_seconds_bucket{route="my_user",le="+Inf"}'], 3)
+        self.assertTrue(m['eos_sql_statements_total{route="my_user"}'] >= 3)
+        self.assertTrue(m['eos_sql_seconds_total{route="my_user"}'] > 0)
+
+        #With no DB config there is no capacity table, so no SQL is needed.
+        self.assertEqual(m['eos_sql_statements_total{route="boostlevels"}'], 0)
+
+        #The metrics call itself is in progress.
+        self.assertEqual(m['eos_requests_in_progress'], 1)
+        self.assertEqual(m['eos_thread_requests_in_progress{thread="%s"}' %
+                           threading.current_thread().name], 1)
+
+    def test_streamed_listing(self):
+        """The SQL a streamed listing runs as its body is sent is counted, so
+           it grows with the number of servers.
+        """
+        old_chunk, server.STREAM_CHUNK = server.STREAM_CHUNK, 5
+        try:
+            counts = []
+            for fleet_size in (3, 30):
+                while len(server.list_artifacts_for_user(None)) < fleet_size:
+                    n = len(server.list_artifacts_for_user(None))
+                    server.create_appliance("vm%i" % n, "uuid%i" % n)
+                metrics.reset()
+                #The agent sees all the servers.
+                self.app.authorization = ('Basic', ('agent', 'sharedsecret'))
+                self.assertEqual(len(self.app.get('/servers').json), fleet_size)
+                counts.append(self._get_metrics()['eos_sql_statements_total{route="servers"}'])
+        finally:
+            server.STREAM_CHUNK = old_chunk
+
+        self.assertTrue(counts[1] > counts[0] > 1)
+
+    def test_histogram_buckets(self):
+        """The histogram buckets must be cumulative, ending with the total."""
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+        self.app.get('/user')
+        self.app.get('/user')
+
+        self.app.authorization = ('Basic', ('administrator', 'adminpass'))
+        text = self.app.get('/metrics').text
+        buckets = [ int(l.rsplit(' ', 1)[1]) for l in text.splitlines()
+                    if l.startswith('eos_request_duration_seconds_bucket{route="my_user"') ]
+
+        self.assertEqual(len(buckets), len(metrics.BUCKETS) + 1)
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], 2)
+
+    def test_sessions(self):
+        """Sessions opened are counted by route, and DB functions are timed."""
+        vm_id = server.create_appliance("testvm", "testuuid")
+        server.touch_to_add_ownership(vm_id, server.get_user_id_from_name("testuser"))
+
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+        self.app.get('/servers/testvm')
+        m = self._get_metrics()
+
+        self.assertTrue(m['eos_sessions_opened_total{route="server"}'] >= 1)
+        self.assertTrue(m['eos_db_function_calls_total{function="check_password"}'] >= 1)
+        self.assertTrue(m['eos_db_function_seconds_total{function="check_password"}'] > 0)
+        self.assertEqual(m['eos_db_function_max_depth{function="_get_server_id_from_name"}'], 1)
+
+    def test_nested_sessions(self):
+        """A function that opens its own session inside another is flagged."""
+        vm_id = server.create_appliance("testvm", "testuuid")
+        metrics.reset()
+
+        _forgetful(vm_id)
+        m = self._get_metrics()
+        self.assertEqual(m['eos_db_function_sessions_total{function="check_state"}'], 1)
+        self.assertEqual(m['eos_db_function_nested_sessions_total{function="check_state"}'], 1)
+        self.assertEqual(m['eos_db_function_nested_sessions_total{function="_forgetful"}'], 0)
+        self.assertEqual(m['eos_db_function_max_depth{function="check_state"}'], 2)
+
+        _careful(vm_id)
+        m = self._get_metrics()
+        self.assertEqual(m['eos_db_function_calls_total{function="check_state"}'], 2)
+        self.assertEqual(m['eos_db_function_sessions_total{function="check_state"}'], 1)
+        self.assertEqual(m['eos_db_function_nested_sessions_total{function="check_state"}'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,301 @@
+"""Tests for the performance tools in eos_db.perf.  These only check that the
+tools work, on tiny fleets, not how fast anything is.
+"""
+import io
+import os
+import unittest
+import tempfile
+import requests
+import eos_db
+from time import perf_counter
+from eos_db import server, capture
+from datetime import datetime, timedelta
+from webtest.http import StopableWSGIServer
+from eos_db.perf import fleet, bench, loadtest, explain, simulate, latency, replay
+
+class TestPerf(unittest.TestCase):
+
+    def setUp(self):
+        server.choose_engine("SQLite")
+        server.set_config(dict(BoostLevels=dict(bench.BOOST_LEVELS)))
+
+    def tearDown(self):
+        #Don't leave the boost levels or a temp DB file set for other tests.
+        server.set_config(dict(BoostLevels=dict(
+                baseline=dict(label='Default', cores=1, ram=2) )))
+        server.choose_engine("SQLite")
+
+    def test_build_fleet(self):
+        """The fleet should be visible through the server API."""
+        f = fleet.build_fleet(3, 25, 10, seed=1)
+
+        self.assertEqual(len(f.user_ids), 3)
+        self.assertEqual(len(f.server_ids), 25)
+        self.assertTrue(server.check_password(f.usernames[0], fleet.PASSWORD))
+
+        #Server 19 re-used a name, so one earlier server is masked.
+        live = set()
+        for user_id in f.user_ids:
+            live.update( s['artifact_id'] for s in server.list_artifacts_for_user(user_id) )
+        self.assertEqual(len(live), 24)
+        self.assertEqual(server.get_server_id_from_name(f.server_names[19]), f.server_ids[19])
+
+        #Nobody should have gone into debt paying for boosts.
+        for user_id in f.user_ids:
+            self.assertTrue(server.check_credit(user_id) >= 0)
+
+        #Same seed, same fleet.
+        server.choose_engine("SQLite")
+        f2 = fleet.build_fleet(3, 25, 10, seed=1)
+        self.assertEqual(f2.server_names, f.server_names)
+        self.assertEqual(f2.touches, f.touches)
+
+    def test_seed_fleet(self):
+        """The bulk-loaded fleet should look the same through the server API as
+           one built with the API, and should carry on after existing records.
+        """
+        old_user = server.create_user("users", "old@example.com", "Old", "old")
+        old_vm = server.create_appliance("oldvm", "olduuid")
+
+        f = fleet.seed_fleet(4, 40, 30, years=2, seed=3, batch_size=100)
+        self.assertEqual(len(f.user_ids), 4)
+        self.assertTrue(min(f.user_ids) > old_user)
+        self.assertTrue(min(f.server_ids) > old_vm)
+
+        #Everyone can log in, and is in a group.
+        self.assertTrue(server.check_password(f.usernames[1], fleet.PASSWORD))
+        self.assertEqual(server.get_user_group(f.usernames[0]), 'administrators')
+        self.assertEqual(server.get_user_group(f.usernames[1]), 'users')
+
+        #Credit was checked before boosting.
+        for user_id in f.user_ids:
+            self.assertTrue(server.check_credit(user_id) >= 0)
+
+        #Servers 19 and 39 re-used names, so each masks an earlier server.
+        self.assertEqual(server.get_server_id_from_name(f.server_names[19]), f.server_ids[19])
+        live = set()
+        for user_id in f.user_ids:
+            live.update( s['artifact_id'] for s in server.list_artifacts_for_user(user_id) )
+        self.assertEqual(len(live), 38)
+
+        #Any server still boosted has a deboost to come.
+        for server_id in live:
+            if server._get_server_boost_status(server_id):
+                self.assertTrue(server.get_time_until_deboost(server_id)[1] > 0)
+
+        #The history goes back over a year, in order.
+        touches = list(server.iter_touches(artifact_id=f.server_ids[0]))
+        self.assertEqual(touches, sorted(touches, key=lambda t: t['touch_dt']))
+        self.assertTrue(len(touches) > 10)
+
+    def test_seed_empty(self):
+        """Seeding a database that has never been set up works too."""
+        server.override_engine('sqlite://', echo=False)
+        f = fleet.seed_fleet(1, 3, 5, seed=4)
+        self.assertTrue(server.check_state(f.server_ids[0]))
+
+    def test_bench(self):
+        """Run the benchmarks on a tiny fleet and compare the results."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            res = bench.run(['2x4x3'], repeat=1, workdir=tmpdir)
+
+        funcs = res['sizes']['2x4x3']['functions']
+        self.assertEqual(len(funcs), 7)
+        self.assertIn('list_servers_by_state', funcs)
+        self.assertTrue(funcs['check_credit']['min'] > 0)
+
+        #Nothing is slower than itself, but everything is slower than zero time.
+        self.assertEqual(bench.compare(res, res), [])
+        fast = { 'sizes': { '2x4x3': { 'functions': {
+                    k: dict(v, median=v['median'] / 10) for k, v in funcs.items() } } } }
+        self.assertEqual(len(bench.compare(res, fast)), len(funcs))
+
+    def test_percentile(self):
+        times = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(times, 50), 50)
+        self.assertEqual(loadtest.percentile(times, 99), 99)
+        self.assertEqual(loadtest.percentile([5], 95), 5)
+        self.assertEqual(loadtest.percentile([], 95), None)
+
+    def test_loadtest(self):
+        """A short load test under waitress should work with no errors.
+           An in-memory DB is not shared between threads, so use a file.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            server.override_engine('sqlite:///%s/loadtest.sqlite' % tmpdir, echo=False)
+            server.setup_states()
+            f = fleet.build_fleet(2, 6, 3)
+            res = loadtest.run(dict(portal=1, script=1, agent=1), 1, f, threads=2)
+
+        routes = res['routes']
+        self.assertIn('GET /boostlevels', routes)
+        self.assertIn('GET /deboost_jobs', routes)
+        self.assertEqual(routes['ALL']['errors'], 0)
+        self.assertEqual(routes['ALL']['requests'],
+                         sum(r['requests'] for k, r in routes.items() if k != 'ALL'))
+        self.assertTrue(routes['ALL']['p50'] <= routes['ALL']['p99'])
+
+    def test_explain(self):
+        """The hot queries use indexes, and losing one is caught."""
+        fleet.seed_fleet(5, 60, 30, seed=2)
+
+        out = io.StringIO()
+        self.assertEqual(explain.report(out=out), 0)
+        names = set( r['name'] for r in explain.explain_all() )
+        self.assertEqual(names, set(explain.HOT_QUERIES))
+
+        #Without the index on touch.artifact_id the state lookup scans touch.
+        server.engine.execute("DROP INDEX ix_touch_artifact_id")
+        res = explain.explain_all(['state'])
+        self.assertEqual([ r["scans"] for r in res ], [["touch"]])
+        self.assertEqual(explain.report(['state'], out=out), 1)
+
+        #The report says it's missing, but doesn't put it back, and nor does
+        #setup_states().
+        self.assertIn("ix_touch_artifact_id on touch", out.getvalue())
+        server.setup_states()
+        self.assertEqual([ i.name for i in server.missing_indexes() ], ['ix_touch_artifact_id'])
+
+        #That is left to create_indexes().
+        self.assertEqual(server.create_indexes(), ['ix_touch_artifact_id'])
+        self.assertEqual(server.missing_indexes(), [])
+        self.assertEqual(server.create_indexes(), [])
+        out = io.StringIO()
+        self.assertEqual(explain.report(['state'], out=out), 0)
+        self.assertNotIn("missing", out.getvalue())
+
+    def test_clock(self):
+        """Deboost times follow the clock set in the server module."""
+        clock = simulate.SimClock(datetime(2030, 6, 1))
+        server.set_clock(clock)
+        try:
+            vm_id = server.create_appliance("clockvm", "clockuuid")
+            server.touch_to_add_specification(vm_id, 2, 40)
+            server.touch_to_add_deboost(vm_id, 2)
+            self.assertEqual(server.get_time_until_deboost(vm_id)[0], datetime(2030, 6, 1, 2))
+            self.assertEqual(server.get_time_until_deboost(vm_id)[1], 7200)
+
+            clock.advance(3 * 3600)
+            self.assertEqual(server.get_time_until_deboost(vm_id)[1], -3600)
+            touch = list(server.iter_touches(artifact_id=vm_id))[-1]
+            self.assertTrue(str(touch['touch_dt']).startswith('2030-06-01'))
+        finally:
+            server.set_clock()
+        self.assertTrue(abs(server.now() - datetime.now()) < timedelta(seconds=5))
+
+    def test_simulate(self):
+        """A couple of simulated days on a tiny fleet."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            res = simulate.run(days=2, users=3, servers=10, poll_minutes=30,
+                               boosts_per_day=2, workdir=tmpdir)
+
+        self.assertEqual([ d['day'] for d in res ], [1, 2])
+        self.assertTrue(res[1]['touches'] > res[0]['touches'])
+        self.assertEqual(res[0]['polls'], 48)
+        self.assertTrue(sum( d['boosts'] for d in res ) > 0)
+        self.assertTrue(sum( d['agent_deboosts'] for d in res ) > 0)
+        #Nothing is picked up later than the next poll, plus the time it took.
+        for d in res:
+            self.assertTrue(0 <= d['late_secs_max'] < 30 * 60 + 60)
+            self.assertEqual(d['missed'], 0)
+        #And the real clock is back.
+        self.assertTrue(server.now().year >= 2024)
+
+    def test_latency(self):
+        """Round trips are counted and each one is delayed."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lat = latency.override_engine('sqlite:///%s/latency.sqlite' % tmpdir, rtt_ms=2)
+            try:
+                server.setup_states()
+                vm_id = server.create_appliance("latencyvm", "latencyuuid")
+
+                lat.reset()
+                start = perf_counter()
+                server.check_state(vm_id)
+                elapsed = perf_counter() - start
+                self.assertEqual(lat.transactions, 1)
+                self.assertTrue(lat.statements >= 1)
+                self.assertEqual(lat.round_trips, lat.statements + 2)
+                self.assertTrue(elapsed >= lat.round_trips * 0.002)
+                self.assertAlmostEqual(lat.delay, lat.round_trips * 0.002)
+            finally:
+                lat.detach()
+
+            res = latency.run(rtts=(0, 2), size='2x4x3', repeat=1, workdir=tmpdir)
+
+        self.assertIn('GET /deboost_jobs', res)
+        for label, r in res.items():
+            self.assertTrue(r['round_trips'] > 0)
+            self.assertTrue(r['secs']['2'] >= r['round_trips'] * 0.002)
+            self.assertTrue(r['secs_per_rtt_ms'] > 0)
+        self.assertAlmostEqual(latency.slope({'0': 0.01, '1': 0.03, '2': 0.05}), 0.02)
+
+    def test_replay(self):
+        """Capture some traffic and play it back at the same server."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            server.override_engine('sqlite:///%s/replay.sqlite' % tmpdir, echo=False)
+            server.setup_states()
+            f = fleet.build_fleet(2, 6, 3)
+            capture_file = os.path.join(tmpdir, 'capture.jsonl')
+            app = eos_db.main({'__file__': os.path.join(tmpdir, 'replay.ini')},
+                              **{ 'server': 'SQLite',
+                                  'authtkt.secret': 'replay',
+                                  'agent.secret': loadtest.AGENT_SECRET,
+                                  'capture.file': capture_file })
+
+            httpd = StopableWSGIServer.create(app, host='127.0.0.1', threads=2)
+            try:
+                self.assertTrue(httpd.wait())
+                url = httpd.application_url.rstrip('/')
+                username = f.usernames[1]
+                group = server.get_user_group(username)
+
+                portal = requests.Session()
+                portal.get(url + '/user', auth=(username, fleet.PASSWORD))
+                portal.put(url + '/user/password',
+                           data=dict(password=fleet.PASSWORD)).raise_for_status()
+                for n in range(3):
+                    portal.get(url + '/servers').raise_for_status()
+                    portal.get(url + '/boostlevels').raise_for_status()
+                requests.get(url + '/deboost_jobs',
+                             auth=('agent', loadtest.AGENT_SECRET)).raise_for_status()
+                capture.close()
+
+                records = replay.load(capture_file)
+                self.assertEqual(len(records), 9)
+                self.assertEqual(records[0]['auth'], 'basic')
+                self.assertEqual(records[1]['auth'], 'cookie')
+
+                #With no agent credentials, the agent call is skipped.
+                replayer = replay.Replayer(url, {group: (username, fleet.PASSWORD)},
+                                           speed=0, threads=2)
+                results = replayer.run(records)
+                self.assertEqual(replayer.skipped, 1)
+                #The password change was scrubbed, so it is not replayed.
+                self.assertEqual(replayer.scrubbed, 1)
+                routes = replay.compare(results)
+                self.assertEqual(routes['ALL']['requests'], 7)
+                self.assertEqual(routes['ALL']['status_changed'], 0)
+                self.assertEqual(routes['GET servers']['requests'], 3)
+                self.assertTrue(routes['GET servers']['replayed_p50'] > 0)
+                self.assertIn('GET servers', replay.format_report(routes))
+
+                #At double speed, the replay takes about half as long as the original.
+                creds = replay.parse_auth('%s=%s:%s,agents=agent:%s' % (
+                        group, username, fleet.PASSWORD, loadtest.AGENT_SECRET))
+                replayer = replay.Replayer(url, creds, speed=2, threads=2)
+                results = replayer.run(records)
+                self.assertEqual(len(results), 8)
+                self.assertTrue(replayer.elapsed >= (records[-1]['t'] - records[0]['t']) / 2)
+            finally:
+                httpd.shutdown()
+                capture.close()
+                capture.configure({})
+
+    def test_scans(self):
+        self.assertEqual(explain.scans(["SCAN touch", "SEARCH resource USING INDEX x"]), ['touch'])
+        self.assertEqual(explain.scans(["Seq Scan on resource resource_1  (cost=0.00..1.01)"]), ['resource'])
+        self.assertEqual(explain.scans(["SCAN touchy_table", "SCAN artifact"]), [])
+
+if __name__ == '__main__':
+    unittest.main()
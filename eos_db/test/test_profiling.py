@@ -0,0 +1,157 @@
+"""Tests for profiling requests with the X-EOS-Profile header.
+"""
+import os
+import cProfile
+import pstats
+import unittest
+import threading
+from base64 import b64encode
+from time import sleep, perf_counter
+from eos_db import profiling
+from eos_db.streaming import stream_response
+from pyramid.request import Request
+from eos_db.test import fresh_db, leave_fresh_db, ADMIN, TESTUSER
+from webtest import TestApp
+from pyramid.paster import get_app
+from http.cookiejar import DefaultCookiePolicy
+
+# Depend on test.ini in the same dir as this file.
+test_ini = os.path.join(os.path.dirname(__file__), 'test.ini')
+
+def _leaf(n):
+    return sum(range(n))
+
+def _middle(n):
+    return _leaf(n) + _leaf(n)
+
+class TestProfiling(unittest.TestCase):
+    """Tests the profiling tween and the /profiles calls.
+    """
+    def setUp(self):
+        """Launch app using webtest with test settings"""
+        self.appconf = get_app(test_ini)
+        self.app = TestApp(self.appconf)
+        self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        fresh_db(ADMIN, TESTUSER)
+
+    def tearDown(self):
+        leave_fresh_db()
+
+    def test_profile_request(self):
+        """An admin can profile a request and fetch the result."""
+        self.app.authorization = ('Basic', ('administrator', 'adminpass'))
+        r = self.app.get('/users', headers={'X-EOS-Profile': '1'})
+        profile_id = r.headers['X-EOS-Profile-Id']
+        self.assertEqual(r.json[0]['username'], 'administrator')
+
+        listing = self.app.get('/profiles').json
+        self.assertIn(dict(id=profile_id, request='GET /users 200 OK'), listing)
+
+        stacks = self.app.get('/profiles/' + profile_id).text
+        #The listing is streamed, so the user lookups are in the profile.
+        self.assertIn('retrieve_users', stacks)
+        self.assertIn('iter_user_details', stacks)
+        for l in stacks.splitlines():
+            self.assertTrue(int(l.rsplit(' ', 1)[1]) > 0)
+
+        stats = self.app.get('/profiles/%s?format=stats' % profile_id).text
+        self.assertIn('function calls', stats)
+
+        self.app.get('/profiles/nosuchprofile', status=404)
+
+    def test_streamed(self):
+        """A streamed body is profiled as it is sent, not read up front."""
+        def body():
+            yield b'['
+            yield str(_middle(1000)).encode()
+            yield b']'
+
+        tween = profiling.profile_tween_factory(lambda request: stream_response(body()),
+                                                self.app.app.registry)
+        request = Request.blank('/servers', headers={'X-EOS-Profile': '1'})
+        request.registry = self.app.app.registry
+        request.authorization = ('Basic', b64encode(b'administrator:adminpass').decode())
+        response = tween(request)
+        profile_id = response.headers['X-EOS-Profile-Id']
+        self.assertIsNone(profiling.get_profile(profile_id))
+
+        self.assertEqual(response.body, b'[999000]')
+        description, stats = profiling.get_profile(profile_id)
+        self.assertEqual(description, 'GET /servers 200 OK')
+        self.assertIn(':_middle:', profiling.collapsed_stacks(stats))
+
+    def test_not_admin(self):
+        """Other users get a normal response, and can't see profiles."""
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+        r = self.app.get('/user', headers={'X-EOS-Profile': '1'})
+        self.assertNotIn('X-EOS-Profile-Id', r.headers)
+
+        self.app.get('/profiles', status=401)
+
+    def test_collapsed_stacks(self):
+        """Stacks are rebuilt from the calls cProfile saw."""
+        profiler = cProfile.Profile()
+        profiler.runcall(_middle, 200000)
+        stacks = profiling.collapsed_stacks(pstats.Stats(profiler))
+
+        lines = dict( l.rsplit(' ', 1) for l in stacks.splitlines() )
+        leaf = [ k for k in lines if k.endswith('builtins.sum>') ]
+        self.assertEqual(len(leaf), 1)
+        self.assertIn(':_middle:', leaf[0].split(';')[-3])
+        self.assertIn(':_leaf:', leaf[0].split(';')[-2])
+
+    def _busy(self, secs):
+        """Keep a thread busy for a while."""
+        def work():
+            end = perf_counter() + secs
+            while perf_counter() < end:
+                _middle(1000)
+        t = threading.Thread(target=work)
+        t.start()
+        return t
+
+    def test_sampler(self):
+        """The sampler sees what the other threads are doing."""
+        sampler = profiling.StackSampler(interval=0.001, max_cpu=50)
+        sampler.start()
+        self._busy(0.3).join()
+        sampler.stop()
+        sampler.join()
+
+        self.assertTrue(sampler.samples > 10)
+        self.assertIn('_leaf', sampler.folded())
+
+        sampler.reset()
+        self.assertEqual(sampler.folded(), '\n')
+
+    def test_sampler_cpu_limit(self):
+        """With a tiny CPU allowance the sampler backs right off."""
+        sampler = profiling.StackSampler(interval=0.001, max_cpu=0.001)
+        sampler.start()
+        self._busy(0.3).join()
+        sampler.stop()
+        sampler.join()
+
+        self.assertTrue(sampler.samples < 5)
+
+    def test_samples_call(self):
+        """The samples are available to admins at /samples."""
+        self.app.authorization = ('Basic', ('administrator', 'adminpass'))
+        self.app.get('/samples', status=404)
+
+        profiling.start_sampler(interval=0.001, max_cpu=50)
+        try:
+            self._busy(0.2).join()
+            r = self.app.get('/samples?reset=1')
+            self.assertIn('_leaf', r.text)
+            self.assertTrue(int(r.headers['X-EOS-Samples']) > 0)
+            self.assertNotIn('_leaf', self.app.get('/samples').text)
+
+            self.app.authorization = ('Basic', ('testuser', 'asdf'))
+            self.app.get('/samples', status=401)
+        finally:
+            profiling.stop_sampler()
+
+if __name__ == '__main__':
+    unittest.main()
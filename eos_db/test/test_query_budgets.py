@@ -0,0 +1,242 @@
+"""Query budgets for each API call.
+
+   Each test runs one API call against a small fleet of servers and checks the
+   number of SQL statements against a budget.  To catch N+1 patterns, where the
+   number of queries grows with the number of servers or users, the same
+   statement may only be repeated a few times.  The fleet has more servers than
+   that, so any per-server query will trip the check.
+
+   Calls with a known N+1 problem have their budgets set to what they run now,
+   with the fleet size as the repeat limit, so they can't get any worse.  When
+   one is fixed, tighten its budget.
+"""
+import os
+import unittest
+from eos_db import server
+from eos_db.test import fresh_db, TESTUSER
+from webtest import TestApp
+from pyramid.paster import get_app
+from http.cookiejar import DefaultCookiePolicy
+
+from eos_db.test.query_budget import QueryBudgetMixin, QueryCounter, statement_shape
+
+# Depend on test.ini in the same dir as this file.
+test_ini = os.path.join(os.path.dirname(__file__), 'test.ini')
+
+# Number of servers owned by the test user.
+FLEET_SIZE = 6
+
+# No statement should be run more often than this, per call.
+MAX_REPEATS = 3
+
+class TestQueryBudgets(unittest.TestCase, QueryBudgetMixin):
+    """Budgets for the number of SQL statements run by each API call.
+       Budgets include the statements needed to check the password with BasicAuth.
+    """
+    def setUp(self):
+        """Launch app using webtest with test settings, and make a fleet of
+           servers, some boosted, owned by testuser.
+        """
+        self.appconf = get_app(test_ini)
+        self.app = TestApp(self.appconf)
+        self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        fresh_db(("administrators", "admin", "adminpass"), TESTUSER)
+        server.set_config(dict(BoostLevels=dict(
+                baseline=dict(label='base', cores=1, ram=2, cost=0),
+                levels=[ dict(label='boost1', cores=2, ram=4, cost=1),
+                         dict(label='boost2', cores=4, ram=8, cost=2) ],
+                capacity=[ [10, 5, 0], [10, 0, 2] ] )))
+
+        user_id = server.get_user_id_from_name("testuser")
+        server.touch_to_add_credit(user_id, 1000)
+        for n in range(3):
+            server.create_user("users", "user%i" % n, "user%i" % n, "user%i" % n)
+
+        self.server_ids = []
+        for n in range(FLEET_SIZE):
+            vm_id = server.create_appliance("server%i" % n, "uuid%i" % n)
+            server.touch_to_add_ownership(vm_id, user_id)
+            server.touch_to_add_specification(vm_id, 1, 2)
+            server.touch_to_state(None, vm_id, "Started")
+            if n % 2:
+                server.touch_to_add_specification(vm_id, 2, 4)
+                server.touch_to_add_deboost(vm_id, -0.1 * n)
+            self.server_ids.append(vm_id)
+
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+
+    def tearDown(self):
+        #Don't leave the boost levels set for other tests.
+        server.set_config(dict(BoostLevels=dict(
+                baseline=dict(label='Default', cores=1, ram=2) )))
+
+    def _as_admin(self):
+        self.app.authorization = ('Basic', ('admin', 'adminpass'))
+
+    def _as_agent(self):
+        self.app.authorization = ('Basic', ('agent', 'sharedsecret'))
+
+    ### Calls that don't need a login
+
+    def test_home(self):
+        with self.assertQueryBudget(0):
+            self.app.get('/')
+
+    def test_health(self):
+        with self.assertQueryBudget(0):
+            self.app.get('/health')
+        #Just the SELECT 1, which touches no tables.
+        with self.assertQueryBudget(1):
+            self.app.get('/ready')
+
+    def test_boostlevels(self):
+        #list_servers_by_boost_level() looks up every server in turn.  This is
+        #what it does now, so it can't get any worse unnoticed.
+        with self.assertQueryBudget(13, FLEET_SIZE):
+            self.app.get('/boostlevels')
+
+    ### User calls
+
+    def test_my_user(self):
+        with self.assertQueryBudget(6, MAX_REPEATS):
+            self.app.get('/user')
+
+    def test_my_password(self):
+        with self.assertQueryBudget(7, MAX_REPEATS):
+            self.app.put('/user/password', {'password': 'asdf'})
+
+    def test_users(self):
+        with self.assertQueryBudget(4, MAX_REPEATS):
+            self.app.get('/users')
+
+    def test_user(self):
+        with self.assertQueryBudget(6, MAX_REPEATS):
+            self.app.get('/users/user0')
+
+    def test_user_credit(self):
+        self._as_admin()
+        with self.assertQueryBudget(5, MAX_REPEATS):
+            self.app.get('/users/testuser/credit')
+        with self.assertQueryBudget(8, MAX_REPEATS):
+            self.app.post('/users/testuser/credit', {'credit': 10})
+
+    def test_create_user(self):
+        self._as_admin()
+        with self.assertQueryBudget(8, MAX_REPEATS):
+            self.app.put('/users/newuser', {'type': 'users', 'handle': 'newuser@example.com',
+                                            'name': 'New User'})
+
+    ### Server listings
+
+    def test_servers(self):
+        with self.assertQueryBudget(11, MAX_REPEATS):
+            self.app.get('/servers')
+
+    def test_servers_multi(self):
+        ids = ','.join(str(i) for i in self.server_ids)
+        with self.assertQueryBudget(10, MAX_REPEATS):
+            self.app.get('/servers?ids=' + ids)
+
+    def test_states(self):
+        #list_servers_by_state() looks up every server in turn, as above.
+        with self.assertQueryBudget(15, FLEET_SIZE):
+            self.app.get('/states')
+
+    def test_state(self):
+        with self.assertQueryBudget(5, MAX_REPEATS):
+            self.app.get('/states/Started')
+
+    def test_deboost_jobs(self):
+        #get_deboost_jobs() looks up the name and boost status for each deboost,
+        #and half the servers have one.
+        self._as_agent()
+        with self.assertQueryBudget(7, FLEET_SIZE // 2):
+            self.app.get('/deboost_jobs')
+
+    ### Single server calls
+
+    def test_server(self):
+        with self.assertQueryBudget(13, MAX_REPEATS):
+            self.app.get('/servers/server1')
+        with self.assertQueryBudget(12, MAX_REPEATS):
+            self.app.get('/servers/by_id/%i' % self.server_ids[1])
+
+    def test_server_state(self):
+        with self.assertQueryBudget(7, MAX_REPEATS):
+            self.app.get('/servers/server1/state')
+
+    def test_server_specification(self):
+        with self.assertQueryBudget(7, MAX_REPEATS):
+            self.app.get('/servers/server1/specification')
+
+    def test_create_server(self):
+        self._as_admin()
+        with self.assertQueryBudget(5, MAX_REPEATS):
+            self.app.put('/servers/newserver', {'uuid': 'newuuid'})
+
+    ### Server actions
+
+    def test_start(self):
+        with self.assertQueryBudget(8, MAX_REPEATS):
+            self.app.post('/servers/server1/Starting')
+
+    def test_boost(self):
+        #Boosting adds four touches - state, specification, deboost and credit.
+        with self.assertQueryBudget(18, 4):
+            self.app.post('/servers/server0/Preparing', dict(hours=2, cores=2, ram=4))
+
+    def test_deboost(self):
+        with self.assertQueryBudget(16, MAX_REPEATS):
+            self.app.post('/servers/server1/Pre_Deboosting')
+
+    def test_extend_boost(self):
+        with self.assertQueryBudget(16, MAX_REPEATS):
+            self.app.post('/servers/server1/extend_boost', dict(hours=2))
+
+    def test_agent_set_state(self):
+        self._as_agent()
+        with self.assertQueryBudget(4, MAX_REPEATS):
+            self.app.post('/servers/server1/Started')
+
+    def test_agent_set_specification(self):
+        self._as_agent()
+        with self.assertQueryBudget(5, MAX_REPEATS):
+            self.app.post('/servers/server1/specification', dict(cores=2, ram=4))
+
+    ### Batches
+
+    def test_batch(self):
+        """A batch should cost no more than the calls in it, plus one login."""
+        calls = [ dict(method='GET', path=p) for p in
+                  ('/user', '/servers', '/servers/server1/specification') ]
+        with self.assertQueryBudget(18):
+            self.app.post_json('/batch', calls)
+
+class TestQueryCounter(unittest.TestCase):
+    """Tests the helper itself.
+    """
+    def test_shapes(self):
+        """Lists of parameters and whitespace should not change the shape."""
+        self.assertEqual(statement_shape("SELECT a FROM b WHERE c IN (?, ?,?)"),
+                         statement_shape("SELECT a  FROM b\nWHERE c IN (?)"))
+        self.assertEqual(statement_shape("SELECT a FROM b WHERE c IN (%(c_1)s, %(c_2)s)"),
+                         "SELECT a FROM b WHERE c IN (?)")
+
+    def test_repeated(self):
+        """Looking up servers one at a time is spotted as N+1."""
+        server.choose_engine("SQLite")
+        ids = [ server.create_appliance("box%i" % n, "uuid%i" % n) for n in range(4) ]
+
+        with QueryCounter() as qc:
+            for a_id in ids:
+                server.get_server_name_from_id(a_id)
+        self.assertEqual(qc.count, 4)
+        self.assertEqual(list(qc.repeated(3).values()), [4])
+
+        with QueryCounter() as qc:
+            server.return_artifact_details_multi(ids)
+        self.assertEqual(qc.repeated(1), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""Tests for reloading the settings file while running.
+"""
+import os
+import json
+import unittest
+import tempfile
+from eos_db import server, reload
+from eos_db.streaming import stream_response
+
+def settings(levels=0, states=()):
+    return dict(BoostLevels=dict(baseline=dict(label='base', ram=8, cores=1),
+                                 levels=[ dict(label='L%i' % n, ram=16 * n, cores=2 * n, cost=n)
+                                          for n in range(1, levels + 1) ],
+                                 capacity=[]),
+                MachineStates=dict(state_list=list(states)))
+
+class TestReload(unittest.TestCase):
+    """Uses check() directly, rather than waiting for the thread."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'test.settings.json')
+        self.mtime = 1000000000
+        self._write(json.dumps(settings(levels=1)))
+
+        self.eos = server.EOSServer()
+        self.eos.load_config_json(self.filename)
+        self.eos.choose_engine("SQLite")
+        self.watcher = reload.ConfigWatcher(self.filename, eos_server=self.eos)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, text):
+        with open(self.filename, 'w') as fh:
+            fh.write(text)
+        #Don't rely on the file system noticing a quick change.
+        self.mtime += 1
+        os.utime(self.filename, ns=(self.mtime, self.mtime))
+
+    def test_reload(self):
+        self.assertFalse(self.watcher.check())
+
+        self._write(json.dumps(settings(levels=2, states=['Archived'])))
+        self.assertTrue(self.watcher.check())
+        self.assertEqual(len(self.eos.BL['levels']), 2)
+        self.assertIn('Archived', self.eos.config.states)
+        with server.using(self.eos):
+            self.assertTrue(server.get_state_id_by_name('Archived'))
+
+        #No change, no reload.
+        self.assertFalse(self.watcher.check())
+        self.assertEqual(self.watcher.reloads, 1)
+
+    def test_bad_file(self):
+        """A broken or invalid file leaves the old config in place."""
+        old = self.eos.config
+        self._write('{ "BoostLevels" : ')
+        self.assertFalse(self.watcher.check())
+
+        bad = settings(levels=2)
+        bad['BoostLevels']['levels'][1]['cores'] = 'lots'
+        self._write(json.dumps(bad))
+        self.assertFalse(self.watcher.check())
+
+        self.assertIs(self.eos.config, old)
+        self.assertEqual(self.watcher.errors, 2)
+
+    def test_pin(self):
+        """A pinned thread keeps its snapshot through a reload."""
+        with self.eos.pin():
+            self._write(json.dumps(settings(levels=3)))
+            self.assertTrue(self.watcher.check())
+            self.assertEqual(len(self.eos.BL['levels']), 1)
+            with self.eos.pin():
+                self.assertEqual(len(self.eos.BL['levels']), 1)
+        self.assertEqual(len(self.eos.BL['levels']), 3)
+
+    def test_pin_streamed(self):
+        """A streamed body is made with the snapshot the request started with."""
+        def handler(request):
+            def body():
+                yield str(len(self.eos.BL['levels'])).encode()
+            return stream_response(body())
+
+        tween = reload.pin_config_tween_factory(handler, None)
+        with server.using(self.eos):
+            response = tween(None)
+
+        #The thread isn't left pinned in case the body is never read.
+        self._write(json.dumps(settings(levels=3)))
+        self.assertTrue(self.watcher.check())
+        self.assertEqual(len(self.eos.BL['levels']), 3)
+        self.assertEqual(response.body, b'1')
+        self.assertEqual(len(self.eos.BL['levels']), 3)
+
+    def test_validate(self):
+        here = os.path.dirname(__file__)
+        for f in ('test.settings.json', 'test2.settings.json',
+                  os.path.join('..', '..', 'development.settings.json')):
+            server.validate_config(reload.parse_json_file(os.path.join(here, f)))
+
+        bad = settings(levels=2)
+        bad['BoostLevels']['capacity'] = [[1]]
+        self.assertRaises(ValueError, server.validate_config, bad)
+        self.assertRaises(ValueError, server.validate_config,
+                          dict(MachineStates=dict(state_list='Started')))
+
+if __name__ == '__main__':
+    unittest.main()
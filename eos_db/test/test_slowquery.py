@@ -0,0 +1,113 @@
+"""Tests for the slow SQL statement log.
+"""
+import json
+import logging
+import unittest
+from eos_db import server, slowquery
+from eos_db.models import Password
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+class TestSlowQuery(unittest.TestCase):
+    """Tests the statement log, with the threshold set so low that everything
+       counts as slow.
+    """
+    def setUp(self):
+        server.choose_engine("SQLite")
+        user_id = server.create_user("users", "testuser", "testuser", "testuser")
+        vm_id = server.create_appliance("testvm", "testuuid")
+        server.touch_to_add_ownership(vm_id, user_id)
+
+        slowquery.install()
+        slowquery.reset()
+        self.old_settings = (slowquery.SLOW_SECS, slowquery.EXPLAIN)
+        slowquery.SLOW_SECS, slowquery.EXPLAIN = 1e-9, True
+
+        self.handler = ListHandler()
+        slowquery.log.addHandler(self.handler)
+
+    def tearDown(self):
+        slowquery.log.removeHandler(self.handler)
+        slowquery.SLOW_SECS, slowquery.EXPLAIN = self.old_settings
+
+    def test_off_by_default(self):
+        """Nothing is logged or explained unless the settings ask for it."""
+        self.assertEqual(self.old_settings, (0, False))
+
+    def test_slow_log(self):
+        """Each statement is logged with the server function that ran it."""
+        server.get_server_id_from_name("testvm")
+
+        self.assertTrue(self.handler.records)
+        for entry in self.handler.records:
+            self.assertEqual(entry['function'], 'get_server_id_from_name')
+            self.assertTrue(entry['secs'] > 0)
+        self.assertIn('testvm', json.dumps([ e['parameters'] for e in self.handler.records ]))
+
+    def test_explain_once(self):
+        """The plan is fetched only the first time a statement shape is slow."""
+        server.get_server_id_from_name("testvm")
+        first = [ e for e in self.handler.records if 'plan' in e ]
+        self.assertTrue(first)
+        for entry in first:
+            self.assertTrue(entry['statement'].lstrip().upper().startswith('SELECT'))
+            self.assertTrue(entry['plan'])
+            self.assertNotIn('Could not', entry['plan'][0])
+
+        self.handler.records = []
+        server.current().clear_ids()
+        server.get_server_id_from_name("testvm")
+        self.assertTrue(self.handler.records)
+        self.assertFalse([ e for e in self.handler.records if 'plan' in e ])
+
+    def test_rowcount_and_params(self):
+        """Updates report a row count, long parameters are cut short, and the
+           password hash is not logged at all.
+        """
+        server.touch_to_add_password(server.get_user_id_from_name("testuser"), "asdf")
+        with server._session_scope() as session:
+            password_hash = session.query(Password.password).order_by(Password.id.desc()).first()[0]
+        inserts = [ e for e in self.handler.records if e['statement'].startswith('INSERT') ]
+        self.assertTrue(inserts)
+        self.assertEqual(inserts[0]['function'], 'touch_to_add_password')
+        self.assertEqual(inserts[-1]['rowcount'], 1)
+        for entry in inserts:
+            for p in entry['parameters']:
+                self.assertTrue(len(str(p)) <= slowquery.MAX_PARAM + 3)
+
+        self.assertTrue(password_hash)
+        self.assertNotIn(password_hash, json.dumps(self.handler.records))
+        self.assertIn(slowquery.SCRUBBED, json.dumps(inserts))
+
+    def test_safe_params(self):
+        """Secrets are spotted by the name of the parameter, or the table."""
+        self.assertEqual(slowquery._safe_params(dict(api_key='x', name='y')),
+                         dict(api_key=slowquery.SCRUBBED, name='y'))
+        self.assertEqual(slowquery._safe_params((1, 'x'), 'UPDATE password SET password=? WHERE id=?'),
+                         [slowquery.SCRUBBED] * 2)
+        self.assertEqual(slowquery._safe_params((1, 'x'), 'INSERT INTO touch (id, x) VALUES (?, ?)'),
+                         [1, 'x'])
+
+    def test_quick(self):
+        """Nothing is logged when statements are quicker than the threshold,
+           or the log is turned off.
+        """
+        slowquery.SLOW_SECS = 60
+        server.get_server_id_from_name("testvm")
+        slowquery.SLOW_SECS = 0
+        server.get_server_id_from_name("testvm")
+        self.assertEqual(self.handler.records, [])
+
+    def test_shape(self):
+        """IN clauses of any length have the same shape."""
+        self.assertEqual(slowquery.statement_shape("SELECT a FROM t WHERE b IN (?, ?)"),
+                         slowquery.statement_shape("SELECT a  FROM t\nWHERE b IN (?)"))
+
+if __name__ == '__main__':
+    unittest.main()
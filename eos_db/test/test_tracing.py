@@ -0,0 +1,123 @@
+"""Tests for request ids and the slow-request trace log.
+"""
+import os
+import json
+import logging
+import unittest
+import eos_db
+from eos_db import server, tracing
+from eos_db.test import fresh_db, TESTUSER
+from webtest import TestApp
+from pyramid.paster import get_appsettings
+from http.cookiejar import DefaultCookiePolicy
+
+# Depend on test.ini in the same dir as this file.
+test_ini = os.path.join(os.path.dirname(__file__), 'test.ini')
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+class TestTracing(unittest.TestCase):
+    """Tests the tracing tween and the spans it records.
+    """
+    def setUp(self):
+        """Launch app using webtest with test settings"""
+        settings = dict(get_appsettings(test_ini))
+        settings['tracing.enabled'] = 'true'
+        self.app = TestApp(eos_db.main({'__file__': test_ini}, **settings))
+        self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        fresh_db(TESTUSER)
+        vm_id = server.create_appliance("testvm", "testuuid")
+        server.touch_to_add_ownership(vm_id, server.get_user_id_from_name("testuser"))
+        self.app.authorization = ('Basic', ('testuser', 'asdf'))
+
+        #Trace everything, and log it all as slow.
+        self.old_settings = (tracing.SAMPLE_RATE, tracing.SLOW_SECS)
+        tracing.SAMPLE_RATE, tracing.SLOW_SECS = 1, 0
+
+        self.handler = ListHandler()
+        tracing.log.addHandler(self.handler)
+
+    def tearDown(self):
+        tracing.log.removeHandler(self.handler)
+        tracing.SAMPLE_RATE, tracing.SLOW_SECS = self.old_settings
+
+    def _spans(self, span, name):
+        """All the spans with the given name in the tree."""
+        res = [span] if span['name'] == name else []
+        for c in span.get('children', ()):
+            res.extend(self._spans(c, name))
+        return res
+
+    def test_request_id(self):
+        """Every request gets an id, or keeps a sensible one it was sent."""
+        r1 = self.app.get('/')
+        r2 = self.app.get('/')
+        self.assertTrue(r1.headers['X-Request-Id'])
+        self.assertNotEqual(r1.headers['X-Request-Id'], r2.headers['X-Request-Id'])
+
+        r = self.app.get('/', headers={'X-Request-Id': 'abc-123'})
+        self.assertEqual(r.headers['X-Request-Id'], 'abc-123')
+
+        r = self.app.get('/', headers={'X-Request-Id': 'bad id\nwith junk'})
+        self.assertNotEqual(r.headers['X-Request-Id'], 'bad id\nwith junk')
+
+    def test_slow_log(self):
+        """A slow request is logged with its spans."""
+        r = self.app.get('/servers/testvm')
+
+        self.assertEqual(len(self.handler.records), 1)
+        entry = json.loads(self.handler.records[0])
+        self.assertEqual(entry['request_id'], r.headers['X-Request-Id'])
+        self.assertEqual(entry['route'], 'server')
+        self.assertEqual(entry['status'], 200)
+
+        #The password check is a with_session function that runs SQL.
+        spans = entry['spans']
+        checks = self._spans(spans, 'check_password')
+        self.assertEqual(len(checks), 1)
+        self.assertEqual(checks[0]['children'][0]['name'], 'sql')
+        self.assertIn('password', checks[0]['children'][0]['sql'])
+
+        sql = self._spans(spans, 'sql')
+        self.assertEqual(entry['sql_count'], len(sql))
+        self.assertTrue(entry['ms'] >= max(s['ms'] for s in sql))
+
+    def test_not_sampled(self):
+        """Nothing is logged when tracing is off, or the request is quick."""
+        tracing.SAMPLE_RATE = 0
+        self.app.get('/servers/testvm')
+        self.assertEqual(self.handler.records, [])
+
+        tracing.SAMPLE_RATE, tracing.SLOW_SECS = 1, 60
+        self.app.get('/servers/testvm')
+        self.assertEqual(self.handler.records, [])
+
+    def test_batch(self):
+        """The calls in a batch are spans in the one trace."""
+        calls = [ dict(method='GET', path='/user'),
+                  dict(method='GET', path='/servers/testvm') ]
+        self.app.post_json('/batch', calls)
+
+        self.assertEqual(len(self.handler.records), 1)
+        spans = json.loads(self.handler.records[0])['spans']
+        self.assertEqual(len(self._spans(spans, 'GET /user')), 1)
+        self.assertEqual(len(self._spans(spans, 'GET /servers/testvm')), 1)
+
+    def test_streamed(self):
+        """A streamed listing is traced until its body is done."""
+        self.app.get('/servers')
+
+        self.assertEqual(len(self.handler.records), 1)
+        spans = json.loads(self.handler.records[0])['spans']
+        self.assertEqual(len(self._spans(spans, 'return_artifact_details_multi')), 1)
+        self.assertIsNone(tracing.current())
+
+if __name__ == '__main__':
+    unittest.main()
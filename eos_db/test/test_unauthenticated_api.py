@@ -11,7 +11,7 @@ from webtest import TestApp
 from pyramid.paster import get_app
 from http.cookiejar import DefaultCookiePolicy
 
-from eos_db import server
+from eos_db import server, models
 
 # Normally I'd frown upon any code that discovers it's own location, but in this
 # case it makes sense to use test.ini from the same folder as the test module.
@@ -50,6 +50,31 @@ class TestUnAuth(unittest.TestCase):
 
         self.assertEqual(response.json['Valid API Call List']['servers'], '/servers')
 
+    def test_health(self):
+        """The probes don't need a login.  /ready checks the DB."""
+        app = self.testapp
+        self.assertEqual(app.get('/health').json, dict(status='ok'))
+
+        res = app.get('/ready').json
+        self.assertEqual(res['status'], 'ok')
+        self.assertTrue(res['db_ok'])
+        self.assertEqual(res['expected_schema_version'], models.SCHEMA_VERSION)
+        self.assertIn('pool', res)
+
+    def test_ready_quick(self):
+        """On an idle pool the DB check should take under a millisecond."""
+        times = [ server.check_db()['db_ms'] for n in range(20) ]
+        self.assertTrue(min(times) < 1.0, times)
+
+    def test_not_ready(self):
+        """If the DB can't be reached /ready says so with a 503."""
+        with server.using(server.EOSServer()):
+            server.override_engine('sqlite:////no/such/dir/eos.db', echo=False)
+            res = self.testapp.get('/ready', status=503).json
+            self.assertFalse(res['db_ok'])
+            self.assertEqual(res['status'], 'unavailable')
+            self.assertEqual(self.testapp.get('/health').json, dict(status='ok'))
+
     def test_servers(self):
         """If I ask for a list of servers, I should get back a 401 code telling me
            to log in.
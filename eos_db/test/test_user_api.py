@@ -5,6 +5,7 @@
 import os, sys
 import unittest
 from eos_db import server
+from eos_db.test import fresh_db
 from webtest import TestApp
 from pyramid.paster import get_app
 from http.cookiejar import DefaultCookiePolicy
@@ -30,15 +31,12 @@ class TestUserAPI(unittest.TestCase):
         #All auth via BasicAuth - never return the session cookie.
         self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
 
-        # This sets global var "engine" - in the case of SQLite this is a fresh RAM
-        # DB each time.  If we only did this on class instantiation the database would
-        # be dirty and one test could influence another.
+        # This gives us a fresh RAM DB each time, with the user account already
+        # in it, made as self.create_user("testuser") would.  If we only did this
+        # on class instantiation the database would be dirty and one test could
+        # influence another.
         # TODO - add a test that tests this.
-        server.choose_engine("SQLite")
-
-        # Punch in new user account with direct server call
-        # This will implicitly generate the tables.
-        user_id = self.create_user("testuser")
+        fresh_db(("users", "testuser", "asdf", "testuser@example.com", "testuser testuser"))
         #Here is what the user should look like when inspected
         self.user_json =  { "name"    : "testuser testuser",
                             "handle"  : "testuser@example.com",
@@ -46,11 +44,8 @@ class TestUserAPI(unittest.TestCase):
                             "credits" : 0,
                             "username": "testuser"}
 
-        #print("user_id is %s" % str(user_id))
         #print("user_from_db_is %s" % server.get_user_id_from_name("testuser"))
 
-        server.touch_to_add_password(user_id, "asdf")
-
         # And log in as this user for all tests (via BasicAuth)
         # FIXME - switch to token auth to speed up the tests.
         self.app.authorization = ('Basic', ('testuser', 'asdf'))
@@ -175,6 +170,62 @@ class TestUserAPI(unittest.TestCase):
         self.assertEqual(len(my_servers), 1)
         self.assertEqual(my_servers[0]['artifact_name'], 'fooserver')
 
+    def test_batch(self):
+        """ Fetch everything the portal dashboard needs in one call.  Each
+            call gets the same result as if it were made directly.
+        """
+        server_id = self.create_server('fooserver', 'testuser')
+        server.touch_to_add_specification(server_id, 1, 16)
+
+        paths = ['/user', '/servers', '/boostlevels', '/servers/fooserver/specification']
+        res = self.app.post_json('/batch', [ dict(method='GET', path=p) for p in paths ]).json
+
+        self.assertEqual([ r['status'] for r in res ], [200] * 4)
+        for p, r in zip(paths, res):
+            self.assertEqual(r['body'], self.app.get(p).json)
+
+    def test_batch_permissions(self):
+        """ Calls in a batch are subject to the same permission checks as
+            normal calls.
+        """
+        self.create_server('fooserver', 'testuser')
+        self.create_user('otheruser')
+        self.create_server('otherserver', 'otheruser')
+
+        calls = [ dict(method='POST', path='/servers/fooserver/Starting'),
+                  dict(method='POST', path='/servers/otherserver/Starting'),
+                  dict(method='POST', path='/servers/fooserver/Started'),
+                  dict(method='POST', path='/users/testuser/credit', params={'credit': 100}) ]
+        res = self.app.post_json('/batch', calls).json
+
+        self.assertEqual([ r['status'] for r in res ], [200, 401, 401, 401])
+        self.assertEqual(self.app.get('/servers/fooserver/state').json, 'Starting')
+        self.assertEqual(self.app.get('/user').json['credits'], 0)
+
+    def test_multi_get(self):
+        """ Get details for several servers at once, by id and by name.
+            Servers that don't exist or that belong to someone else come back
+            as null without spoiling the rest.
+        """
+        foo_id = self.create_server('fooserver', 'testuser')
+        bar_id = self.create_server('barserver', 'testuser')
+        self.create_user('otheruser')
+        other_id = self.create_server('otherserver', 'otheruser')
+
+        res = self.app.get('/servers?ids=%i,%i,%i,999' % (foo_id, bar_id, other_id)).json
+        self.assertEqual(sorted(res), sorted(str(i) for i in (foo_id, bar_id, other_id, 999)))
+        self.assertEqual(res[str(foo_id)], self.app.get('/servers/fooserver').json)
+        self.assertEqual(res[str(bar_id)]['artifact_name'], 'barserver')
+        self.assertEqual(res[str(other_id)], None)
+        self.assertEqual(res['999'], None)
+
+        res = self.app.get('/servers?names=fooserver,otherserver,noserver').json
+        self.assertEqual(res['fooserver'], self.app.get('/servers/fooserver').json)
+        self.assertEqual(res['otherserver'], None)
+        self.assertEqual(res['noserver'], None)
+
+        self.app.get('/servers?ids=1,foo', status=400)
+
     def test_retrieve_user_touches(self):
         """ Retrieve a list of touches that the user has made to the database.
         This can only be requested by the user themselves, an agent or an
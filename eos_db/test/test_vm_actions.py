@@ -4,6 +4,7 @@ This test suite avoids webtest and calls server functions directly.
 """
 
 import unittest
+from datetime import datetime
 import eos_db.server as s
 
 # These tests are not good.  Skip them for now.
@@ -144,6 +145,62 @@ class TestVMActions(unittest.TestCase):
         self.assertEqual(server_details['state'], "Not yet initialised")
         self.assertEqual(server_details['artifact_name'], "returndetails")
 
+    def test_return_artifact_details_multi(self):
+        """The multi-VM version should give the same as calling
+           return_artifact_details() for each VM.
+        """
+        s.set_config(dict(BoostLevels=dict(
+                baseline=dict(label='base', cores=1, ram=2, cost=0),
+                levels=[dict(label='boost', cores=2, ram=4, cost=1)],
+                capacity=[] )))
+
+        plain_id = self.my_create_appliance("plain")
+        started_id = self.my_create_appliance("started")
+        s.touch_to_state(None, started_id, "Started")
+        boosted_id = self.my_create_appliance("boosted")
+        s.touch_to_add_specification(boosted_id, 1, 2)
+        s.touch_to_add_specification(boosted_id, 2, 4)
+        s.touch_to_add_deboost(boosted_id, 10)
+        s.touch_to_state(None, boosted_id, "Preparing")
+
+        ids = [plain_id, started_id, boosted_id]
+        res = s.return_artifact_details_multi(ids + [999])
+
+        self.assertEqual(sorted(res), ids)
+        for a_id in ids:
+            self.assertEqual(res[a_id], s.return_artifact_details(a_id))
+        self.assertEqual(res[boosted_id]['boosted'], "Boosted")
+
+        self.assertEqual(s.get_server_ids_from_names(["plain", "boosted", "none"]),
+                         {"plain": plain_id, "boosted": boosted_id})
+
+    def test_latest_touches(self):
+        """The multi-VM lookups pick the touch with the newest touch_dt, then
+           the highest id, and fetch just that one row per VM.
+        """
+        clock = [datetime(2030, 1, 2)]
+        s.set_clock(lambda: clock[0])
+        self.addCleanup(s.set_clock)
+
+        vm_id = self.my_create_appliance("history")
+        other_id = self.my_create_appliance("other")
+        s.touch_to_add_specification(vm_id, 1, 2)
+        s.touch_to_state(None, vm_id, "Started")
+        s.touch_to_state(None, vm_id, "Stopped")
+        s.touch_to_state(None, other_id, "Started")
+        #Backdated, so not the latest in spite of the higher id.
+        clock[0] = datetime(2030, 1, 1)
+        s.touch_to_add_specification(vm_id, 2, 4)
+        s.touch_to_state(None, vm_id, "Preparing")
+
+        res = s.return_artifact_details_multi([vm_id, other_id])
+        self.assertEqual((res[vm_id]['cores'], res[vm_id]['state']), (1, "Stopped"))
+        self.assertEqual(res[other_id]['state'], "Started")
+
+        with s._session_scope() as session:
+            latest = s._latest_touches([vm_id, other_id], session)
+            self.assertEqual(session.query(latest).count(), 2)
+
     def test_ownership(self):
         artifact_id = self.my_create_appliance("owned")
         artifact2_id = self.my_create_appliance("unowned")
@@ -189,6 +246,9 @@ class TestVMActions(unittest.TestCase):
         self.assertEqual(len(s.list_artifacts_for_user(owners[1])), 1)
         self.assertEqual(len(s.list_artifacts_for_user(owners[2])), 1)
 
+        #And in list_owned_artifacts?
+        self.assertEqual(s.list_owned_artifacts(artifacts, owners[1]), {artifacts[1]})
+
         #Likewise requesting an artifact I don't own should give an error,
         #but that has to be tested via webtest.
 
@@ -198,6 +258,103 @@ class TestVMActions(unittest.TestCase):
         self.assertEqual(len(s.list_artifacts_for_user(owners[1])), 1)
         self.assertEqual(len(s.list_artifacts_for_user(owners[2])), 0)
 
+    def test_template(self):
+        """Each copy of a template starts out the same, and the current engine
+           is left alone while the template is made.
+        """
+        vm_id = self.my_create_appliance("keepme")
+        template = s.make_template(lambda: s.create_appliance("templatevm", "templateuuid"))
+        self.assertEqual(s.get_server_id_from_name("keepme"), vm_id)
+
+        s.choose_engine("SQLite", template=template)
+        tvm_id = s.get_server_id_from_name("templatevm")
+        s.touch_to_state(None, tvm_id, "Started")
+        self.assertEqual(s.check_state(tvm_id), "Started")
+
+        s.choose_engine("SQLite", template=template)
+        self.assertIsNone(s.check_state(tvm_id))
+        self.assertEqual(s.setup_states(), 0)
+
+    def test_instances(self):
+        """Two EOSServers can be used side by side, each with its own database
+           and config, leaving the default alone.
+        """
+        vm_id = self.my_create_appliance("defaultvm")
+        default_bl = s.BL
+
+        one, two = s.EOSServer(), s.EOSServer()
+        two.set_config(dict(BoostLevels=dict(baseline=dict(label='Two', cores=2, ram=4))))
+        for eos_server, name in ((one, "onevm"), (two, "twovm")):
+            eos_server.choose_engine("SQLite")
+            with s.using(eos_server):
+                s.create_appliance(name, name)
+
+        with s.using(one):
+            self.assertEqual(s.get_server_id_from_name("onevm"), 1)
+            self.assertEqual(s.get_baseline_specification(1), (1, 2))
+            with s.using(two):
+                self.assertIs(s.engine, two.engine)
+                self.assertEqual(s.get_server_id_from_name("twovm"), 1)
+                self.assertEqual(s.get_baseline_specification(1), (2, 4))
+            self.assertIs(s.current(), one)
+
+        self.assertIs(s.current(), s.default)
+        self.assertIs(s.BL, default_bl)
+        self.assertEqual(s.get_server_id_from_name("defaultvm"), vm_id)
+
+    def test_id_cache(self):
+        """Name lookups are cached, and a new server masks an old one even if the
+           old id was cached, unless it is rolled back.  Nothing looked up in a
+           shared session is cached, as it may not be committed.
+        """
+        ids = s.current().server_ids
+        vm_id = self.my_create_appliance("cachedvm")
+        self.assertEqual(s.get_server_id_from_name("cachedvm"), vm_id)
+        self.assertEqual(s.get_server_id_from_name("cachedvm"), vm_id)
+        self.assertEqual((ids.hits, ids.misses), (1, 1))
+
+        with s.shared_session() as session:
+            new_id = self.my_create_appliance("cachedvm")
+            self.assertEqual(s.get_server_id_from_name("cachedvm"), new_id)
+            self.assertIsNone(ids.get("cachedvm"))
+            session.rollback()
+        self.assertEqual(s.get_server_id_from_name("cachedvm"), vm_id)
+
+        new_id = self.my_create_appliance("cachedvm")
+        self.assertEqual(s.get_server_id_from_name("cachedvm"), new_id)
+        self.assertEqual(s.get_server_id_from_uuid(str(self._uuid)), new_id)
+
+        #A lookup that started before a discard() is not saved.
+        gen = ids.generation()
+        ids.discard("othervm")
+        ids.put("othervm", 99, gen)
+        self.assertIsNone(ids.get("othervm"))
+
+        small = s.IdCache(size=2)
+        for n in range(3):
+            small.put(n, n, small.generation())
+        self.assertEqual((small.get(0), small.get(2), len(small)), (None, 2, 2))
+
+    def test_id_cache_expiry(self):
+        """A server made by another process is seen once the cached id of the
+           one it masks expires.
+        """
+        now = [0]
+        ids = s.current().server_ids = s.IdCache(ttl=5, clock=lambda: now[0])
+        self.addCleanup(setattr, s.current(), 'server_ids', s.IdCache())
+
+        vm_id = self.my_create_appliance("sharedvm")
+        self.assertEqual(s.get_server_id_from_name("sharedvm"), vm_id)
+
+        #As if from eos-admin, so nothing is discarded from the cache.
+        with s._session_scope() as session:
+            session.add(s.Appliance(name="sharedvm", uuid="otheruuid"))
+            session.commit()
+        self.assertEqual(s.get_server_id_from_name("sharedvm"), vm_id)
+
+        now[0] = 5
+        self.assertGreater(s.get_server_id_from_name("sharedvm"), vm_id)
+        self.assertEqual(len(ids), 1)
 
 if __name__ == '__main__':
     unittest.main()
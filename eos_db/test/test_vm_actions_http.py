@@ -3,8 +3,10 @@
    $ ~/eoscloud-venv/bin/python3 -m unittest eos_db.test.test_vm_actions_http
 """
 import os
+import json
 import unittest
-from eos_db import server
+from eos_db import server, views
+from eos_db.test import fresh_db, ADMIN
 from webtest import TestApp
 from pyramid.paster import get_app
 from http.cookiejar import DefaultCookiePolicy
@@ -39,17 +41,11 @@ class TestVMActionsHTTP(unittest.TestCase):
         #For speed, allow cookie setting.
         # self.app.cookiejar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
 
-        # This sets global var "engine" - in the case of SQLite this is a fresh RAM
-        # DB each time.  If we only did this on class instantiation the database would
-        # be dirty and one test could influence another.
+        # This gives us a fresh RAM DB each time, with the administrator account
+        # already in it.  If we only did this on class instantiation the database
+        # would be dirty and one test could influence another.
         # TODO - add a test that tests this.
-        server.choose_engine("SQLite")
-
-        # Punch in new administrator account with direct server call
-        # This will implicitly generate the tables.
-        user_id = server.create_user("administrators", "administrator", "administrator", "administrator")
-        #server.touch_to_add_user_group("administrator", "administrators")
-        server.touch_to_add_password(user_id, "adminpass")
+        fresh_db(ADMIN)
 
         self.app.authorization = ('Basic', ('administrator', 'adminpass'))
 
@@ -216,6 +212,52 @@ class TestVMActionsHTTP(unittest.TestCase):
     def test_retrieve_server_touches(self):
         """ Not currently implemented. """
 
+    def test_list_servers_streamed(self):
+        """ Listings are streamed out in chunks, but the result should be the
+            same whatever the chunk size, including the masking of servers that
+            have been re-created with the same name.
+        """
+        for n in range(5):
+            self.create_server("testserver%i" % n)
+        self.create_server("testserver1")
+        self.app.post('/servers/testserver3/Stopping')
+        self.app.post('/servers/testserver0/Stopping')
+
+        names = [ 'testserver%i' % n for n in (0, 2, 3, 4, 1) ]
+
+        #An agent sees all the servers
+        self.app.cookiejar.clear()
+        self.app.authorization = ('Basic', ('agent', 'sharedsecret'))
+
+        old_chunk = server.STREAM_CHUNK
+        try:
+            for chunk in (1, 2, 200):
+                server.STREAM_CHUNK = chunk
+                res = self.app.get('/servers').json
+                self.assertEqual([ s['artifact_name'] for s in res ], names)
+                self.assertEqual(res[-1]['artifact_id'], 6)
+
+                res = self.app.get('/states/Stopping').json
+                self.assertEqual([ s['artifact_name'] for s in res ],
+                                 ['testserver0', 'testserver3'])
+        finally:
+            server.STREAM_CHUNK = old_chunk
+
+        self.assertEqual(self.app.get('/states/Started').json, [])
+
+    def test_stream_error(self):
+        """ An error before the first chunk is raised at once, and an error
+            after that ends the JSON early rather than breaking it.
+        """
+        def items(good):
+            yield from range(good)
+            raise RuntimeError("Database went away")
+
+        self.assertRaises(RuntimeError, views._stream_json, items(0))
+        with self.assertLogs('eos_db.views', 'ERROR'):
+            body = views._stream_json(items(5), chunk_size=2).body
+        self.assertEqual(json.loads(body.decode()), [0, 1, 2, 3])
+
     def test_retrieve_state_summary(self):
         """ Test for /states
         """
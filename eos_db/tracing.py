@@ -0,0 +1,222 @@
+"""Request tracing for EOS-DB.
+
+Every request is given an id, which is sent back in the X-Request-Id header
+(or passed through, if the caller supplied one).  A sample of requests are also
+traced: each call to a @with_session function in eos_db.server and each SQL
+statement becomes a span, nested as the calls were.  If a traced request takes
+longer than the slow threshold, the whole span tree is logged as one line of
+JSON to the eos_db.tracing logger.
+
+Settings in the .ini file:
+
+  tracing.sample_rate = 0.01   Fraction of requests to trace, 0 to 1.
+  tracing.slow_secs = 1.0      Log traced requests that take longer than this.
+
+Untraced requests only pay for one random number and one thread-local lookup
+per function call.
+"""
+
+import re
+import json
+import uuid
+import random
+import logging
+import threading
+from time import perf_counter
+
+from eos_db.streaming import after_body
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+SAMPLE_RATE = 0.01
+SLOW_SECS = 1.0
+
+# Stop recording spans after this many in one request, so a runaway loop
+# doesn't eat all the memory.
+MAX_SPANS = 5000
+
+# SQL is cut down to this many characters in the log.
+MAX_SQL = 500
+
+# Incoming request ids must look like this, or we make our own.
+_GOOD_ID = re.compile(r'^[\w.:-]{1,64}$')
+
+_local = threading.local()
+
+class Span():
+    """One timed call, and the calls made within it."""
+    __slots__ = ('name', 'sql', 'start', 'end', 'children')
+
+    def __init__(self, name, sql=None):
+        self.name = name
+        self.sql = sql
+        self.start = perf_counter()
+        self.end = None
+        self.children = []
+
+    def as_dict(self):
+        res = dict(name=self.name,
+                   ms=round(((self.end or perf_counter()) - self.start) * 1000, 3))
+        if self.sql is not None:
+            res['sql'] = self.sql[:MAX_SQL]
+        if self.children:
+            res['children'] = [ c.as_dict() for c in self.children ]
+        return res
+
+class Trace():
+    """The spans for one request.  Only the thread handling the request
+       touches this.
+    """
+    def __init__(self, request_id, name):
+        self.request_id = request_id
+        self.root = Span(name)
+        self.stack = [self.root]
+        self.spans = 1
+        self.dropped = 0
+
+    def enter(self, name, sql=None):
+        if self.spans >= MAX_SPANS:
+            self.dropped += 1
+            #Push a placeholder so exit() still balances.
+            self.stack.append(None)
+            return
+        span = Span(name, sql)
+        parent = self.stack[-1] or self.root
+        parent.children.append(span)
+        self.stack.append(span)
+        self.spans += 1
+
+    def exit(self):
+        span = self.stack.pop()
+        if span is not None:
+            span.end = perf_counter()
+
+    def sql_counts(self):
+        """Returns the number of SQL statements and the total time they took."""
+        count, secs = 0, 0.0
+        todo = [self.root]
+        while todo:
+            span = todo.pop()
+            if span.sql is not None:
+                count += 1
+                secs += (span.end or span.start) - span.start
+            todo.extend(span.children)
+        return count, secs
+
+def current():
+    """Returns the Trace for the request being handled by this thread, or None
+       if the request is not being traced.
+    """
+    return getattr(_local, 'trace', None)
+
+def configure(settings):
+    """Reads the tracing.* settings from the app settings."""
+    global SAMPLE_RATE, SLOW_SECS
+    SAMPLE_RATE = float(settings.get('tracing.sample_rate', SAMPLE_RATE))
+    SLOW_SECS = float(settings.get('tracing.slow_secs', SLOW_SECS))
+
+_installed = False
+def install():
+    """Sets up the SQLAlchemy event listeners which add a span for each SQL
+       statement.  As in eos_db.metrics these go on the Engine class.
+    """
+    global _installed
+    if _installed:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    _installed = True
+
+def uninstall():
+    """Takes the listeners off again."""
+    global _installed
+    if not _installed:
+        return
+    event.remove(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.remove(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.remove(Engine, 'handle_error', _handle_error)
+    _installed = False
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = getattr(_local, 'trace', None)
+    if trace:
+        trace.enter('sql', statement)
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = getattr(_local, 'trace', None)
+    if trace:
+        trace.exit()
+
+def _handle_error(context):
+    #The after event does not fire if the statement fails.
+    trace = getattr(_local, 'trace', None)
+    if trace and len(trace.stack) > 1:
+        trace.exit()
+
+def tracing_tween_factory(handler, registry):
+    """Tween that gives each request an id and traces a sample of them.
+       Calls made by /batch are traced as spans of the batch request.
+    """
+    configure(registry.settings)
+    install()
+
+    def tracing_tween(request):
+        outer = getattr(_local, 'trace', None)
+        if outer:
+            #A sub-request, which is part of the outer trace.
+            request.request_id = outer.request_id
+            outer.enter('%s %s' % (request.method, request.path))
+            try:
+                response = handler(request)
+            except:
+                outer.exit()
+                raise
+            after_body(response, outer.exit)
+            return response
+
+        request_id = request.headers.get('X-Request-Id', '')
+        if not _GOOD_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.request_id = request_id
+
+        trace = None
+        if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+            trace = _local.trace = Trace(request_id, '%s %s' % (request.method, request.path))
+
+        def finish(status):
+            if trace:
+                _local.trace = None
+                trace.root.end = perf_counter()
+                elapsed = trace.root.end - trace.root.start
+                if elapsed >= SLOW_SECS:
+                    _log_slow(request, status, elapsed, trace)
+
+        try:
+            response = handler(request)
+        except:
+            finish(500)
+            raise
+        response.headers['X-Request-Id'] = request_id
+        #A streamed listing is still being traced until its body is done.
+        after_body(response, lambda: finish(response.status_int))
+        return response
+
+    return tracing_tween
+
+def _log_slow(request, status, elapsed, trace):
+    sql_count, sql_secs = trace.sql_counts()
+    log.warning(json.dumps(dict(
+            request_id = trace.request_id,
+            method = request.method,
+            path = request.path,
+            route = request.matched_route.name if request.matched_route else None,
+            status = status,
+            ms = round(elapsed * 1000, 3),
+            sql_count = sql_count,
+            sql_ms = round(sql_secs * 1000, 3),
+            dropped_spans = trace.dropped,
+            spans = trace.root.as_dict() )))
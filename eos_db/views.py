@@ -6,15 +6,27 @@ the "server" module.
 """
 
 import json, uuid
+import logging
 import hashlib, base64, random
+from itertools import islice
+from urllib.parse import urlencode
+from pyramid.request import Request
 from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.httpexceptions import (HTTPBadRequest, HTTPNotImplemented,
                                     HTTPUnauthorized, HTTPForbidden,
-                                    HTTPNotFound, HTTPInternalServerError )
+                                    HTTPNotFound, HTTPConflict,
+                                    HTTPInternalServerError )
 from pyramid.security import Allow, Everyone
+from pyramid.interfaces import IRoutesMapper
 
-from eos_db import server
+from eos_db import server, metrics, profiling, memory, models
+from eos_db.streaming import stream_response, after_body
+
+log = logging.getLogger(__name__)
+
+# Most calls allowed in one /batch request, unless batch.max_calls is set.
+BATCH_MAX_CALLS = 100
 
 # Patch for view_config - as we're not calling any of these functions directly it's
 # too easy to accidentally give two funtions the same name, and then wonder why
@@ -57,12 +69,16 @@ def home_view(request):
     """ Return a list of all valid API calls by way of documentation. """
     call_list = {"Valid API Call List":{
                               "See valid Boost levels": "/boostlevels",
+                              "Is the server up": "/health",
+                              "Is the server ready for requests": "/ready",
+                              "Run a batch of API calls": "/batch",
                               "Retrieve User List": "/users",
                               "Get my details": "/user",
                               "Get my touches": "/user/touches",
                               "Set my password": "/user/password",
                               "Get my credit": "/user/credit",
                               "servers": "/servers",  # Return server list
+                              "Details of several servers": "/servers?ids={id},{id}",
                               "Server details by name": "/servers/{name}",  # Get server details or
                               "Server details by ID": "/servers/by_id/{id}",
                               "Start a server": "/servers/{name}/Starting",
@@ -85,10 +101,249 @@ def home_view(request):
                  }
     return call_list
 
+@view_config(request_method="GET", route_name='health', renderer='json')
+def health_view(request):
+    """ Liveness probe.  Says the process is up, without going near the DB. """
+    return {"status": "ok"}
+
+@view_config(request_method="GET", route_name='ready', renderer='json')
+def ready_view(request):
+    """ Readiness probe.  Makes a trivial DB round trip, reporting on the
+        connection pool, when the config was loaded, and the schema version
+        this code expects.  The schema version is not stored in the DB, so
+        that is not checked.  Gives a 503 if the DB can't be reached.
+    """
+    res = server.check_db()
+    res['status'] = "ok" if res['db_ok'] else "unavailable"
+    res['expected_schema_version'] = models.SCHEMA_VERSION
+    res['config_loaded'] = server.CONFIG_LOADED and server.CONFIG_LOADED.isoformat()
+    if not res['db_ok']:
+        request.response.status = 503
+    return res
+
 @view_config(request_method="GET", route_name='boostlevels', renderer='json')
 def blview(request):
     return server.get_boost_levels()
 
+@view_config(request_method="POST", route_name='batch', renderer='json', permission="use")
+def batch(request):
+    """Run a list of API calls in one go.  The body is a JSON array of
+       {"method": ..., "path": ..., "params": {...}} objects, and each one is
+       dispatched through the normal routes and views, with the same credentials
+       and permission checks as this request.  All of them share one DB session.
+       By default each call is committed as it completes, so a failed call does not
+       affect the others.  With ?atomic=1 any failure rolls back all the calls and
+       gets a 409 response.
+       A batch holds a DB session and a server thread until it is done, so there
+       can be no more than batch.max_calls calls in it.
+
+    :returns: JSON array of {status, body} for each call, in order.
+    """
+    try:
+        calls = request.json_body
+        assert isinstance(calls, list)
+        assert all(isinstance(c, dict) and c.get('path') for c in calls)
+    except (ValueError, AssertionError):
+        return HTTPBadRequest()
+    max_calls = int(request.registry.settings.get('batch.max_calls', BATCH_MAX_CALLS))
+    if len(calls) > max_calls:
+        return HTTPBadRequest("No more than %i calls are allowed in a batch" % max_calls)
+    atomic = request.params.get('atomic', '0') not in ('0', 'false', '')
+
+    results = []
+    with server.shared_session() as session:
+        for call in calls:
+            result = _batch_call(request, call)
+            results.append(result)
+
+            if result['status'] < 400:
+                if not atomic: session.commit()
+            elif atomic:
+                session.rollback()
+                request.response.status = HTTPConflict.code
+                return results
+            else:
+                session.rollback()
+        session.commit()
+
+    return results
+
+def _batch_call(request, call):
+    """Run a single call from a /batch request, returning {status, body}."""
+    method = call.get('method', 'GET').upper()
+    path = call['path']
+    params = call.get('params') or {}
+
+    if method in ('POST', 'PUT'):
+        subreq = Request.blank(path, method=method, POST=params)
+    else:
+        if params:
+            path += ('&' if '?' in path else '?') + urlencode(params)
+        subreq = Request.blank(path, method=method)
+
+    #No batches within batches, or we'd be trying to share the session twice.
+    route = request.registry.getUtility(IRoutesMapper)(subreq)['route']
+    if route is not None and route.name == request.matched_route.name:
+        return dict(status=HTTPBadRequest.code, body="Nested batch calls are not allowed")
+
+    #Pass on the credentials, and also the results of looking them up so that
+    #we don't check the password again for every call.
+    for header in ('Authorization', 'Cookie', 'auth_tkt'):
+        if header in request.headers:
+            subreq.headers[header] = request.headers[header]
+    subreq.cached_authenticated_userid = request.authenticated_userid
+    subreq.cached_effective_principals = request.effective_principals
+
+    try:
+        resp = request.invoke_subrequest(subreq, use_tweens=True)
+    except Exception:
+        #Don't send the details back to the client.
+        log.exception("Error in batch call %s %s", method, call['path'])
+        return dict(status=HTTPInternalServerError.code, body="Internal server error")
+
+    if resp.content_type == 'application/json':
+        body = resp.json_body
+    else:
+        body = resp.text
+    return dict(status=resp.status_int, body=body)
+
+def _stream_json(items, chunk_size=server.STREAM_CHUNK):
+    """Returns a response that renders the items as a JSON array as they are
+       generated, rather than building the whole list and then the whole body in
+       memory like the json renderer does.  For the big listings, used with the
+       generators in the server module.
+       The queries run as the body is sent, so tweens must use
+       streaming.after_body() to see them.
+    """
+    it = iter(items)
+    #Get the first chunk now, so if the query fails outright the client gets a
+    #proper error rather than a 200 with broken JSON.
+    first = list(islice(it, chunk_size))
+
+    def app_iter():
+        sep = b'['
+        chunk = first
+        try:
+            while chunk:
+                yield sep + ','.join(json.dumps(i) for i in chunk).encode('utf-8')
+                sep = b','
+                chunk = list(islice(it, chunk_size))
+        except Exception:
+            #Too late to change the status, so at least end the JSON cleanly.
+            log.exception("Listing cut short by an error")
+        yield b']' if sep == b',' else b'[]'
+
+    response = stream_response(app_iter(), content_type='application/json', charset='utf-8')
+    #If the body is never read the items still need closing, to free the session.
+    if hasattr(it, 'close'):
+        after_body(response, it.close)
+    return response
+
+@view_config(request_method="GET", route_name='metrics', permission="administer")
+def metrics_view(request):
+    """Return request and database metrics in Prometheus text format.
+       See metrics.py.
+    """
+    resp = Response(metrics.render())
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
+@view_config(request_method="GET", route_name='profiles', renderer='json', permission="administer")
+def retrieve_profiles(request):
+    """List the saved request profiles, oldest first.  See profiling.py.
+    """
+    return [ dict(id=k, request=v) for k, v in profiling.list_profiles().items() ]
+
+@view_config(request_method="GET", route_name='profile', permission="administer")
+def retrieve_profile(request):
+    """Return a saved request profile as collapsed stacks, or as a pstats
+       listing with ?format=stats
+    """
+    profile = profiling.get_profile(request.matchdict['id'])
+    if not profile:
+        return HTTPNotFound()
+
+    if request.params.get('format') == 'stats':
+        resp = Response(profiling.stats_text(profile[1]))
+    else:
+        resp = Response(profiling.collapsed_stacks(profile[1]))
+    resp.content_type = 'text/plain'
+    resp.charset = 'utf-8'
+    return resp
+
+@view_config(request_method="GET", route_name='samples', permission="administer")
+def retrieve_samples(request):
+    """Return the stacks counted by the background sampler, as folded stacks
+       for flame graph tools.  Add ?reset=1 to start counting afresh.
+    """
+    sampler = profiling.get_sampler()
+    if not sampler:
+        return HTTPNotFound("The stack sampler is not running.")
+
+    resp = Response(sampler.folded())
+    resp.content_type = 'text/plain'
+    resp.charset = 'utf-8'
+    resp.headers['X-EOS-Samples'] = str(sampler.samples)
+    resp.headers['X-EOS-Idle-Samples'] = str(sampler.idle)
+    if request.params.get('reset'):
+        sampler.reset()
+    return resp
+
+@view_config(request_method="GET", route_name='memory', renderer='json', permission="administer")
+def retrieve_memory(request):
+    """Say whether tracemalloc is on, and how much memory it has traced.
+       See memory.py.
+    """
+    return memory.status()
+
+@view_config(request_method="POST", route_name='memory_start', renderer='json', permission="administer")
+def start_memory(request):
+    """Start tracemalloc, keeping ?frames=N frames of each traceback."""
+    try:
+        frames = int(request.params.get('frames', 1))
+    except ValueError:
+        return HTTPBadRequest()
+    if not 1 <= frames <= 100:
+        return HTTPBadRequest()
+    memory.start(frames)
+    return memory.status()
+
+@view_config(request_method="POST", route_name='memory_stop', renderer='json', permission="administer")
+def stop_memory(request):
+    """Stop tracemalloc.  Snapshots are kept."""
+    memory.stop()
+    return memory.status()
+
+@view_config(request_method="GET", route_name='memory_snapshots', renderer='json', permission="administer")
+def retrieve_memory_snapshots(request):
+    """List the memory snapshots held."""
+    return memory.list_snapshots()
+
+@view_config(request_method="POST", route_name='memory_snapshots', renderer='json', permission="administer")
+def create_memory_snapshot(request):
+    """Take a memory snapshot, returning its id.  Needs tracemalloc to be on."""
+    snapshot_id = memory.take_snapshot()
+    if not snapshot_id:
+        return HTTPConflict("Memory tracing is not on.")
+    return dict(id=snapshot_id)
+
+@view_config(request_method="GET", route_name='memory_snapshot', renderer='json', permission="administer")
+def retrieve_memory_snapshot(request):
+    """List the top allocation sites in a snapshot, or the growth since
+       ?base={id}.  Group by line, or with ?group_by=filename by file.
+    """
+    try:
+        limit = int(request.params.get('limit', memory.TOP))
+        res = memory.top( request.matchdict['id'],
+                          base_id = request.params.get('base'),
+                          group_by = request.params.get('group_by', 'lineno'),
+                          limit = limit )
+    except ValueError:
+        return HTTPBadRequest()
+    if res is None:
+        return HTTPNotFound("No such snapshot.")
+    return res
+
 # OPTIONS call result
 
 @view_config(request_method="OPTIONS", routes=['home', 'servers'])
@@ -123,11 +378,7 @@ def retrieve_users(request):
     """Return details for all users on the system.  Basically the same as calling /users/x
        for all users, but missing the credit info.
     """
-    res = []
-    for user_id in server.list_user_ids():
-        res.append(server.check_user_details(user_id))
-
-    return res
+    return _stream_json(server.iter_user_details())
 
 
 @view_config(request_method="PUT", route_name='user', renderer='json', permission="administer")
@@ -137,6 +388,22 @@ def create_user(request):
     newname = server.create_user(request.POST['type'], request.POST['handle'], request.POST['name'], request.matchdict['name'])
     return newname
 
+def _my_actor_id(request):
+    """The user id of the logged-in user, looked up just once per request.
+       Raises KeyError if there is no such user, as for an agent.
+    """
+    try:
+        actor_id = request.cached_actor_id
+    except AttributeError:
+        try:
+            actor_id = server.get_user_id_from_name(request.authenticated_userid)
+        except KeyError:
+            actor_id = None
+        request.cached_actor_id = actor_id
+    if actor_id is None:
+        raise KeyError("No such user")
+    return actor_id
+
 @view_config(request_method="GET", route_name='user', renderer='json', permission="use")
 def retrieve_user(request):
     """Return account details for any user.  Anybody should be able to do this,
@@ -161,9 +428,8 @@ def retrieve_my_user(request):
     :param name: The user we are interested in.
     :returns JSON object containing user table data.
     """
-    username = request.authenticated_userid
     try:
-        actor_id = server.get_user_id_from_name(username)
+        actor_id = _my_actor_id(request)
         details = server.check_user_details(actor_id)
         details.update({'credits' : server.check_credit(actor_id)})
         return details
@@ -198,8 +464,7 @@ def create_user_password(request):
 @view_config(request_method="PUT", route_name='my_password', renderer='json', permission="use")
 def create_my_password(request):
     """ Creates a password for the user given. """
-    username = request.authenticated_userid
-    actor_id = server.get_user_id_from_name(username)
+    actor_id = _my_actor_id(request)
     newname = server.touch_to_add_password(actor_id, request.POST['password'])
     #FIXME - should we not just return OK?
     #FIXME2 - also should this not be a POST?
@@ -274,15 +539,43 @@ def retrieve_user_credit(request):
 def retrieve_servers(request):
     """
     Lists all artifacts related to the current user.
+    Alternatively, with ?ids=1,2,3 or ?names=foo,bar, gets the details of just
+    those servers.  See _retrieve_servers_by_key() below.
     """
     user_id = None
     try:
-        user_id = server.get_user_id_from_name(request.authenticated_userid)
+        user_id = _my_actor_id(request)
     except:
         pass
         #This should only happen if the user is an agent, right?
-    server_list = server.list_artifacts_for_user(user_id)
-    return list(server_list)
+
+    if 'ids' in request.params or 'names' in request.params:
+        return _retrieve_servers_by_key(request, user_id)
+
+    return _stream_json(server.iter_artifacts_for_user(user_id))
+
+def _retrieve_servers_by_key(request, user_id):
+    """Gets details for a list of servers in one go, rather than calling
+       /servers/by_id/{id} for each.  The result is a dict keyed by the ids or
+       names that were asked for.  Where a server does not exist, or the user
+       has no permission to see it, the value will be null.
+    """
+    if 'ids' in request.params:
+        try:
+            keys = [ int(i) for i in request.params['ids'].split(',') if i ]
+        except ValueError:
+            return HTTPBadRequest()
+        key_to_id = { k: k for k in keys }
+    else:
+        keys = [ n for n in request.params['names'].split(',') if n ]
+        key_to_id = server.get_server_ids_from_names(keys)
+
+    vm_ids = set(key_to_id.values())
+    if not request.has_permission('act'):
+        vm_ids = server.list_owned_artifacts(vm_ids, user_id)
+
+    details = server.return_artifact_details_multi(vm_ids)
+    return { k: details.get(key_to_id.get(k)) for k in keys }
 
 @view_config(request_method="GET", route_name='states', renderer='json', permission="use")
 def retrieve_server_counts_by_state(request):
@@ -307,13 +600,7 @@ def retrieve_servers_in_state(request):
     """
     Lists all servers in a given state.
     """
-    server_ids = server.list_servers_by_state().get(request.matchdict['name'],())
-    server_uuid = [ server.get_server_uuid_from_id(s_id) for s_id in server_ids ]
-    server_name = [ server.get_server_name_from_id(s_id) for s_id in server_ids ]
-    return [ { "artifact_id"   : s[0],
-               "artifact_uuid" : s[1],
-               "artifact_name" : s[2] }
-             for s in zip(server_ids, server_uuid, server_name) ]
+    return _stream_json(server.iter_servers_in_state(request.matchdict['name']))
 
 @view_config(request_method="PUT", route_name='server', renderer='json', permission="administer")
 def create_server(request):
@@ -372,7 +659,7 @@ def _resolve_vm(request):
     actor_id = None
     vm_id = None
     try:
-        actor_id = server.get_user_id_from_name(request.authenticated_userid)
+        actor_id = _my_actor_id(request)
     except:
         #OK, it must be an agent or an internal call.
         pass